@@ -0,0 +1,59 @@
+import tempfile
+import numpy as np
+from shrimpgrad import Tensor
+from shrimpgrad.engine.realize import kernel_name
+from shrimpgrad.engine.schedule import Scheduler
+from shrimpgrad.runtime.clang import ClangCompiler, ClangProgram
+from benchmarks.harness import benchmark
+
+def chain(x: Tensor, depth: int) -> Tensor:
+  # permutes force a kernel boundary every other op, so the graph has depth/2 kernels
+  for i in range(depth): x = (x * 1.5 + 0.5).permute((1, 0)) if i % 2 else (x * 1.5 + 0.5)
+  return x
+
+@benchmark('graph', depth=[50, 150, 1000, 2000])
+def build(depth: int):
+  x = Tensor.from_numpy(np.ones((8, 8), dtype=np.float32))
+  return lambda: chain(x, depth)
+
+@benchmark('graph', depth=[50, 150, 1000, 2000])
+def schedule(depth: int):
+  y = chain(Tensor.from_numpy(np.ones((8, 8), dtype=np.float32)), depth)
+  return lambda: Scheduler([y.thunk]).schedule()
+
+def _program() -> ClangProgram:
+  x = Tensor.from_numpy(np.ones((32, 32), dtype=np.float32))
+  sk = Scheduler([((x * 2.0 + 1.0).exp() * x).sum(axis=1).thunk]).schedule()[-1]
+  prg = ClangProgram()
+  prg.create_kernel(kernel_name(sk.ast), sk.ast)
+  return prg
+
+@benchmark('compile', cache=['cold', 'warm'])
+def clang_compile(cache: str):
+  prg, compiler = _program(), ClangCompiler()
+  if cache == 'warm': return lambda: compiler.compile(prg)
+  def cold():
+    # an empty cache directory and no loaded handles, so every call invokes clang
+    with tempfile.TemporaryDirectory() as tmp:
+      compiler.cache_dir = tmp
+      ClangCompiler._libs.clear()
+      compiler.compile(prg)
+  return cold
+
+@benchmark('compile', threads=[1, 4])
+def realize_cold(threads: int):
+  import shrimpgrad.engine.realize as realize
+  def step() -> Tensor:
+    # 16 kernels with distinct sources, none of them cached
+    x = Tensor.from_numpy(np.ones((16, 16), dtype=np.float32))
+    for i in range(16): x = (x * (1.0 + i/16)).permute((1, 0)).exp() if i % 2 else x + float(i)
+    return x
+  def cold():
+    compile_threads, cache_dir, realize.COMPILE_THREADS = realize.COMPILE_THREADS, ClangCompiler.cache_dir, threads
+    try:
+      with tempfile.TemporaryDirectory() as tmp:
+        ClangCompiler.cache_dir = tmp
+        ClangCompiler._libs.clear()
+        step().numpy()
+    finally: realize.COMPILE_THREADS, ClangCompiler.cache_dir = compile_threads, cache_dir
+  return cold
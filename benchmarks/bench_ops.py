@@ -0,0 +1,32 @@
+import numpy as np
+from shrimpgrad import Tensor
+from shrimpgrad.nn import Linear
+from benchmarks.harness import benchmark
+
+def rand(*shape) -> Tensor: return Tensor.from_numpy(np.random.default_rng(0).standard_normal(shape, dtype=np.float32))
+
+# Each timed call builds the graph, schedules, compiles (a cache hit after warmup) and runs it
+
+@benchmark('ops', size=[1 << 10, 1 << 16, 1 << 20])
+def elementwise(size: int):
+  x, y = rand(size), rand(size)
+  return lambda: ((x * y + 1.0).relu() / 2.0).realize()
+
+@benchmark('ops', shape=[(1024, 1024), (64, 16384)], axis=[0, 1])
+def reduce_sum(shape, axis: int):
+  x = rand(*shape)
+  return lambda: x.sum(axis=axis).realize()
+
+@benchmark('ops', n=[16, 64, 256])
+def dot(n: int):
+  x, w = rand(n, n), rand(n, n)
+  return lambda: x.dot(w).realize()
+
+@benchmark('nn', batch=[32], features=[(64, 64), (256, 128)])
+def linear_forward_backward(batch: int, features):
+  layer, x = Linear(*features), rand(batch, features[0])
+  def step():
+    layer.w.grad = layer.bias.grad = None
+    layer(x).sum().backward()
+    layer.w.grad.realize(layer.bias.grad)
+  return step
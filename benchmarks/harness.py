@@ -0,0 +1,82 @@
+from __future__ import annotations
+import itertools
+import json
+import os
+import platform
+import statistics
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+@dataclass
+class Benchmark:
+  name: str
+  group: str
+  setup: Callable[..., Callable[[], Any]] # builds the inputs and returns the function to time
+  params: Dict[str, Any] = field(default_factory=dict)
+
+@dataclass
+class Result:
+  name: str
+  group: str
+  params: Dict[str, Any]
+  times: List[float]
+  @property
+  def median(self) -> float: return statistics.median(self.times)
+  def to_json(self) -> Dict[str, Any]:
+    return {**asdict(self), 'median': self.median, 'min': min(self.times), 'mean': statistics.fmean(self.times),
+            'stdev': statistics.stdev(self.times) if len(self.times) > 1 else 0.0}
+
+BENCHMARKS: List[Benchmark] = []
+
+def benchmark(group: str, **grid: List[Any]):
+  """Registers a setup function once per point of the parameter grid, named group/fn[key=value,...]."""
+  def register(setup: Callable[..., Callable[[], Any]]):
+    for values in itertools.product(*grid.values()):
+      params = dict(zip(grid.keys(), values))
+      suffix = f"[{','.join(f'{k}={v}' for k, v in params.items())}]" if params else ''
+      BENCHMARKS.append(Benchmark(f'{group}/{setup.__name__}{suffix}', group, setup, params))
+    return setup
+  return register
+
+def run(bench: Benchmark, repeat: int=10, warmup: int=2) -> Result:
+  fxn = bench.setup(**bench.params)
+  for _ in range(warmup): fxn()
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fxn()
+    times.append(time.perf_counter() - start)
+  return Result(bench.name, bench.group, bench.params, times)
+
+def machine() -> Dict[str, Any]:
+  import numpy as np
+  from shrimpgrad.device import ClangDevice
+  from shrimpgrad.runtime.clang import clang_version
+  return {'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+          'numpy': np.__version__, 'clang': clang_version(), 'threads': ClangDevice().threads, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def save(results: List[Result], path: str):
+  with open(path, 'w') as f: json.dump({'machine': machine(), 'results': {r.name: r.to_json() for r in results}}, f, indent=2)
+
+def load(path: str) -> Dict[str, Dict[str, Any]]:
+  with open(path) as f: return json.load(f)['results']
+
+@dataclass
+class Comparison:
+  name: str
+  baseline: float
+  current: float
+  @property
+  def ratio(self) -> float: return self.current / self.baseline
+
+def compare(results: List[Result], baseline: Dict[str, Dict[str, Any]], threshold: float=0.1) -> List[Comparison]:
+  """Compares medians against the baseline, returns the benchmarks that got slower by more than threshold."""
+  rows = [Comparison(r.name, baseline[r.name]['median'], r.median) for r in results if r.name in baseline]
+  for row in rows:
+    flag = 'REGRESSED' if row.ratio > 1 + threshold else 'improved' if row.ratio < 1 - threshold else ''
+    print(f'{row.name:<56} {row.baseline*1e3:>10.3f}ms {row.current*1e3:>10.3f}ms {row.ratio:>6.2f}x {flag}')
+  return [row for row in rows if row.ratio > 1 + threshold]
+
+def report(results: List[Result], out: Optional[Callable[[str], None]]=print):
+  for r in results: out(f'{r.name:<56} median {r.median*1e3:>10.3f}ms  min {min(r.times)*1e3:>10.3f}ms')
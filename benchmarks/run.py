@@ -0,0 +1,43 @@
+"""Runs the benchmark suite.
+
+  python -m benchmarks.run                          # run everything, print medians
+  python -m benchmarks.run -k ops/dot --out res.json
+  python -m benchmarks.run --save-baseline          # store results as benchmarks/baseline.json
+  python -m benchmarks.run --baseline benchmarks/baseline.json --threshold 0.1
+
+Exits with status 1 when a benchmark's median is slower than the baseline by more than threshold.
+Timings only compare on the machine that recorded them, so the baseline is not committed (it is in .gitignore):
+save one on your machine before a change and compare against it after.
+"""
+import argparse
+import importlib
+import os
+import sys
+from benchmarks.harness import BENCHMARKS, compare, load, report, run, save
+
+# importing a benchmark module registers its benchmarks
+for module in ('bench_graph', 'bench_ops'): importlib.import_module(f'benchmarks.{module}')
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+def main(argv=None) -> int:
+  parser = argparse.ArgumentParser(description='shrimpgrad benchmarks')
+  parser.add_argument('-k', dest='filter', default='', help='only run benchmarks whose name contains this')
+  parser.add_argument('--repeat', type=int, default=10)
+  parser.add_argument('--warmup', type=int, default=2)
+  parser.add_argument('--out', help='write results as JSON to this path')
+  parser.add_argument('--baseline', help='compare against the results stored at this path')
+  parser.add_argument('--save-baseline', action='store_true', help=f'store the results as {BASELINE}')
+  parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown counted as a regression')
+  args = parser.parse_args(argv)
+
+  results = [run(b, args.repeat, args.warmup) for b in BENCHMARKS if args.filter in b.name]
+  report(results)
+  if args.out: save(results, args.out)
+  if args.save_baseline: save(results, BASELINE)
+  if args.baseline is None: return 0
+  regressions = compare(results, load(args.baseline), args.threshold)
+  for r in regressions: print(f'regression: {r.name} {r.ratio:.2f}x slower', file=sys.stderr)
+  return 1 if regressions else 0
+
+if __name__ == '__main__': sys.exit(main())
@@ -3,4 +3,5 @@ from shrimpgrad.autograd.function import *
 from shrimpgrad.util import *
 from shrimpgrad.runtime import python, clang, ops
 from shrimpgrad.dtype import *
-from shrimpgrad.device import *
\ No newline at end of file
+from shrimpgrad.device import *
+from shrimpgrad.engine.jit import ShrimpJit
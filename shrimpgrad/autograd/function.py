@@ -1,13 +1,30 @@
+import contextlib
 import math
+import threading
 from typing import Any, Optional, Tuple, TypeAlias 
 import shrimpgrad as shrimp
 from shrimpgrad.device import Device
-from shrimpgrad.runtime.ops import UnaryOps, BinaryOps, TernaryOps, ReduceOps
+from shrimpgrad.runtime.ops import UnaryOps, BinaryOps, TernaryOps, ReduceOps, LoadOps
 from shrimpgrad.util import argsort
 from shrimpgrad.future import Thunk 
 
 OptionalGradients: TypeAlias = Tuple[Optional[Thunk], ...]
 
+_grad_mode = threading.local()
+def grad_enabled() -> bool: return getattr(_grad_mode, 'enabled', True)
+
+class no_grad(contextlib.ContextDecorator):
+  """Context manager and decorator that stops autograd from recording history on the current thread."""
+  def __enter__(self):
+    # the previous modes live on the thread, so one instance can be nested, reused and shared between threads
+    if not hasattr(_grad_mode, 'stack'): _grad_mode.stack = []
+    _grad_mode.stack.append(grad_enabled())
+    _grad_mode.enabled = False
+    return self
+  def __exit__(self, *exc): _grad_mode.enabled = _grad_mode.stack.pop()
+
+class inference_mode(no_grad): pass
+
 class FunctionContext:
   def __init__(self, device: Device, *tensors): 
     self.device = device
@@ -30,10 +47,15 @@ class Function(FunctionContext):
 
   @classmethod
   def apply(cls, *tensors, **kwargs) -> Thunk:
-    ctx = cls(tensors[0].device, *tensors)
-    thunk = cls.forward(ctx, *[t.thunk for t in tensors], **kwargs)
     from shrimpgrad import Tensor
     ret = Tensor.__new__(Tensor)
+    if not grad_enabled():
+      # forward still needs somewhere to write what it saves, but nothing keeps it alive
+      ret.grad, ret.requires_grad, ret.cls, ret.ctx = None, False, cls, None
+      ret.thunk = cls.forward(cls.__new__(cls), *[t.thunk for t in tensors], **kwargs)
+      return ret
+    ctx = cls(tensors[0].device, *tensors)
+    thunk = cls.forward(ctx, *[t.thunk for t in tensors], **kwargs)
     ret.grad, ret.requires_grad, ret.cls, ret.ctx = None, ctx.requires_grad, cls, ctx
     ret.thunk= thunk
     return ret
@@ -63,7 +85,7 @@ class Mul(Function):
   @staticmethod
   def backward(ctx: FunctionContext, grad_out: Thunk) -> OptionalGradients:
     x, y = ctx.x, ctx.y 
-    return (x.alu(BinaryOps.MUL, grad_out), y.alu(BinaryOps.MUL, grad_out))
+    return (y.alu(BinaryOps.MUL, grad_out), x.alu(BinaryOps.MUL, grad_out))
 
 class Div(Function):
   @staticmethod
@@ -156,6 +178,56 @@ class Expand(Function):
   def backward(ctx: FunctionContext, grad_out: Thunk) -> Thunk:
     return grad_out.reduce(ReduceOps.SUM, axis=tuple(ctx.expanded_axis)) 
 
+class Shrink(Function):
+  @staticmethod
+  def forward(ctx: FunctionContext, x: Thunk, arg: Tuple[Tuple[int, int], ...]) -> Thunk:
+    ctx.pad_arg = tuple((b, s-e) for (b, e), s in zip(arg, x.shape))
+    return x.shrink(arg)
+  @staticmethod
+  def backward(ctx: FunctionContext, grad_out: Thunk) -> Thunk:
+    return grad_out.pad(ctx.pad_arg)
+
+class Pad(Function):
+  @staticmethod
+  def forward(ctx: FunctionContext, x: Thunk, arg: Tuple[Tuple[int, int], ...]) -> Thunk:
+    ctx.shrink_arg = tuple((b, b+s) for (b, _), s in zip(arg, x.shape))
+    return x.pad(arg)
+  @staticmethod
+  def backward(ctx: FunctionContext, grad_out: Thunk) -> Thunk:
+    return grad_out.shrink(ctx.shrink_arg)
+
+class Stride(Function):
+  @staticmethod
+  def forward(ctx: FunctionContext, x: Thunk, mul: Tuple[int, ...]) -> Thunk:
+    ctx.mul, ctx.shape = mul, x.shape
+    return x.stride(mul)
+  @staticmethod
+  def backward(ctx: FunctionContext, grad_out: Thunk) -> Thunk:
+    # Every element of grad_out is padded out to a block of |mul| (the skipped elements get no gradient),
+    # trimmed to the input shape and flipped back where mul is negative
+    shape = grad_out.shape
+    g = grad_out.reshape(tuple(d for n in shape for d in (n, 1)))
+    g = g.pad(tuple(p for m in ctx.mul for p in ((0, 0), (0, abs(m)-1))))
+    g = g.reshape(tuple(n*abs(m) for n, m in zip(shape, ctx.mul))).shrink(tuple((0, s) for s in ctx.shape))
+    return g.stride(tuple(-1 if m < 0 else 1 for m in ctx.mul)) if any(m < 0 for m in ctx.mul) else g
+
+class Gather(Function):
+  @staticmethod
+  def forward(ctx: FunctionContext, x: Thunk, idx: Thunk, dim: int) -> Thunk:
+    ctx.idx, ctx.dim, ctx.size = idx, dim, x.shape[dim]
+    return x.gather(idx, dim)
+  @staticmethod
+  def backward(ctx: FunctionContext, grad_out: Thunk) -> OptionalGradients:
+    # Every element of x sums the gradient of the outputs that read it: the outputs are compared with each
+    # position of dim on a new axis after it, where (not a multiply) keeps a non-finite gradient out of the others
+    dim, s, shape = ctx.dim, ctx.size, grad_out.shape
+    wide = (*shape[:dim+1], s, *shape[dim+1:])
+    pos = shrimp.Tensor.arange(0, s, dtype=ctx.idx.dtype, device=ctx.device).thunk.reshape((1,)*(dim+1) + (s,) + (1,)*(len(shape)-dim-1)).expand(wide)
+    hit = ctx.idx.reshape((*shape[:dim+1], 1, *shape[dim+1:])).expand(wide).alu(BinaryOps.CMPEQ, pos)
+    g = grad_out.reshape((*shape[:dim+1], 1, *shape[dim+1:])).expand(wide)
+    grad = hit.alu(TernaryOps.WHERE, g, g.const(0.0)).reduce(ReduceOps.SUM, (dim,))
+    return grad.reshape((*shape[:dim], s, *shape[dim+1:])), None
+
 class Less(Function):
   @staticmethod
   def forward(ctx: FunctionContext, x:Thunk, y:Thunk) -> Thunk: 
@@ -201,3 +273,29 @@ class Sigmoid(Function):
   @staticmethod
   def backward(ctx: FunctionContext, grad_out: Thunk) -> Thunk:
     return ctx.ret.alu(BinaryOps.MUL, ctx.ret.const(1).alu(BinaryOps.SUB, ctx.ret)).alu(BinaryOps.MUL, grad_out)
+
+class Checkpoint(Function):
+  # Only the segment inputs are saved, the activations inside fn are rebuilt from them in backward
+  @staticmethod
+  def forward(ctx: FunctionContext, *xs: Thunk, fn) -> Thunk:
+    ctx.fn, ctx.xs = fn, xs
+    with no_grad(): out = fn(*[shrimp.Tensor(x.shape, x, x.dtype, x.device, requires_grad=False) for x in xs]).thunk
+    # The output is realized into a buffer of its own and handed over to a thunk without operands,
+    # so nothing downstream reaches back into the segment graph
+    if out.base is not out: out = out.alu(BinaryOps.MUL, out.const(1.0))
+    from shrimpgrad.engine.realize import realize
+    realize(out)
+    ret = Thunk.loadop(LoadOps.EMPTY, out.shape, out.dtype, out.device)
+    ret.buff = out.buff
+    del ret._operands
+    return ret
+  @staticmethod
+  def backward(ctx: FunctionContext, grad_out: Thunk) -> OptionalGradients:
+    xs = [shrimp.Tensor(x.shape, x, x.dtype, x.device, requires_grad=True) for x in ctx.xs]
+    ctx.fn(*xs).backward(shrimp.Tensor(grad_out.shape, grad_out, grad_out.dtype, grad_out.device, requires_grad=False))
+    grads = tuple(x.grad.thunk if x.grad is not None else x.thunk.const(0.0) for x in xs)
+    return grads[0] if len(grads) == 1 else grads
+
+def checkpoint(fn, *tensors) -> shrimp.Tensor:
+  """Runs fn(*tensors) without keeping its activations and recomputes them from tensors during backward."""
+  return Checkpoint.apply(*tensors, fn=fn)
@@ -1,10 +1,18 @@
 
 from __future__ import annotations
 import ctypes
-from typing import Type
+import mmap
+import os
+import sys
+import threading
+import weakref
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Type
 from shrimpgrad.dtype import DType
 from shrimpgrad.meta.singleton import Singleton
-from shrimpgrad.runtime.clang import ClangCompiler, ClangRuntime
+from shrimpgrad.runtime.clang import ClangCompiler, ClangProgram, ClangRuntime
+from shrimpgrad.runtime.numpy import NumpyCompiler, NumpyProgram, NumpyRuntime
+from shrimpgrad.util import from_mv
 
 class Device(metaclass=Singleton):
   def __init__(self, name:str): self.name = name
@@ -17,12 +25,15 @@ class Runtime:
   def exec(self): raise NotImplementedError('implement exec') 
 
 class Accelerator(Device):
-  def __init__(self, name:str, allocator: Type[Allocator], compiler: Type[Compiler], runtime: Type[Runtime]) -> None:
+  def __init__(self, name:str, allocator: Type[Allocator], compiler: Type[Compiler], runtime: Type[Runtime], program: Type) -> None:
     super().__init__(name)
-    self._allocator, self._compiler, self._runtime = allocator, compiler, runtime
+    self._allocator, self._compiler, self._runtime, self._program = allocator, compiler, runtime, program
+  def program(self): return self._program()
   def compiler(self): raise NotImplementedError('implement compiler for accelerator')
   def allocator(self): raise NotImplementedError('implement allocator for accelerator')
   def runtime(self): raise NotImplementedError('implement runtime for accelerator')
+  # a library call that runs the kernel instead of a compiled program, None if the device has none for it
+  def library_kernel(self, ast) -> Optional[Callable]: return None
 
 class HostDevice(Device): 
   def copyto(self, accelerator: Accelerator): raise NotImplementedError('implement copyto')
@@ -34,46 +45,153 @@ class CPU(HostDevice):
 
 class ClangDevice(Accelerator):
   def __init__(self) -> None:
-    super().__init__("CLANG", MallocAllocator, ClangCompiler, ClangRuntime)
+    super().__init__("CLANG", MallocAllocator, ClangCompiler, ClangRuntime, ClangProgram)
+    # kernels that loop over fewer than parallel_threshold elements stay on the calling thread
+    self.threads, self.parallel_threshold = int(os.getenv('SHRIMP_THREADS', str(os.cpu_count() or 1))), 1 << 16
+    # one allocator per device so every buffer shares its free lists
+    self._alloc = self._allocator()
+    # matmuls of plain buffers go to the system BLAS when there is one (see runtime/blas.py), off they use the generated gemm
+    self.use_blas = True
   
   def allocator(self):
-    return self._allocator()
+    return self._alloc
 
   def compiler(self):
     return self._compiler()
 
-  def runtime(self):
-    return self._runtime()
+  def runtime(self, lib):
+    return self._runtime(lib, threads=self.threads, parallel_threshold=self.parallel_threshold)
+
+  def library_kernel(self, ast):
+    from shrimpgrad.runtime.blas import blas_kernel, load_blas
+    return None if not self.use_blas or (lib := load_blas()) is None else blas_kernel(lib, ast)
+
+class NumpyDevice(Accelerator):
+  def __init__(self) -> None:
+    super().__init__("NUMPY", MallocAllocator, NumpyCompiler, NumpyRuntime, NumpyProgram)
+    self._alloc = self._allocator()
+
+  def allocator(self):
+    return self._alloc
+
+  def compiler(self):
+    return self._compiler()
+
+  def runtime(self, lib):
+    return self._runtime(lib)
 
 class Allocator:
   def alloc(self): raise NotImplementedError('implement alloc')
-  def free(self): raise NotImplementedError('implement free')
+  def free(self, buf, size:int): raise NotImplementedError('implement free')
   def copyin(self): raise NotImplementedError('implement copyin')
   def copyout(self): raise NotImplementedError('implement copyout')
+  def from_buffer(self): raise NotImplementedError('implement from_buffer')
+
+def size_class(size:int) -> int:
+  # powers of two up to 1MB then whole megabytes, so a reused block wastes at most half of a small request
+  if size > 1 << 20: return -(-size // (1 << 20)) * (1 << 20)
+  return max(64, 1 << (size - 1).bit_length())
 
-class MallocAllocator(Allocator):
+class CachingAllocator(Allocator):
+  # Freed blocks go to a free list per size class and are handed out again before asking the device for memory.
+  # Buffers are allocated and freed from the compile and kernel pools and the garbage collector, the lock guards the lists and counters
+  def __init__(self, cap:int=int(os.getenv('SHRIMP_ALLOC_CACHE', str(1 << 30)))):
+    self.cap, self.cached, self.hits, self.misses = cap, 0, 0, 0
+    self.free_lists: Dict[int, List] = defaultdict(list)
+    self._lock = threading.Lock()
   def alloc(self, size:int):
+    bucket = size_class(size)
+    with self._lock:
+      if self.free_lists[bucket]:
+        self.hits, self.cached = self.hits + 1, self.cached - bucket
+        return self.free_lists[bucket].pop()
+      self.misses += 1
+    return self._alloc(bucket)
+  def free(self, buf, size:int):
+    bucket = size_class(size)
+    with self._lock:
+      if self.cached + bucket <= self.cap:
+        self.free_lists[bucket].append(buf)
+        self.cached += bucket
+        return
+    self._free(buf)
+  def trim(self, target:int=0) -> int:
+    # Releases cached blocks, largest first, until at most target bytes are held; returns the bytes released
+    released, blocks = 0, []
+    with self._lock:
+      for bucket in sorted(self.free_lists, reverse=True):
+        while self.free_lists[bucket] and self.cached > target:
+          blocks.append(self.free_lists[bucket].pop())
+          self.cached, released = self.cached - bucket, released + bucket
+    for buf in blocks: self._free(buf)
+    return released
+  @property
+  def stats(self) -> Dict[str, int]: return {'hits': self.hits, 'misses': self.misses, 'cached_bytes': self.cached, 'cap': self.cap}
+  def reset_stats(self): self.hits = self.misses = 0
+  def _alloc(self, size:int): raise NotImplementedError('implement _alloc')
+  def _free(self, buf): return
+
+class MallocAllocator(CachingAllocator):
+  def _alloc(self, size:int):
     return (ctypes.c_uint8 * size)()
   def copyin(self, dst, src:memoryview):
-    ctypes.memmove(dst, src, len(src))
+    ctypes.memmove(dst, from_mv(src), len(src))
   def copyout(self, dst:memoryview, src):
-    ctypes.memmove(dst, src, len(dst))
-  def free(self): return
+    ctypes.memmove(from_mv(dst), src, len(dst))
+  def from_buffer(self, src:memoryview):
+    # Shares writable memory (ctypes keeps the exporter alive), read only memory has to be copied
+    return (ctypes.c_uint8 * len(src)).from_buffer_copy(src) if src.readonly else (ctypes.c_uint8 * len(src)).from_buffer(src)
+
+class MmapAllocator(MallocAllocator):
+  # Maps a region of a file, pages are read lazily by the OS page cache
+  # read only mappings are copy on write so kernels can never touch the file, writable ones are shared with it
+  def map(self, path:str, size:int, offset:int=0, writable:bool=False):
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(path, 'r+b' if writable else 'rb') as f:
+      if writable and os.fstat(f.fileno()).st_size < offset + size: f.truncate(offset + size)
+      mm = mmap.mmap(f.fileno(), offset + size - start, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_COPY, offset=start)
+    return mm, (ctypes.c_uint8 * size).from_buffer(mm, offset - start)
+  def flush(self, mm: mmap.mmap): mm.flush()
 
 class Buffer:
   def __init__(self, device: Device, size:int, dtype: DType):
     self.allocator, self.dtype, self.size = device.allocator() if isinstance(device, Accelerator) else None, dtype, size
+    self.device = device
     self._ref_count = 1
+    self._holders: List[weakref.ref] = []
   @property
   def allocated(self): return hasattr(self, '_buf')
+  def hold(self, holder):
+    # Weak references to the tensors reading this buffer, dead ones are dropped as new ones arrive
+    self._holders = [r for r in self._holders if r() is not None] + [weakref.ref(holder)] if self._holders else [weakref.ref(holder)]
+  @property
+  def held(self) -> bool: return any(r() is not None for r in self._holders)
   @property
   def nbytes(self): return self.size * self.dtype.bytes
   def allocate(self, with_data=None):
+    self._owned = with_data is None
     if with_data is None: # Alloc empty buffer
       self._buf = self.allocator.alloc(self.dtype.bytes * self.size)
+    elif self.allocator is not None and isinstance(with_data, memoryview): # Wrap existing memory
+      self._buf = self.allocator.from_buffer(with_data)
     else:
       self._buf = with_data 
     return self
+  def deallocate(self):
+    # The block leaves the buffer in one step, so of two racing deallocations (a run and the garbage collector) only
+    # one frees it and no thread can take a new reference to it after the count below
+    if (buf := self.__dict__.pop('_buf', None)) is None: return
+    # A block still referenced elsewhere (a numpy view, a pointer, a running kernel) is left to the garbage collector, never reused
+    if self._owned and sys.getrefcount(buf) == 2: self.allocator.free(buf, self.nbytes)
+  def __del__(self):
+    if self.allocated: self.deallocate()
+  def map(self, path:str, offset:int=0, writable:bool=False):
+    assert isinstance(self.allocator, MallocAllocator), f"{self.device.name} buffers can not be backed by a file"
+    self._owned = False
+    self._mmap, self._buf = MmapAllocator().map(path, self.nbytes, offset, writable)
+    return self
+  def flush(self):
+    if hasattr(self, '_mmap'): MmapAllocator().flush(self._mmap)
   def pointer(self, to_type=ctypes.c_byte):
     return ctypes.cast(ctypes.addressof(to_type.from_buffer(self._buf)), ctypes.POINTER(to_type*self.size)).contents
   def copyin(self, src: memoryview): 
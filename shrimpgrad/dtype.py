@@ -7,13 +7,14 @@ ConstType: TypeAlias = Union[float, int, bool]
 class DType:
   bytes: int
   name: str
+  fmt: str
   def __repr__(self):
     return f'shrimp.{self.name}'
   
 class dtypes:
-  int32: Final[DType] = DType(4, "int32")
-  float32: Final[DType] = DType(4, "float32")
-  bool: Final[DType] = DType(1, "bool")
+  int32: Final[DType] = DType(4, "int32", "i")
+  float32: Final[DType] = DType(4, "float32", "f")
+  bool: Final[DType] = DType(1, "bool", "?")
   @staticmethod
   def from_py(x: ConstType) -> DType:
     if isinstance(x, float): return dtypes.float32
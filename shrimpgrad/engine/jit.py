@@ -0,0 +1,56 @@
+from __future__ import annotations
+import functools
+from typing import Any, Callable, List
+from shrimpgrad.device import Buffer
+from shrimpgrad.engine.realize import CAPTURING, ExecItem
+from shrimpgrad.shapetracker import ShapeTracker
+from shrimpgrad.tensor import Tensor
+
+def _tensors(x: Any) -> List[Tensor]:
+  if isinstance(x, Tensor): return [x]
+  if isinstance(x, (list, tuple)): return [t for y in x for t in _tensors(y)]
+  if isinstance(x, dict): return [t for y in x.values() for t in _tensors(y)]
+  return []
+
+def _realize(tensors: List[Tensor]):
+  if tensors: tensors[0].realize(*tensors[1:])
+
+class ShrimpJit:
+  """Captures the kernels fn launches and replays them on later calls.
+  The first call runs fn normally, the second records every kernel it launches, and from then on
+  the recorded kernels run directly on the new input buffers without building or scheduling a graph.
+  Returned tensors are reused, so each replay overwrites the previous result. The kernels bake in the view
+  of every input, a call with another view (slice, offset or permutation) of an input raises, reset() captures again.
+  """
+  def __init__(self, fn: Callable):
+    self.fn, self.cnt = fn, 0
+    self.jit_cache: List[ExecItem] = []
+    self.input_buffers: List[Buffer] = []
+    self.input_sts: List[ShapeTracker] = []
+    functools.update_wrapper(self, fn)
+
+  def reset(self): self.cnt, self.jit_cache, self.input_buffers, self.input_sts = 0, [], [], []
+
+  def __call__(self, *args, **kwargs):
+    inputs = _tensors([args, kwargs])
+    _realize(inputs)
+    buffers, sts = [t.thunk.base.buff for t in inputs], [t.thunk.st for t in inputs]
+    if self.cnt >= 2:
+      assert len(buffers) == len(self.input_buffers), f'jit captured {len(self.input_buffers)} input tensors, got {len(buffers)}'
+      for old, new in zip(self.input_buffers, buffers):
+        assert old.size == new.size and old.dtype == new.dtype, f'jit input changed from {old.size} {old.dtype} to {new.size} {new.dtype}'
+      for old, new in zip(self.input_sts, sts): assert old == new, f'jit input view changed from {old} to {new}, reset() to capture it again'
+      swap = dict(zip(self.input_buffers, buffers))
+      for ei in self.jit_cache: ei.run(tuple(swap.get(b, b) for b in ei.bufs))
+    elif self.cnt == 1:
+      CAPTURING.append([])
+      try:
+        self.ret = self.fn(*args, **kwargs)
+        _realize(_tensors(self.ret))
+      finally: self.jit_cache = CAPTURING.pop()
+      self.input_buffers, self.input_sts = buffers, sts
+    else:
+      self.ret = self.fn(*args, **kwargs)
+      _realize(_tensors(self.ret))
+    self.cnt += 1
+    return self.ret
@@ -0,0 +1,58 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Tuple
+from shrimpgrad.device import Buffer, Device
+from shrimpgrad.engine.schedule import ScheduledKernel
+
+@dataclass
+class Arena:
+  device: Device
+  size: int = 0
+  free_at: int = -1 # index of the last kernel that reads the current occupant
+
+@dataclass
+class MemoryPlan:
+  # intermediate buffer -> index of the arena it lives in
+  assignments: Dict[Buffer, int] = field(default_factory=dict)
+  arenas: List[Arena] = field(default_factory=list)
+  kept: int = 0 # bytes of the buffers that outlive the schedule
+  unplanned: int = 0 # bytes the schedule allocates when every buffer gets its own memory
+  @property
+  def peak(self) -> int: return self.kept + sum(a.size for a in self.arenas)
+  def report(self) -> str:
+    return f'memory plan: {len(self.assignments)} intermediates in {len(self.arenas)} arenas, peak {self.peak} bytes, unplanned {self.unplanned} bytes'
+
+def liveness(schedule: List[ScheduledKernel]) -> Dict[Buffer, Tuple[int, int]]:
+  # [first kernel that writes, last kernel that reads] for every buffer the schedule produces
+  lifetimes: Dict[Buffer, Tuple[int, int]] = {}
+  for i, sk in enumerate(schedule):
+    for b in sk.inputs:
+      if b in lifetimes: lifetimes[b] = (lifetimes[b][0], i)
+    for b in sk.outputs:
+      if b not in lifetimes: lifetimes[b] = (i, i)
+  return lifetimes
+
+def plan_memory(schedule: List[ScheduledKernel], keep: Iterable[Buffer]) -> MemoryPlan:
+  """Packs the intermediates of a schedule into shared arenas.
+  Buffers whose lifetimes do not overlap share an arena (interval graph coloring), keep buffers get their own memory.
+  So do buffers a live tensor still reads, through its own thunk or a view of it. Autograd contexts hold
+  their input tensors, so outside of no_grad the intermediates backward needs are kept too.
+  """
+  keep, plan = set(keep), MemoryPlan()
+  for b, (start, end) in sorted(liveness(schedule).items(), key=lambda x: x[1][0]):
+    plan.unplanned += b.nbytes
+    if b in keep or b.held or b.allocated or b.allocator is None:
+      plan.kept += b.nbytes
+      continue
+    free = [i for i, a in enumerate(plan.arenas) if a.free_at < start and a.device == b.device]
+    # Best fit, otherwise grow the largest free arena, otherwise open a new one
+    fits = [i for i in free if plan.arenas[i].size >= b.nbytes]
+    if fits: idx = min(fits, key=lambda i: plan.arenas[i].size)
+    elif free: idx = max(free, key=lambda i: plan.arenas[i].size)
+    else:
+      idx = len(plan.arenas)
+      plan.arenas.append(Arena(b.device))
+    arena = plan.arenas[idx]
+    arena.size, arena.free_at = max(arena.size, b.nbytes), end
+    plan.assignments[b] = idx
+  return plan
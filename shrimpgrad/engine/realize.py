@@ -0,0 +1,118 @@
+from __future__ import annotations
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional, Tuple
+from shrimpgrad.device import Buffer
+from shrimpgrad.engine.memory import MemoryPlan, plan_memory
+from shrimpgrad.engine.schedule import MLIR, ScheduledKernel, Scheduler
+from shrimpgrad.future import Thunk
+from shrimpgrad.runtime.clang import launch_dims
+from shrimpgrad.runtime.ops import BufferOps, LoadOps, ReduceOps, TernaryOps
+from shrimpgrad.runtime.profiler import PROFILER
+
+def kernel_name(ast: MLIR) -> str: return ('r_' if ast.inputs[0].op in ReduceOps else 'E_') + '_'.join(str(s) for s in ast.arg.st.shape or (1,))
+
+def _host_data(buff: Buffer) -> memoryview:
+  # Host buffers hold whatever the tensor was created from (a list, a scalar or raw bytes)
+  data = buff._buf
+  if isinstance(data, (bytes, bytearray, memoryview)): return memoryview(bytearray(data))
+  data = data if isinstance(data, (list, tuple)) else [data]
+  return memoryview(bytearray(struct.pack(f'{len(data)}{buff.dtype.fmt}', *data)))
+
+def estimate_flops(ast: MLIR) -> int:
+  # Every alu node runs once per iteration of the kernel loops, MULACC counts as two and a reduce adds its accumulate
+  seen, ops, stack = set(), 0, [ast.inputs[0]]
+  while stack:
+    if (node := stack.pop()) in seen: continue
+    seen.add(node)
+    if node.op not in BufferOps: ops += 2 if node.op is TernaryOps.MULACC else 1
+    stack.extend(node.inputs)
+  return ops * launch_dims(ast)[1]
+
+def _shapes(ast: MLIR) -> Tuple[Tuple[int, ...], ...]:
+  # the stored shape then every distinct loaded shape
+  shapes, stack, seen = [ast.arg.st.shape], [ast], set()
+  while stack:
+    if (node := stack.pop()) in seen: continue
+    seen.add(node)
+    if node.op is BufferOps.LOAD and node.arg.st.shape not in shapes: shapes.append(node.arg.st.shape)
+    stack.extend(node.inputs)
+  return tuple(shapes)
+
+@dataclass(frozen=True)
+class ExecItem:
+  # A kernel ready to launch, bufs are its inputs followed by its outputs
+  prg: Callable
+  bufs: Tuple[Buffer, ...]
+  name: str = ''
+  shapes: Tuple[Tuple[int, ...], ...] = ()
+  flops: int = 0
+  def run(self, bufs: Optional[Tuple[Buffer, ...]]=None):
+    bufs = self.bufs if bufs is None else bufs
+    if not PROFILER.enabled: return self.prg(*bufs)
+    start = time.perf_counter_ns()
+    self.prg(*bufs)
+    PROFILER.record(self.name, bufs[-1].device.name, self.shapes, sum(b.nbytes for b in bufs), self.flops, start, time.perf_counter_ns() - start)
+
+# Every ExecItem run while a list is pushed here is recorded into it, see ShrimpJit
+CAPTURING: List[List[ExecItem]] = []
+
+def _copy(src: Buffer, dst: Buffer): dst.copyin(_host_data(src))
+def _launcher(runtime, name: str, args: Tuple[int, ...], global_size: int, work: int) -> Callable:
+  return lambda *bufs: runtime.exec(name, *[b._buf for b in bufs], *args, global_size=global_size, work=work)
+
+def lower_kernel(sk: ScheduledKernel) -> ExecItem:
+  if sk.ast.op is LoadOps.COPY: return ExecItem(_copy, (*sk.inputs, *sk.outputs), f'copy_{sk.outputs[0].nbytes}', ((sk.outputs[0].size,),))
+  device, name = sk.outputs[0].device, kernel_name(sk.ast)
+  if (call := device.library_kernel(sk.ast)) is not None:
+    return ExecItem(lambda *bufs: call(*[b._buf for b in bufs]), (*sk.inputs, *sk.outputs), name, _shapes(sk.ast), estimate_flops(sk.ast))
+  prg = device.program()
+  # a kernel that takes its sizes as arguments is compiled once for every batch size
+  symbol, args = prg.create_kernel(name, sk.ast)
+  lib = device.compiler().compile(prg)
+  return ExecItem(_launcher(device.runtime(lib), symbol, args, *launch_dims(sk.ast)), (*sk.inputs, *sk.outputs), name, _shapes(sk.ast), estimate_flops(sk.ast))
+
+# Kernels of a schedule are lowered on this many threads at once, each compile is its own clang process
+COMPILE_THREADS = int(os.getenv('SHRIMP_COMPILE_THREADS', str(os.cpu_count() or 1)))
+_compile_pool: Optional[ThreadPoolExecutor] = None
+
+def lower_schedule(schedule: List[ScheduledKernel]) -> Iterator[ExecItem]:
+  # Every kernel is handed to the pool up front and yielded in schedule order as soon as its program is built, so
+  # the first kernels run while the rest still compile. Execution keeps the topological order of the schedule,
+  # the memory plan reuses arena memory in that order.
+  global _compile_pool
+  kernels = [sk for sk in schedule if sk.ast.op is not LoadOps.EMPTY]
+  if COMPILE_THREADS <= 1 or len(kernels) <= 1:
+    yield from map(lower_kernel, kernels)
+    return
+  if _compile_pool is None: _compile_pool = ThreadPoolExecutor(max_workers=COMPILE_THREADS, thread_name_prefix='shrimp_compile')
+  futures = [_compile_pool.submit(lower_kernel, sk) for sk in kernels]
+  try:
+    for fut in futures: yield fut.result()
+  finally:
+    for fut in futures: fut.cancel()
+
+def run_schedule(schedule: List[ScheduledKernel], plan: Optional[MemoryPlan]=None):
+  arenas = [a.device.allocator().alloc(a.size) for a in plan.arenas] if plan is not None else []
+  for b, idx in (plan.assignments.items() if plan is not None else ()): b.allocate(with_data=memoryview(arenas[idx])[:b.nbytes])
+  for sk in schedule:
+    for out in sk.outputs:
+      if not out.allocated: out.allocate()
+  for ei in lower_schedule(schedule):
+    ei.run()
+    if CAPTURING: CAPTURING[-1].append(ei)
+  if plan is None: return
+  # Intermediates go back to being unrealized, a later read recomputes them from their operands
+  for b in plan.assignments: b.deallocate()
+  for a, mem in zip(plan.arenas, arenas): a.device.allocator().free(mem, a.size)
+
+def realize(*thunks: Thunk):
+  schedule = Scheduler(list(thunks)).schedule()
+  # captured kernels are replayed later, so their intermediates have to keep their memory
+  if CAPTURING: return run_schedule(schedule)
+  plan = plan_memory(schedule, [t.base.buff for t in thunks])
+  if os.getenv('SHRIMP_DEBUG_MEMORY'): print(plan.report())
+  run_schedule(schedule, plan)
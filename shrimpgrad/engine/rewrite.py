@@ -0,0 +1,74 @@
+from __future__ import annotations
+from collections import defaultdict
+from typing import Any, Callable, DefaultDict, Dict, List, Optional, Tuple, Union
+from shrimpgrad.engine.schedule import MLIR
+from shrimpgrad.runtime.ops import BufferOps, Op
+from shrimpgrad.util import toposort
+
+class Pat:
+  """A pattern over MLIR nodes.
+  op is an op or a tuple of ops (None matches any), src the patterns of the inputs (None matches any inputs),
+  name binds the matched node for the rule, arg is either a value node.arg must equal or a predicate on it.
+  Commutative patterns also try their two sources swapped.
+  """
+  def __init__(self, op: Union[None, Op, Tuple[Op, ...]]=None, src: Optional[Tuple[Pat, ...]]=None, name: Optional[str]=None, arg: Any=None, commutative: bool=False):
+    self.ops = op if op is None or isinstance(op, tuple) else (op,)
+    self.src, self.name, self.arg, self.commutative = src, name, arg, commutative
+
+  def match(self, node: MLIR, store: Dict[str, MLIR]) -> bool:
+    if self.ops is not None and node.op not in self.ops: return False
+    if self.arg is not None and not (self.arg(node.arg) if callable(self.arg) else node.arg == self.arg): return False
+    # a name bound twice has to be the same node
+    if self.name is not None and store.setdefault(self.name, node) is not node: return False
+    if self.src is None: return True
+    if len(self.src) != len(node.inputs): return False
+    for src in ([self.src, self.src[::-1]] if self.commutative else [self.src]):
+      attempt = dict(store)
+      if all(p.match(x, attempt) for p, x in zip(src, node.inputs)):
+        store.update(attempt)
+        return True
+    return False
+
+# A rule rewrites the nodes bound by its pattern into a new node, or returns None to leave it alone
+Rule = Tuple[Pat, Callable[..., Optional[MLIR]]]
+
+class PatternMatcher:
+  def __init__(self, rules: List[Rule]):
+    self.rules: DefaultDict[Optional[Op], List[Rule]] = defaultdict(list)
+    for pat, fxn in rules: self.add(pat, fxn)
+
+  def add(self, pat: Pat, fxn: Callable[..., Optional[MLIR]]):
+    # rules are indexed by the op they match at the root, so a node only tries the rules that can apply
+    for op in (pat.ops if pat.ops is not None else (None,)): self.rules[op].append((pat, fxn))
+
+  def rewrite(self, node: MLIR) -> Optional[MLIR]:
+    for pat, fxn in self.rules[node.op] + self.rules[None]:
+      store: Dict[str, MLIR] = {}
+      if pat.match(node, store) and (ret := fxn(**store)) is not None: return ret
+    return None
+
+def _key(node: MLIR) -> Any:
+  # Leaves are keyed by what they describe (index or value, shapetracker and dtype)
+  if node.op in {BufferOps.LOAD, BufferOps.CONST}: return (node.op, node.arg)
+  return (node.op, tuple(id(x) for x in node.inputs), node.arg)
+
+def graph_rewrite(ast: MLIR, pm: PatternMatcher) -> MLIR:
+  """Rewrites ast bottom up until no rule applies.
+  Structurally identical nodes are shared (hash consing) and every node is rewritten once, memoized by identity.
+  """
+  canon: Dict[Any, MLIR] = {}
+  done: Dict[MLIR, MLIR] = {}
+  def visit(root: MLIR) -> MLIR:
+    # inputs before their users with an explicit stack, only the nodes a rule returns are visited by recursing
+    for node in toposort(root, lambda x: () if x in done else x.inputs):
+      if node in done: continue
+      inputs = tuple(done[x] for x in node.inputs)
+      rebuilt = node if inputs == node.inputs else MLIR(node.op, inputs, node.arg)
+      new = canon.setdefault(_key(rebuilt), rebuilt)
+      if new not in done:
+        # provisional, a rule that rebuilds an identical node ends here instead of looping
+        done[new] = new
+        if (ret := pm.rewrite(new)) is not None: done[new] = visit(ret)
+      done[node] = done[new]
+    return done[root]
+  return visit(ast)
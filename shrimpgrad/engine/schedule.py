@@ -3,10 +3,11 @@ from collections import defaultdict
 from dataclasses import dataclass
 from typing import Any, DefaultDict, Dict, List, Set, Tuple
 from shrimpgrad.device import Buffer
-from shrimpgrad.dtype import DType
+from shrimpgrad.dtype import ConstType, DType
 from shrimpgrad.future import Thunk
-from shrimpgrad.runtime.ops import BufferOps, LoadOps, Op
-from shrimpgrad.view import View
+from shrimpgrad.runtime.ops import BufferOps, LoadOps, Op, ReduceOps
+from shrimpgrad.shapetracker import ShapeTracker
+from shrimpgrad.util import toposort
 
 @dataclass(frozen=True, eq=False)
 class MLIR:
@@ -18,7 +19,21 @@ class MLIR:
 @dataclass(frozen=True)
 class MLIRBuffer:
   index: int
-  view: View
+  st: ShapeTracker
+  dtype: DType
+
+@dataclass(frozen=True)
+class MLIRGather:
+  # buffer index read through st with the loop index of dim replaced by the value of the GATHER node's input
+  index: int
+  st: ShapeTracker
+  dtype: DType
+  dim: int
+
+@dataclass(frozen=True)
+class MLIRConst:
+  val: ConstType
+  st: ShapeTracker
   dtype: DType
 
 class BuffsManager:
@@ -28,7 +43,7 @@ class BuffsManager:
   def get_mlir_buff(self, thunk: Thunk):
     if thunk.base.buff in self.buffs:
       return self.buffs[thunk.base.buff]
-    buff = MLIRBuffer(index=self.idx, view=thunk._view, dtype=thunk.dtype)
+    buff = MLIRBuffer(index=self.idx, st=thunk.st, dtype=thunk.dtype)
     self.buffs[thunk.base.buff] = buff
     self.idx+=1
     return buff
@@ -45,9 +60,9 @@ def lower(root: Thunk) -> MLIR:
     if not root in visited:
       visited.add(root)
       if root.base != root:
-        v = root._view
+        v = root.st
         root = root.base
-        root._view = v
+        root.st = v
       if root._op in LoadOps:
         arg = root.arg if root._op == LoadOps.CONST else buffs_mgr.get_mlir_buff(root)
         return MLIR(op=root._op, arg=arg)
@@ -86,10 +101,10 @@ class Scheduler:
     
     schedule_targets = {out:ps for ps in prescheduled.values() for out in ps.outputs}
 
-    graph: DefaultDict[Thunk, List[Thunk]] = defaultdict(list)
-    in_degree: DefaultDict[Thunk, int] = defaultdict(int)
-    for target, sched_kernel in prescheduled.items(): 
-      if target not in in_degree: in_degree[target] = 0
+    graph: DefaultDict[PrescheduledKernel, List[PrescheduledKernel]] = defaultdict(list)
+    in_degree: DefaultDict[PrescheduledKernel, int] = defaultdict(int)
+    for sched_kernel in prescheduled.values(): 
+      if sched_kernel not in in_degree: in_degree[sched_kernel] = 0
       
       # If any of the targets operands (parents) are also targets
       # we need to schedule them first in the DAG
@@ -97,18 +112,18 @@ class Scheduler:
 
       # Update the graph such that parent kernels point to children kernels
       for parent in scheduled_parents:
-        graph[parent].append(target)
-        in_degree[target] += 1
+        graph[parent].append(sched_kernel)
+        in_degree[sched_kernel] += 1
     
     from collections import deque
 
-    frontier = deque(pk for target, pk in prescheduled.items() if in_degree[target] == 0)
+    frontier = deque(pk for pk in prescheduled.values() if in_degree[pk] == 0)
 
     schedule = []
     while frontier:
       pk = frontier.popleft()
       schedule.append(ScheduledKernel(ast=pk.ast, inputs=tuple(x.buff for x in pk.inputs), outputs=tuple(x.buff for x in pk.outputs)))
-      for x in graph[pk.outputs[0]]:
+      for x in graph[pk]:
         in_degree[x] -= 1
         if in_degree[x] == 0:
           frontier.append(x)
@@ -122,31 +137,70 @@ class Scheduler:
     # recurse on the output to find other targets (loads, view bases)
     self._search(out.base)
   
-  def _search(self, thunk: Thunk):
-    if thunk in self.visited or thunk.base.realized is not None: return
-    # view: realize my base
-    if thunk != thunk.base: 
-      # base is a target, realize pads, and expands
-      self.targets[thunk.base] = None
-      return self._search(thunk.base)
-    # base
-    self.visited.add(thunk)
-    if thunk._op in LoadOps: self.targets[thunk] = None
-    if thunk._op is LoadOps.COPY:
-      # Realize my operands (usually empty load) base
-      self.targets[thunk._operands[0].base] = None
-    for operand in thunk._operands:
-      # recurese on my operands to find their targets 
-      self._search(operand)
+  def _search(self, root: Thunk):
+    # depth first with an explicit stack, a thunk's operands are searched in order before its siblings
+    stack = [root]
+    while stack:
+      thunk = stack.pop()
+      if thunk in self.visited or thunk.base.realized is not None: continue
+      # view: realize my base
+      if thunk != thunk.base: 
+        # base is a target, realize pads, and expands
+        self.targets[thunk.base] = None
+        stack.append(thunk.base)
+        continue
+      # base
+      self.visited.add(thunk)
+      if thunk._op in LoadOps: self.targets[thunk] = None
+      if thunk._op is LoadOps.COPY:
+        # Realize my operands (usually empty load) base
+        self.targets[thunk._operands[0].base] = None
+      # Reductions are their own kernel, their elementwise operand is fused into the accumulator
+      if thunk._op in ReduceOps: self.targets[thunk] = None
+      # a gather reads its source from a buffer, only the index is fused
+      if thunk._op is BufferOps.GATHER: self.targets[thunk._operands[0].base] = None
+      # search my operands to find their targets
+      stack.extend(reversed(thunk._operands))
     
-  def _preschedule(self, out):
-    inputs: List[Thunk] = [] 
-    ast: List[MLIR]
-    if (out._op in {LoadOps.COPY, LoadOps.EMPTY, LoadOps.CUSTOM}): 
-      inputs = [x.base for x in out._operands]
-      ast = MLIR(out._op, (), out.arg)
-
-    return PrescheduledKernel(ast, tuple(inputs), tuple([out]))
+  def _preschedule(self, out: Thunk) -> PrescheduledKernel:
+    if out._op in {LoadOps.COPY, LoadOps.EMPTY, LoadOps.CUSTOM}: 
+      return PrescheduledKernel(MLIR(out._op, (), out.arg), tuple(x.base for x in out._operands), (out,))
+    # Fuse out and its unrealized elementwise ancestors into a single kernel,
+    # every other target or realized thunk it touches becomes a buffer load
+    from shrimpgrad.engine.simplify import simplify
+    inputs: Dict[Thunk, int] = {}
+    ast = simplify(self._fuse(out, inputs))
+    store = MLIR(BufferOps.STORE, (ast,), MLIRBuffer(len(inputs), ShapeTracker.from_shape(out.shape), out.dtype))
+    return PrescheduledKernel(store, tuple(inputs), (out,))
+
+  def _fuse(self, out: Thunk, inputs: Dict[Thunk, int]) -> MLIR:
+    # Built bottom up over the thunks in topological order, so chains of any length never recurse
+    def leaf(thunk: Thunk) -> bool:
+      base = thunk.base
+      return base._op is LoadOps.CONST or (base is not out and (base.realized is not None or base in self.targets))
+    built: Dict[Thunk, MLIR] = {}
+    cache: Dict[Any, MLIR] = {}
+    def srcs(t: Thunk) -> Tuple[Thunk, ...]: return () if leaf(t) else t.base._operands[1:] if t.base._op is BufferOps.GATHER else t.base._operands
+    for thunk in toposort(out, srcs):
+      base = thunk.base
+      if base._op is LoadOps.CONST:
+        built[thunk] = MLIR(BufferOps.CONST, (), MLIRConst(base.arg, thunk.st, thunk.dtype))
+      elif leaf(thunk):
+        # Each buffer is an argument to the kernel once, and each view of it is loaded once
+        key = (base, thunk.st)
+        if key not in cache:
+          if base not in inputs: inputs[base] = len(inputs)
+          cache[key] = MLIR(BufferOps.LOAD, (), MLIRBuffer(inputs[base], thunk.st, thunk.dtype))
+        built[thunk] = cache[key]
+      elif base._op is BufferOps.GATHER:
+        src = base._operands[0]
+        if src.base not in inputs: inputs[src.base] = len(inputs)
+        if base not in cache: cache[base] = MLIR(BufferOps.GATHER, (built[base._operands[1]],), MLIRGather(inputs[src.base], src.st, src.dtype, base.arg))
+        built[thunk] = cache[base]
+      else:
+        if base not in cache: cache[base] = MLIR(base._op, tuple(built[x] for x in base._operands), base.arg)
+        built[thunk] = cache[base]
+    return built[out]
         
 def _tree(mlir: MLIR, prefix="") -> str:
   if not len(mlir.inputs): return [f"━━ {prefix}{mlir.op.name} {mlir.arg if mlir.arg is not None else ''}"]
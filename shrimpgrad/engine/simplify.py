@@ -0,0 +1,52 @@
+from __future__ import annotations
+import math
+from typing import Optional
+import numpy as np
+from shrimpgrad.dtype import dtypes
+from shrimpgrad.engine.rewrite import Pat, PatternMatcher, graph_rewrite
+from shrimpgrad.engine.schedule import MLIR, MLIRConst
+from shrimpgrad.runtime.numpy import from_np_dtype, numpy_alu, to_np_dtype
+from shrimpgrad.runtime.ops import BinaryOps, BufferOps, TernaryOps, UnaryOps
+
+# A padded constant is 0 outside its mask, it is never an identity or folded
+def _const(val=None, name: str='c') -> Pat: return Pat(BufferOps.CONST, name=name, arg=lambda arg: not arg.st.masked and (val is None or arg.val == val))
+def _not_const(name: str='x') -> Pat: return Pat(name=name, arg=lambda arg: not isinstance(arg, MLIRConst))
+def _with_val(c: MLIR, val) -> MLIR: return MLIR(BufferOps.CONST, (), MLIRConst(val, c.arg.st, c.arg.dtype))
+
+alu_ops = tuple(op for op in (*UnaryOps, *BinaryOps, *TernaryOps))
+
+def _fold(node: MLIR) -> Optional[MLIR]:
+  # An expression of constants is evaluated with the same numpy ops the backends agree with
+  if not node.inputs or not all(x.op is BufferOps.CONST and not x.arg.st.masked for x in node.inputs): return None
+  vals = [np.array(x.arg.val, dtype=to_np_dtype(x.arg.dtype)) for x in node.inputs]
+  with np.errstate(all='ignore'):
+    ret = vals[0].astype(to_np_dtype(node.arg)) if node.op is UnaryOps.CAST else np.asarray(numpy_alu[node.op](*vals))
+  return MLIR(BufferOps.CONST, (), MLIRConst(ret.item(), node.inputs[0].arg.st, node.arg if node.op is UnaryOps.CAST else from_np_dtype(ret.dtype)))
+
+# Rules that never change a result
+symbolic = [
+  (Pat(alu_ops, name='node'), _fold),
+  (Pat(BinaryOps.ADD, (_not_const(), _const(0)), commutative=True), lambda x, c: x),
+  (Pat(BinaryOps.SUB, (_not_const(), _const(0))), lambda x, c: x),
+  (Pat(BinaryOps.MUL, (_not_const(), _const(1)), commutative=True), lambda x, c: x),
+  (Pat(BinaryOps.DIV, (_not_const(), _const(1))), lambda x, c: x),
+  (Pat(UnaryOps.NEG, (Pat(UnaryOps.NEG, (Pat(name='x'),)),)), lambda x: x),
+]
+
+# Rules that pick cheaper ops for the backends
+lowering = [
+  # x/c is x*(1/c) for floats, a multiply is cheaper than a divide
+  (Pat(BinaryOps.DIV, (_not_const(), _const())), lambda x, c: MLIR(BinaryOps.MUL, (x, _with_val(c, 1.0/c.arg.val)))
+    if c.arg.dtype == dtypes.float32 and c.arg.val != 0 and math.isfinite(c.arg.val) else None),
+  # Tensor.exp is exp2(x*log2(e)), one exp call does it without the multiply
+  (Pat(UnaryOps.EXP2, (Pat(BinaryOps.MUL, (Pat(name='x'), _const()), commutative=True),)),
+    lambda x, c: MLIR(UnaryOps.EXP, (x,)) if math.isclose(c.arg.val, 1/math.log(2), rel_tol=1e-6) else
+                 MLIR(UnaryOps.EXP, (MLIR(UnaryOps.NEG, (x,)),)) if math.isclose(c.arg.val, -1/math.log(2), rel_tol=1e-6) else None),
+  (Pat(BinaryOps.ADD, (Pat(BinaryOps.MUL, (Pat(name='a'), Pat(name='b'))), Pat(name='c')), commutative=True), lambda a, b, c: MLIR(TernaryOps.MULACC, (a, b, c))),
+]
+
+simplifier = PatternMatcher(symbolic + lowering)
+
+def simplify(ast: MLIR) -> MLIR:
+  """Shares identical nodes, folds constants, drops algebraic identities and lowers to cheaper ops."""
+  return graph_rewrite(ast, simplifier)
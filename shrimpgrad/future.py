@@ -2,12 +2,12 @@ from __future__ import annotations
 from typing import List, Optional, Tuple, Union
 from shrimpgrad.device import CPU, Device, Buffer
 from shrimpgrad.dtype import ConstType, DType 
-from shrimpgrad.runtime.ops import BinaryOps, LoadOps, Op, ReduceOps, TernaryOps, UnaryOps
-from shrimpgrad.view import View
+from shrimpgrad.runtime.ops import BinaryOps, BufferOps, LoadOps, Op, ReduceOps, TernaryOps, UnaryOps
+from shrimpgrad.shapetracker import ShapeTracker
 
 # Thunk
-#   - shapetracker
-#      - list of views (each view has shape, strides, contiguous(are the strides swapped?), offset?, mask (for padding)?)
+#   - shapetracker (st)
+#      - a stack of views (each view has shape, strides, offset and a mask for padding)
 #      - the shapetracker consolidates all the movement ops on a thunk
 #      - some thunks will have an st with multiple views (ex. permute(1,0).reshape((..)) b/c the permute makes the view non-contiguous
 #        just reshaping after will lose the effect the permute had on the tensor
@@ -21,9 +21,9 @@ class Thunk:
   syntax tree where root thunks have allocated buffers (inputs usually from tensor factory methods)
   and child thunks are described by operations and their parent operands.
   """
-  def __init__(self, device: Device, dtype: DType, view: View, operands: Tuple[Thunk, ...], op: Optional[Op]=None, data: Union[ConstType, List, bytes, memoryview]=None, base: Optional[Thunk]=None, arg=None):
+  def __init__(self, device: Device, dtype: DType, st: ShapeTracker, operands: Tuple[Thunk, ...], op: Optional[Op]=None, data: Union[ConstType, List, bytes, memoryview]=None, base: Optional[Thunk]=None, arg=None):
     # initial buffer conditions
-    self._view, self.device, self.dtype, self.arg = view, device, dtype, arg
+    self.st, self.device, self.dtype, self.arg = st, device, dtype, arg
     self._op, self._operands = op, operands 
     
     # Am I the base thunk? Does the buffer reside with me or another thunk? Am I a view of the base thunk after a movement op? (same questions)
@@ -31,49 +31,66 @@ class Thunk:
     self._base = None
     if base is None:
       # I'm the base I own the real buffer 
-      self.buff = Buffer(self.device, self._view.numel, self.dtype)
+      self.buff = Buffer(self.device, self.st.numel, self.dtype)
     else:
       assert base.base == base, "base must be the base"
       self._base = base
 
   @property
-  def shape(self): return self._view.shape
+  def shape(self): return self.st.shape
   @property
-  def numel(self): return self._view.numel
+  def numel(self): return self.st.numel
   @property
-  def scalar(self): return self._view.scalar
+  def scalar(self): return self.st.scalar
   @property
-  def ndim(self): return self._view.ndim
+  def ndim(self): return self.st.ndim
   @property
   def base(self): return self._base if self._base is not None else self
   @property
   def realized(self) -> Optional[Buffer]: return self.buff if hasattr(self, 'buff') and self.buff.allocated else None
   
   @staticmethod
-  def from_compute(op: Union[BinaryOps, UnaryOps, TernaryOps, ReduceOps], operands: Tuple[Thunk,...], view: View, device: Device, dtype: DType):
+  def from_compute(op: Union[BinaryOps, UnaryOps, TernaryOps, ReduceOps], operands: Tuple[Thunk,...], st: ShapeTracker, device: Device, dtype: DType):
     if op in BinaryOps: assert len(operands) > 1, f'binary ops require two operands, {len(operands)} given' 
     if op in UnaryOps: assert len(operands) > 0, f'unary ops require one operands, {len(operands)} given'
     if op in TernaryOps: assert len(operands) > 2, f'ternary ops require three operands, {len(operands)} given' 
-    return Thunk(device, dtype, View.from_view(view), tuple(operands), op)
+    return Thunk(device, dtype, ShapeTracker.from_shape(st.shape), tuple(operands), op)
 
   def alu(self, op: Union[UnaryOps, BinaryOps, TernaryOps], *in_thunks: Tuple[Thunk,...]) -> Thunk:
-    return Thunk.from_compute(op, (self, *in_thunks), self._view, self.device, self.dtype)
+    # where selects between its value operands, the condition is only a mask
+    dtype = in_thunks[0].dtype if op is TernaryOps.WHERE else self.dtype
+    return Thunk.from_compute(op, (self, *in_thunks), self.st, self.device, dtype)
 
   def reduce(self, op: ReduceOps, axis: Tuple[int,...]) -> Thunk: 
-    new_shape = tuple([1 if i in axis else s for i,s in enumerate(self._view.shape)])
-    return Thunk(self.device, self.dtype, View(new_shape), (self,), op, arg=axis)
+    new_shape = tuple([1 if i in axis else s for i,s in enumerate(self.st.shape)])
+    return Thunk(self.device, self.dtype, ShapeTracker.from_shape(new_shape), (self,), op, arg=axis)
 
   def reshape(self, shape: Tuple[int,...]):
-    return Thunk(self.device, self.dtype, self._view.reshape(shape), (), base=self.base)
+    return Thunk(self.device, self.dtype, self.st.reshape(shape), (), base=self.base)
 
   def permute(self, order:Tuple[int,...]) -> Thunk:
-    return Thunk(self.device, self.dtype, self._view.permute(order), (), base=self.base)
+    return Thunk(self.device, self.dtype, self.st.permute(order), (), base=self.base)
 
   def expand(self, shape: Tuple[int,...]) -> Thunk:
-    return Thunk(self.device, self.dtype, self._view.expand(shape), (), base=self.base)
+    return Thunk(self.device, self.dtype, self.st.expand(shape), (), base=self.base)
+
+  def shrink(self, arg: Tuple[Tuple[int,int],...]) -> Thunk:
+    return Thunk(self.device, self.dtype, self.st.shrink(arg), (), base=self.base)
+
+  def pad(self, arg: Tuple[Tuple[int,int],...]) -> Thunk:
+    return Thunk(self.device, self.dtype, self.st.pad(arg), (), base=self.base)
+
+  def stride(self, mul: Tuple[int,...]) -> Thunk:
+    return Thunk(self.device, self.dtype, self.st.stride(mul), (), base=self.base)
+
+  def gather(self, idx: Thunk, dim: int) -> Thunk:
+    # out[i] is self[i] with i[dim] replaced by idx[i], idx has the shape of the result and self the same shape but along dim
+    # a constant has no buffer to read from, a cast of it is stored into one
+    src = self.cast(self.dtype) if self.base._op is LoadOps.CONST else self
+    return Thunk(self.device, self.dtype, ShapeTracker.from_shape(idx.shape), (src, idx), BufferOps.GATHER, arg=dim)
 
   def cast(self, dtype: DType) -> Thunk:
-    return Thunk(self.device, dtype, self._view, (self,))
+    return Thunk(self.device, dtype, ShapeTracker.from_shape(self.shape), (self,), UnaryOps.CAST, arg=dtype)
 
   @staticmethod 
   def load_from_cpu(data, dtype, shape):
@@ -83,14 +100,32 @@ class Thunk:
     del thunk._operands
     return thunk
   
+  @staticmethod
+  def load_from_buffer(data: memoryview, dtype, shape, device: Device):
+    # The device buffer wraps data directly, there is nothing left to schedule
+    thunk = Thunk.loadop(LoadOps.EMPTY, shape, dtype, device)
+    thunk.buff.allocate(with_data=data)
+    del thunk._operands
+    return thunk
+
+  @staticmethod
+  def load_from_file(path: str, dtype, shape, device: Device, offset: int=0, writable: bool=False):
+    # The device buffer is a mapping of the file, nothing is read until a kernel touches the pages
+    thunk = Thunk.loadop(LoadOps.EMPTY, shape, dtype, device)
+    thunk.buff.map(path, offset, writable)
+    del thunk._operands
+    return thunk
+
   @staticmethod
   def loadop(op: LoadOps, shape, dtype, device, arg=None, srcs=()):
-    return Thunk(device, dtype, View(shape), srcs, op=op, arg=arg)
+    return Thunk(device, dtype, ShapeTracker.from_shape(shape), srcs, op=op, arg=arg)
   
   def copy_to_device(self, device: Device) -> Thunk:
     # Generaly self is a LoadOps.EMPTY with device as CPU
     # It may have been reshaped etc so ensure we copy from the base
-    return Thunk(device, self.dtype, self._view, (self.base, ), LoadOps.COPY, arg=self.base.buff.nbytes)
+    # The whole base buffer is copied, a view of it becomes the same view of the copy
+    copy = Thunk(device, self.dtype, self.base.st, (self.base, ), LoadOps.COPY, arg=self.base.buff.nbytes)
+    return copy if self.base is self else Thunk(device, self.dtype, self.st, (), base=copy)
 
   def const(self, val: ConstType, shape: Tuple[int,...]=None):
     shape = self.shape if shape is None else shape
@@ -0,0 +1,70 @@
+from __future__ import annotations
+import ctypes
+import ctypes.util
+import functools
+import os
+from typing import Callable, Optional
+from shrimpgrad.runtime.clang import gemm_dims, kernel_dims
+from shrimpgrad.runtime.ops import BufferOps
+from shrimpgrad.engine.schedule import MLIR
+
+CblasRowMajor, CblasNoTrans, CblasTrans = 101, 111, 112
+
+@functools.lru_cache(maxsize=None)
+def load_blas() -> Optional[ctypes.CDLL]:
+  # SHRIMP_BLAS is the path of a CBLAS library or 0 to never use one, by default the first one on the system is
+  name = os.getenv('SHRIMP_BLAS', '')
+  if name == '0': return None
+  for path in ([name] if name else [ctypes.util.find_library(lib) for lib in ('openblas', 'cblas', 'blas', 'mkl_rt')]):
+    if not path: continue
+    try: lib = ctypes.CDLL(path)
+    except OSError: continue
+    if not (hasattr(lib, 'cblas_sgemm') and hasattr(lib, 'cblas_sgemv')): continue
+    i, f, p = ctypes.c_int, ctypes.c_float, ctypes.c_void_p
+    lib.cblas_sgemm.argtypes, lib.cblas_sgemm.restype = [i, i, i, i, i, i, f, p, i, p, i, f, p, i], None
+    lib.cblas_sgemv.argtypes, lib.cblas_sgemv.restype = [i, i, i, i, f, p, i, p, i, f, p, i], None
+    return lib
+  return None
+
+def _layout(outer: int, inner: int, st_outer: int, st_inner: int):
+  # (transpose, leading dim) of an outer x inner matrix with these strides, None if BLAS can't address it
+  if st_inner == 1 and st_outer >= max(inner, 1): return CblasNoTrans, st_outer
+  if st_outer == 1 and st_inner >= max(outer, 1): return CblasTrans, st_inner
+  return None
+
+def blas_kernel(lib: ctypes.CDLL, ast: MLIR) -> Optional[Callable]:
+  """A kernel that is exactly a matmul (or matrix-vector product) of two strided buffers, returned as a call of
+  cblas_sgemm (sgemv) on the buffers in place, one per batch. Anything else is None and runs as a generated kernel."""
+  root = ast.inputs[0]
+  if (dims := gemm_dims(ast, vector=True)) is None or not all(x.op is BufferOps.LOAD for x in root.inputs[0].inputs): return None
+  k, m, n, b, swap = dims
+  shape, _, st_out, strides = kernel_dims(ast)
+  x, y = root.inputs[0].inputs[::-1] if swap else root.inputs[0].inputs
+  sx, sy = strides[x], strides[y]
+  if any(st < 0 for st in (*sx, *sy)): return None
+  K, batch = shape[k], shape[b] if b is not None else 1
+  bx, by, bo = (sx[b], sy[b], st_out[b]) if b is not None else (0, 0, 0)
+  ix, iy, isz = x.arg.index, y.arg.index, x.arg.dtype.bytes
+  def ptrs(bufs, i: int):
+    return [ctypes.addressof(bufs[ix]) + (x.arg.st.view.offset + i*bx)*isz, ctypes.addressof(bufs[iy]) + (y.arg.st.view.offset + i*by)*isz,
+            ctypes.addressof(bufs[-1]) + i*bo*isz]
+  if m is not None and n is not None:
+    M, N = shape[m], shape[n]
+    if (a := _layout(M, K, sx[m], sx[k])) is None or (bl := _layout(K, N, sy[k], sy[n])) is None or st_out[n] != 1 or st_out[m] < N: return None
+    def gemm(*bufs):
+      for i in range(batch):
+        pa, pb, pc = ptrs(bufs, i)
+        lib.cblas_sgemm(CblasRowMajor, a[0], bl[0], M, N, K, 1.0, pa, a[1], pb, bl[1], 0.0, pc, st_out[m])
+    return gemm
+  # the matrix is the operand that moves along the output dim, the other one is the vector
+  out, (mat, smat, svec) = (m, (0, sx, sy[k])) if m is not None else (n, (1, sy, sx[k]))
+  R = shape[out]
+  if (a := _layout(R, K, smat[out], smat[k])) is None: return None
+  # a transposed R x K matrix is a K x R row major one
+  rows, cols = (R, K) if a[0] == CblasNoTrans else (K, R)
+  def gemv(*bufs):
+    for i in range(batch):
+      pa, pb, pc = ptrs(bufs, i)
+      pm, pv = (pa, pb) if mat == 0 else (pb, pa)
+      lib.cblas_sgemv(CblasRowMajor, a[0], rows, cols, 1.0, pm, a[1], pv, svec, 0.0, pc, st_out[out])
+  return gemv
@@ -1,15 +1,23 @@
 from __future__ import annotations
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import ctypes
+import functools
+import hashlib
+import math
+import os
+import re
 import subprocess
-from typing import List, Tuple
-from shrimpgrad.dtype import DType, dtypes
-import tempfile
-from shrimpgrad.runtime.ops import Op, UnaryOps, BinaryOps, TernaryOps 
-from shrimpgrad.runtime.profiler import Profile
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+from shrimpgrad.dtype import ConstType, DType, dtypes
+from shrimpgrad.runtime.ops import BufferOps, Op, ReduceOps, UnaryOps, BinaryOps, TernaryOps 
+from shrimpgrad.util import prod, toposort
+if TYPE_CHECKING: from shrimpgrad.engine.schedule import MLIR
 
 c_alu = {
   UnaryOps.LOG2: lambda x: f'log2({x})',
-  UnaryOps.EXP2: lambda x: f'exp2({x})',
+  UnaryOps.EXP2: lambda x: f'exp2({x})', UnaryOps.EXP: lambda x: f'exp({x})',
   UnaryOps.SQRT: lambda x: f'sqrt({x})', UnaryOps.SIN: lambda x: f'sin({x})',
   UnaryOps.NEG: lambda x: f'-{x}',
   BinaryOps.MUL: lambda x,y: f'{x}*{y}', BinaryOps.ADD: lambda x,y: f'{x}+{y}', BinaryOps.SUB: lambda x,y: f'{x}-{y}', BinaryOps.XOR: lambda x,y: f'{x}^{y}',
@@ -17,7 +25,10 @@ c_alu = {
   BinaryOps.CMPEQ: lambda x,y: f'{x}=={y}', BinaryOps.CMPLT: lambda x,y: f'{x}<{y}',
   BinaryOps.MOD: lambda x,y: f'{x}%{y}',
   BinaryOps.DIV: lambda x,y: f'{x}/{y}',
-  TernaryOps.WHERE: lambda x,y,z: f'{x} ? {y} : {z}'}
+  TernaryOps.WHERE: lambda x,y,z: f'{x} ? {y} : {z}', TernaryOps.MULACC: lambda x,y,z: f'{x}*{y}+{z}'}
+
+reduce_alu = {ReduceOps.SUM: BinaryOps.ADD, ReduceOps.MAX: BinaryOps.MAX}
+reduce_init = {ReduceOps.SUM: 0.0, ReduceOps.MAX: -math.inf}
 
 class ClangProgram:
   def __init__(self):  self.func = {}
@@ -29,47 +40,344 @@ class ClangProgram:
     ctype = self._dtype_to_c(dtype) if op not in [BinaryOps.XOR, BinaryOps.MOD] else 'int*'
     if op in BinaryOps: self.func[op] = {'args':{'in0':ctype, 'in1':ctype, 'out0': ctype}, 'name':op.name.lower()+'shrimp', 'shape':shape, 'strides':strides}
     if op in UnaryOps: self.func[op] = {'args':{'in0':ctype, 'out0':ctype}, 'name':op.name.lower()+'shrimp', 'shape':shape, 'strides':strides}
+  def create_generic_op(self, op: Op, dtype: DType) -> None:
+    # shape and strides are passed at runtime (see generic_args) so one function serves every shape of dtype
+    ctype = self._dtype_to_c(dtype) if op not in [BinaryOps.XOR, BinaryOps.MOD] else 'int*'
+    if op in BinaryOps: self.func[op] = {'args':{'in0':ctype, 'in1':ctype, 'out0': ctype}, 'name':op.name.lower()+'shrimp', 'generic':True}
+    if op in UnaryOps: self.func[op] = {'args':{'in0':ctype, 'out0':ctype}, 'name':op.name.lower()+'shrimp', 'generic':True}
+  def create_kernel(self, name: str, ast: MLIR) -> Tuple[str, Tuple[int, ...]]:
+    # ast is a scheduled kernel, STORE(...) of a fused elementwise expression or of a reduce over one.
+    # Returns the symbol to launch and its size arguments, a kernel generic over its sizes (see generic_dims)
+    # is named without them so every batch size renders the same source
+    args = ()
+    if (dims := generic_dims(ast)) is not None:
+      name, args = ('r_' if ast.inputs[0].op in ReduceOps else 'E_') + '_'.join(str(s) for s in dims[0] or (1,)), tuple(dims[-1].values())
+    self.func[name] = {'name':name, 'ast':ast}
+    return name, args
   def autogen(self, shape: Tuple[int,...], strides:List[int], dtype: DType):
     for op in c_alu.keys():
       self.create_op(op, shape, strides, dtype)
+  def autogen_generic(self, dtype: DType):
+    for op in c_alu.keys():
+      self.create_generic_op(op, dtype)
+
+def generic_args(shape: Tuple[int,...], *strides: Tuple[int,...]) -> Tuple[ctypes._SimpleCData, ...]:
+  # trailing arguments of a generic function: ndim, shape and the strides of every in/out buffer (in argument order)
+  def arr(x): return (ctypes.c_int * max(len(x), 1))(*x)
+  return (ctypes.c_int(len(shape)), arr(shape), *[arr(strd) for strd in strides])
+
+generic_helpers = '''static inline int shrimp_numel(int ndim, const int* shape) { int n = 1; for(int d = 0; d < ndim; d++) n *= shape[d]; return n; }
+static inline bool shrimp_contiguous(int ndim, const int* shape, const int* strides) {
+  int expect = 1;
+  for(int d = ndim-1; d >= 0; d--) { if(shape[d] != 1 && strides[d] != expect) return false; expect *= shape[d]; }
+  return true;
+}
+'''
+
+def collapse_dims(shape: Tuple[int,...], strides: List[Tuple[int,...]], axis: Tuple[int,...]=()) -> Tuple[Tuple[int,...], List[Tuple[int,...]], Tuple[int,...]]:
+  # Drop size 1 dims and merge neighbours that every view walks as one (the outer stride spans the inner dim).
+  # Reduced and kept dims are never merged with each other.
+  dims = [d for d in range(len(shape)) if shape[d] != 1]
+  groups: List[List[int]] = []
+  for d in dims:
+    if groups and (groups[-1][-1] in axis) == (d in axis) and all(st[groups[-1][-1]] == st[d]*shape[d] for st in strides): groups[-1].append(d)
+    else: groups.append([d])
+  new_shape = tuple(prod(shape[d] for d in g) for g in groups)
+  return new_shape, [tuple(st[g[-1]] for g in groups) for st in strides], tuple(i for i, g in enumerate(groups) if g[0] in axis)
+
+def _walk(node: MLIR) -> List[MLIR]:
+  # every node under node once, depth first and left to right, with an explicit stack so deep kernels don't recurse
+  seen, order, stack = set(), [], [node]
+  while stack:
+    if (x := stack.pop()) in seen: continue
+    seen.add(x)
+    order.append(x)
+    stack.extend(reversed(x.inputs))
+  return order
+def _loads(node: MLIR) -> List[MLIR]: return [x for x in _walk(node) if x.op is BufferOps.LOAD]
+def _leaf_st(node: MLIR):
+  while node.inputs: node = node.inputs[0]
+  return node.arg.st
+def _gathers(node: MLIR) -> bool: return any(x.op is BufferOps.GATHER for x in _walk(node))
+def _masked_consts(node: MLIR) -> bool: return any(x.op is BufferOps.CONST and x.arg.st.masked for x in _walk(node))
+
+class CExpr:
+  # A C int expression, View.expr builds buffer indices and masks out of loop variables with it
+  def __init__(self, s: str): self.s = s
+  def __add__(self, x): return self if isinstance(x, int) and x == 0 else CExpr(f'({self.s}+{_cstr(x)})')
+  def __radd__(self, x): return self + x
+  def __mul__(self, x): return self if isinstance(x, int) and x == 1 else CExpr(f'{self.s}*{_cstr(x)}')
+  def __floordiv__(self, x): return self if isinstance(x, int) and x == 1 else CExpr(f'({self.s}/{_cstr(x)})')
+  def __mod__(self, x): return CExpr(f'({self.s}%{_cstr(x)})')
+  def __ge__(self, x): return CExpr(f'({self.s}>={_cstr(x)})')
+  def __lt__(self, x): return CExpr(f'({self.s}<{_cstr(x)})')
+  def __and__(self, x): return CExpr(f'({self.s}&&{_cstr(x)})')
+  def __rand__(self, x): return self & x
+def _cstr(x) -> str: return x.s if isinstance(x, CExpr) else str(int(x))
+
+def kernel_dims(ast: MLIR) -> Tuple[Tuple[int,...], Tuple[int,...], Tuple[int,...], Dict[MLIR, Optional[Tuple[int,...]]]]:
+  # A reduce kernel loops over the shape of its (fused) input and accumulates over axis
+  store, root = ast.arg, ast.inputs[0]
+  reduce = root.op in ReduceOps
+  shape = _leaf_st(root).shape if reduce else store.st.shape
+  axis = root.arg if reduce else ()
+  # The store never moves along a reduced axis
+  lds = _loads(root)
+  st_out = tuple(0 if d in axis else strd for d, strd in enumerate(store.st.strides))
+  # Loads through a stack of views or a mask are indexed per loop variable (strides None), the loops can't be merged under them
+  # and neither can they under a gather, which replaces the loop variable of its dim
+  if not all(ld.arg.st.simple for ld in lds) or _masked_consts(root) or _gathers(root): return shape, axis, st_out, {ld: ld.arg.st.strides if ld.arg.st.simple else None for ld in lds}
+  shape, (st_out, *st_lds), axis = collapse_dims(shape, [st_out, *[ld.arg.st.strides for ld in lds]], axis)
+  return shape, axis, st_out, dict(zip(lds, st_lds))
+
+# Register tile (rows x cols) and cache blocks (depth x cols) of the matmul kernel
+GEMM_MR, GEMM_NR, GEMM_KC, GEMM_NC = 6, 16, 256, 128
+
+def gemm_dims(ast: MLIR, vector: bool=False) -> Optional[Tuple[int, Optional[int], Optional[int], Optional[int], bool]]:
+  # (k, m, n, batch, swap) loops of a kernel that sums x*y over k where x never moves along n and y never along m,
+  # which is every dot, matmul and linear and the gradients of them. swap says x and y trade places as the
+  # tile is stored along n, which should be the contiguous dim of the output.
+  # With vector a missing m or n (a matrix-vector product) is None.
+  root = ast.inputs[0]
+  if root.op is not ReduceOps.SUM or root.inputs[0].op is not BinaryOps.MUL or ast.arg.dtype != dtypes.float32 or _masked_consts(root) or _gathers(root): return None
+  shape, axis, st_out, strides = kernel_dims(ast)
+  if len(axis) != 1 or any(st is None or ld.arg.dtype != dtypes.float32 for ld, st in strides.items()): return None
+  def moves(node: MLIR) -> Set[int]: return {d for ld in _loads(node) for d, st in enumerate(strides[ld]) if st != 0}
+  (mx, my), k = [moves(x) for x in root.inputs[0].inputs], axis[0]
+  kept = [d for d in range(len(shape)) if d != k]
+  m, n, b = [d for d in kept if d not in my], [d for d in kept if d not in mx], [d for d in kept if d in mx and d in my]
+  if k not in mx or k not in my or len(m) > 1 or len(n) > 1 or len(b) > 1 or any(d not in mx for d in m) or any(d not in my for d in n): return None
+  if not (m and n if not vector else m or n): return None
+  m, n, b = m[0] if m else None, n[0] if n else None, b[0] if b else None
+  if m is not None and n is not None and st_out[m] == 1 and st_out[n] != 1: return k, n, m, b, True
+  return k, m, n, b, False
+
+def generic_dims(ast: MLIR) -> Optional[Tuple[Tuple[Union[int, str],...], Tuple[int,...], Tuple[Union[int, str],...], Dict[MLIR, Tuple[Union[int, str],...]], Dict[MLIR, Union[int, str]], Dict[str, int]]]:
+  # kernel_dims with the sizes that change with the batch (loop bounds, strides other than 0 and 1, load offsets)
+  # replaced by named int arguments of the kernel, plus the load offsets and the value of every argument.
+  # Loads and constants indexed through their views, gathers and matmuls keep their sizes in the source.
+  root = ast.inputs[0]
+  if _masked_consts(root) or _gathers(root) or gemm_dims(ast) is not None: return None
+  shape, axis, st_out, strides = kernel_dims(ast)
+  if any(st is None for st in strides.values()): return None
+  params: Dict[str, int] = {}
+  def param(name: str, v: int) -> Union[int, str]:
+    if v in (0, 1): return v
+    params[name] = v
+    return name
+  shape, st_out = tuple(param(f'n{d}', s) for d, s in enumerate(shape)), tuple(param(f'so{d}', s) for d, s in enumerate(st_out))
+  offsets = {ld: param(f'o{j}', ld.arg.st.view.offset) for j, ld in enumerate(strides)}
+  strides = {ld: tuple(param(f's{j}_{d}', s) for d, s in enumerate(st)) for j, (ld, st) in enumerate(strides.items())}
+  return shape, axis, st_out, strides, offsets, params
+
+def launch_dims(ast: MLIR) -> Tuple[int, int]:
+  # (iterations of the outermost loop, total loop iterations) of a fused kernel
+  shape, axis, _, _ = kernel_dims(ast)
+  # a matmul splits its row panels across threads
+  if (dims := gemm_dims(ast)) is not None: return (shape[dims[3]] if dims[3] is not None else 1) * -(-shape[dims[1]]//GEMM_MR), prod(shape)
+  outer = [d for d in range(len(shape)) if d not in axis]
+  return (shape[outer[0]] if outer else 1), prod(shape)
 
 class ClangCodeGenerator:
-  def __init__(self, prg: ClangProgram): self.prg, self._preamble, self._src = prg, '#include<stdio.h>\n#include<math.h>\n', ''
+  def __init__(self, prg: ClangProgram): self.prg, self._preamble, self._src = prg, '#include<stdio.h>\n#include<stdbool.h>\n#include<math.h>\n', ''
   def render(self):
+    if any('generic' in opts for opts in self.prg.func.values()): self._preamble += generic_helpers
     for op, opts in self.prg.func.items():
-      self._src += self._function(opts['name'], opts['args'], self._loops(opts['shape'], self._op(op, opts['args'].keys(), opts['shape'], opts['strides']))) + '\n'
+      if 'ast' in opts: self._src += self._kernel(opts['name'], opts['ast']) + '\n'
+      elif 'generic' in opts: self._src += self._generic_function(op, opts['name'], opts['args']) + '\n'
+      else:
+        shape, (strides,), _ = collapse_dims(opts['shape'], [tuple(opts['strides'])])
+        self._src += self._function(opts['name'], opts['args'], self._loops(shape, self._op(op, opts['args'].keys(), shape, strides))) + '\n'
     return self._preamble + self._src
   # Code Generation (Private)
   def _loop(self,v, s, e, step, body): return f'for(int {v} = {s}; {v} < {e}; {v}+={step}) {{{body}}}'
-  def _loops(self, shape: Tuple[int,...], body: str) -> str: 
-    def build(shp, depth=0):
-      if not shp: return body
-      return self._loop(f'i{depth}', 0, shp[0], 1, build(shp[1:], depth+1))
-    return build(shape)
+  def _loops(self, shape: Tuple[int,...], body: str, dims: Optional[List[int]]=None, ranged=False) -> str: 
+    def build(dims, ranged):
+      if not dims: return body
+      return self._loop(f'i{dims[0]}', 'start' if ranged else 0, 'end' if ranged else shape[dims[0]], 1, build(dims[1:], False))
+    return build(list(range(len(shape))) if dims is None else dims, ranged)
   def _loop_vars(self, num_loops): return [f'i{num}' for num in range(num_loops)]
   def _op(self, op: Op, args, shape, strides):
-    offset = '+'.join([self._offset(i, strd, 1) for i, strd in zip(self._loop_vars(len(shape)), strides)])
+    offset = self._index(range(len(shape)), strides)
     if op in BinaryOps: c_code = c_alu[op](*self._many_ptrinc(list(args)[0:2], offset))
     if op in UnaryOps: c_code = c_alu[op](self._ptrinc(list(args)[0], offset))
     if op in TernaryOps: c_code = c_alu[op](*self._many_ptrinc(list(args)[0:3], offset))
     return f'out0[{offset}]={c_code};'
+  def _generic_function(self, op: Op, name: str, args: dict) -> str:
+    bufs = list(args.keys())
+    strides = {buf:f'strides_{buf}' for buf in bufs}
+    sig = {**args, 'ndim':'int', 'shape':'const int*', **{strd:'const int*' for strd in strides.values()}}
+    # Fast path: every buffer is contiguous so a single flat index addresses all of them
+    contiguous = ' && '.join(f'shrimp_contiguous(ndim, shape, {strd})' for strd in strides.values())
+    fast = f'if({contiguous}) {{{self._loop("i", 0, "numel", 1, self._generic_op(op, bufs, {buf:"i" for buf in bufs}))} return;}}'
+    offsets = {buf:f'off_{buf}' for buf in bufs}
+    unravel = f'int rem = i, {", ".join(f"{off} = 0" for off in offsets.values())};' + \
+      f'for(int d = ndim-1; d >= 0; d--) {{int id = rem % shape[d]; rem /= shape[d];{"".join(f"{offsets[buf]} += id*{strides[buf]}[d];" for buf in bufs)}}}'
+    body = f'int numel = shrimp_numel(ndim, shape);{fast}' + self._loop('i', 0, 'numel', 1, unravel + self._generic_op(op, bufs, offsets))
+    return self._function(name, sig, body)
+  def _generic_op(self, op: Op, bufs: List[str], offsets: dict) -> str:
+    return f'{self._ptrinc(bufs[-1], offsets[bufs[-1]])}={c_alu[op](*[self._ptrinc(buf, offsets[buf]) for buf in bufs[:-1]])};'
+  def _kernel(self, name: str, ast: MLIR) -> str:
+    store, root = ast.arg, ast.inputs[0]
+    reduce = root.op in ReduceOps
+    if (dims := gemm_dims(ast)) is not None: return self._gemm(name, ast, *dims)
+    shape, axis, st_out, strides, offsets, params = generic_dims(ast) or (*kernel_dims(ast), {}, {})
+    outer = [d for d in range(len(shape)) if d not in axis]
+    body, names, loads = [], {}, {}
+    val, _ = self._expr(root.inputs[0] if reduce else root, len(shape), strides, body, names, loads, offsets)
+    # sizes follow the buffers, start and end bound the outermost loop so the runtime can split a kernel across threads
+    args = {**{f'in{i}':self.prg._dtype_to_c(dtype) for i, dtype in sorted(loads.items())}, 'out0':self.prg._dtype_to_c(store.dtype),
+            **{p:'int' for p in params}, 'start':'int', 'end':'int'}
+    out = f'out0[{self._index(outer, st_out)}]'
+    if not reduce: return self._function(name, args, self._loops(shape, ''.join(body) + f'{out}={val};', outer, ranged=True))
+    body.append(f'acc0 = {c_alu[reduce_alu[root.op]]("acc0", val)};')
+    acc = f'{self.prg._dtype_to_c(store.dtype, ptr=False)} acc0 = {self._const(reduce_init[root.op], store.dtype)};'
+    return self._function(name, args, self._loops(shape, acc + self._loops(shape, ''.join(body), list(axis)) + f'{out}=acc0;', outer, ranged=True))
+  def _expr(self, node: MLIR, ndim: int, strides: Dict[MLIR, Optional[Tuple[int,...]]], body: List[str], names: Dict[MLIR, Tuple[str, DType]], loads: Dict[int, DType], offsets: Optional[Dict[MLIR, Union[int, str]]]=None) -> Tuple[str, DType]:
+    # Appends a statement per node to body (each node once) and returns the variable holding node's value
+    # at loop indices i0..i{ndim-1}, the buffers it reads are added to loads. Constants are inlined, not statements.
+    for x in toposort(node, lambda x: () if x in names else x.inputs):
+      if x in names: continue
+      if x.op is BufferOps.CONST:
+        const = self._const(x.arg.val, x.arg.dtype)
+        names[x] = (self._gather(x.arg.st, lambda _, c=const: c, x.arg.dtype, ndim) if x.arg.st.masked else const), x.arg.dtype
+        continue
+      srcs = [names[s] for s in x.inputs]
+      if x.op is BufferOps.LOAD:
+        loads[x.arg.index] = x.arg.dtype
+        if strides[x] is not None: code = self._ptrinc(f'in{x.arg.index}', self._index(range(ndim), strides[x], (offsets or {}).get(x, x.arg.st.view.offset)))
+        else: code = self._gather(x.arg.st, lambda idx, buf=f'in{x.arg.index}': self._ptrinc(buf, idx), x.arg.dtype, ndim)
+        dtype, var = x.arg.dtype, 'val'
+      elif x.op is BufferOps.GATHER:
+        loads[x.arg.index] = x.arg.dtype
+        # an index outside the source dim reads 0 like padding
+        i, s = CExpr(f'((int){srcs[0][0]})'), x.arg.st.shape[x.arg.dim]
+        code = self._gather(x.arg.st, lambda idx, buf=f'in{x.arg.index}': self._ptrinc(buf, idx), x.arg.dtype, ndim, {x.arg.dim: i}, (i >= 0) & (i < s))
+        dtype, var = x.arg.dtype, 'val'
+      elif x.op is UnaryOps.CAST: code, dtype, var = f'({self.prg._dtype_to_c(x.arg, ptr=False)})({srcs[0][0]})', x.arg, 'cast'
+      else:
+        # where takes its dtype from the selected values, everything else from its first operand
+        code, dtype, var = c_alu[x.op](*[src for src, _ in srcs]), srcs[1 if x.op is TernaryOps.WHERE else 0][1], 'alu'
+      names[x] = (f'{var}{len(body)}', dtype)
+      body.append(f'{self.prg._dtype_to_c(dtype, ptr=False)} {names[x][0]} = {code};')
+    return names[node]
+  def _gemm(self, name: str, ast: MLIR, k: int, m: int, n: int, b: Optional[int], swap: bool) -> str:
+    # out[b,m,n] = sum_k x[b,m,k]*y[b,k,n] with x and y any fused expressions of their loads.
+    # Blocks of y (GEMM_KC x GEMM_NC) and panels of x (GEMM_MR x GEMM_KC) are evaluated once into packed
+    # contiguous buffers, zero filled to whole tiles, and a GEMM_MR x GEMM_NR tile of out is accumulated
+    # in registers from them. start and end bound the row panels (of every batch) like any outer loop.
+    shape, _, st_out, strides = kernel_dims(ast)
+    x, y = ast.inputs[0].inputs[0].inputs[::-1] if swap else ast.inputs[0].inputs[0].inputs
+    loads: Dict[int, DType] = {}
+    def pack(node: MLIR) -> Tuple[str, str]:
+      body: List[str] = []
+      val, _ = self._expr(node, len(shape), strides, body, {}, loads)
+      return ''.join(body), val
+    (xb, xv), (yb, yv) = pack(x), pack(y)
+    M, N, K, MR, NR, KC, NC = shape[m], shape[n], shape[k], GEMM_MR, GEMM_NR, GEMM_KC, GEMM_NC
+    MP = -(-M//MR)
+    out = f'out0[{self._index(range(len(shape)), st_out)}]'
+    batch = f'int i{b} = p/{MP};' if b is not None else ''
+    pack_y = (f'if(i{b} != packed) {{packed = i{b};' if b is not None else 'if(packed < 0) {packed = 0;') + \
+      f'for(int kk = 0; kk < kc; kk++) {{int i{k} = k0+kk; for(int j = 0; j < {NC}; j++) {{' \
+      f'if(j < nc) {{int i{n} = n0+j; {yb} bp[kk*{NC}+j] = {yv};}} else bp[kk*{NC}+j] = 0.0f;}}}}}}'
+    pack_x = f'for(int i = 0; i < {MR}; i++) {{for(int kk = 0; kk < kc; kk++) {{' \
+      f'if(i < mr) {{int i{m} = m0+i, i{k} = k0+kk; {xb} ap[i*{KC}+kk] = {xv};}} else ap[i*{KC}+kk] = 0.0f;}}}}'
+    tile = f'float acc[{MR}][{NR}]; for(int i = 0; i < {MR}; i++) for(int j = 0; j < {NR}; j++) acc[i][j] = 0.0f;' \
+      f'for(int kk = 0; kk < kc; kk++) {{const float* bk = bp + kk*{NC} + j0; for(int i = 0; i < {MR}; i++) {{' \
+      f'float av = ap[i*{KC}+kk]; for(int j = 0; j < {NR}; j++) acc[i][j] += av*bk[j];}}}}' \
+      f'for(int i = 0; i < mr; i++) for(int j = 0; j < {NR} && j0+j < nc; j++) {{int i{m} = m0+i, i{n} = n0+j0+j; {out} = k0 ? {out}+acc[i][j] : acc[i][j];}}'
+    body = f'float bp[{KC*NC}], ap[{MR*KC}];' \
+      f'for(int n0 = 0; n0 < {N}; n0 += {NC}) {{int nc = {N}-n0 < {NC} ? {N}-n0 : {NC};' \
+      f'for(int k0 = 0; k0 < {K}; k0 += {KC}) {{int kc = {K}-k0 < {KC} ? {K}-k0 : {KC}, packed = -1;' \
+      f'for(int p = start; p < end; p++) {{{batch} int m0 = (p%{MP})*{MR}, mr = {M}-m0 < {MR} ? {M}-m0 : {MR};' \
+      f'{pack_y}{pack_x}for(int j0 = 0; j0 < nc; j0 += {NR}) {{{tile}}}}}}}}}'
+    args = {**{f'in{i}':self.prg._dtype_to_c(dtype) for i, dtype in sorted(loads.items())}, 'out0':self.prg._dtype_to_c(ast.arg.dtype), 'start':'int', 'end':'int'}
+    return self._function(name, args, body)
+  def _index(self, dims: Iterable[int], strides: Tuple[int,...], offset: int=0) -> str:
+    return '+'.join([self._offset(f'i{d}', strides[d], 1) for d in dims if strides[d] != 0] + ([str(offset)] if offset else [])) or '0'
+  def _gather(self, st, read: Callable[[str], str], dtype: DType, ndim: int, idxs: Optional[Dict[int, CExpr]]=None, cond: Optional[CExpr]=None) -> str:
+    # read renders the element at a buffer index through every view of st, padding reads as 0.
+    # idxs replaces the loop variable of a dim, cond is an extra validity
+    idx, valid = st.expr([(idxs or {}).get(d, CExpr(f'i{d}')) for d in range(ndim)])
+    if cond is not None and valid is not False: valid = cond if valid is None or valid is True else valid & cond
+    val = read(_cstr(idx))
+    if valid is None or valid is True: return val
+    return self._const(0, dtype) if valid is False else f'({_cstr(valid)} ? {val} : {self._const(0, dtype)})'
+  def _const(self, val: ConstType, dtype: DType) -> str:
+    if dtype == dtypes.bool: return '1' if val else '0'
+    if dtype == dtypes.int32: return f'({int(val)})'
+    if math.isnan(val): return 'NAN'
+    if math.isinf(val): return 'INFINITY' if val > 0 else '(-INFINITY)'
+    return f'({float(val)}f)'
   def _ptrinc(self, arg, offset): return f'{arg}[{offset}]' # ptr[offset]
   def _many_ptrinc(self, args, offset): return [self._ptrinc(arg, offset) for arg in args]
-  def _offset(self, off:str, strd:int, step:int) -> str: return f'{off}*{strd}*{step}'
+  def _offset(self, off:str, strd:int, step:int) -> str: return off if strd*step == 1 else f'{off}*{strd*step}'
   def _function(self, name:str, args: dict, body:str) -> str: return f'void {name} ({self._unpack_args(args)}) {{ { body} }}'
   def _unpack_args(self, args: dict):  return ','.join([f'{typ} {name} ' for name, typ in args.items()])
 
+CLANG_FLAGS = ['-include', 'tgmath.h', '-shared', '-march=native', '-O2', '-Wall', '-Werror', '-x', 'c', '-fPIC']
+
+@functools.lru_cache(maxsize=None)
+def clang_version() -> str: return subprocess.run(['clang', '--version'], check=True, capture_output=True).stdout.decode('utf-8')
+
+@functools.lru_cache(maxsize=None)
+def host_target() -> str:
+  # the cpu and features -march=native resolves to here, a library built for them may not load on another machine
+  out = subprocess.run(['clang', '-march=native', '-###', '-x', 'c', '-c', '-', '-o', os.devnull], check=True, capture_output=True, stdin=subprocess.DEVNULL).stderr
+  return ' '.join(re.findall(r'"-target-(?:cpu|feature)" "([^"]*)"', out.decode('utf-8')))
+
 class ClangCompiler:
+  # Compiled libraries are content addressed by source, flags, compiler version and host cpu.
+  # Loaded handles live in an in-process LRU, the shared objects in a directory that survives restarts.
+  cache_dir = os.getenv('SHRIMP_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'shrimpgrad', 'clang'))
+  cache_size = 256
+  _libs: OrderedDict[str, ctypes.CDLL] = OrderedDict()
+  # kernels compile on several threads at once (see lower_schedule), one lock per source so each is built once
+  _lock, _building = threading.Lock(), {}
+  def key(self, src: str) -> str: return hashlib.sha256('\0'.join([src, *CLANG_FLAGS, clang_version(), host_target()]).encode('utf-8')).hexdigest()
+  def _cached(self, key: str) -> Optional[ctypes.CDLL]:
+    with self._lock:
+      if key not in self._libs: return None
+      self._libs.move_to_end(key)
+      return self._libs[key]
   def compile(self, prg: ClangProgram):
+    src = ClangCodeGenerator(prg).render()
+    key = self.key(src)
+    if (lib := self._cached(key)) is not None: return lib
+    with self._lock: building = self._building.setdefault(key, threading.Lock())
     try:
-      with tempfile.TemporaryFile() as outfile:
-        subprocess.run(['clang', '-include', 'tgmath.h', '-shared', '-march=native', '-O2', '-Wall', '-Werror', '-x', 'c', '-fPIC', '-',
-                        '-o', str(outfile.name)], check=True, input=ClangCodeGenerator(prg).render().encode('utf-8'))
-        return ctypes.CDLL('./'+str(outfile.name))
-    except subprocess.CalledProcessError as e:
-      print(f"clang failure: {e}") 
-
-class ClangRuntime(metaclass=Profile):
-  def __init__(self, lib): self.lib = lib
-  def exec(self, op: Op, *args): return getattr(self.lib, op.name.lower() + 'shrimp')(*args)
+      with building:
+        if (lib := self._cached(key)) is not None: return lib
+        path = os.path.join(self.cache_dir, f'{key}.so')
+        if not os.path.exists(path):
+          os.makedirs(self.cache_dir, exist_ok=True)
+          # Compile next to the final path and rename so concurrent compiles never load a partial file,
+          # a failed compile raises and leaves nothing behind
+          tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+          try:
+            subprocess.run(['clang', *CLANG_FLAGS, '-', '-o', tmp], check=True, input=src.encode('utf-8'))
+            os.replace(tmp, path)
+          finally:
+            if os.path.exists(tmp): os.remove(tmp)
+        lib = ctypes.CDLL(path)
+        with self._lock:
+          self._libs[key] = lib
+          if len(self._libs) > self.cache_size: self._libs.popitem(last=False)
+        return lib
+    finally:
+      # the per source lock goes away with the compile that made it, whether it built the library or raised
+      with self._lock: self._building.pop(key, None)
 
+class ClangRuntime:
+  _pools: Dict[int, ThreadPoolExecutor] = {}
+  def __init__(self, lib, threads: int=1, parallel_threshold: int=0): self.lib, self.threads, self.parallel_threshold = lib, threads, parallel_threshold
+  def exec(self, op: Union[Op, str], *args, global_size: Optional[int]=None, work: int=0):
+    fxn = getattr(self.lib, op if isinstance(op, str) else op.name.lower() + 'shrimp')
+    if global_size is None: return fxn(*args)
+    # Split the outermost loop into one chunk per thread, ctypes drops the GIL for the duration of each call
+    threads = min(self.threads, global_size) if work >= self.parallel_threshold else 1
+    if threads <= 1: return fxn(*args, 0, global_size)
+    if threads not in self._pools: self._pools[threads] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='shrimp')
+    bounds = [global_size*i//threads for i in range(threads+1)]
+    for fut in [self._pools[threads].submit(fxn, *args, start, end) for start, end in zip(bounds, bounds[1:])]: fut.result()
@@ -0,0 +1,89 @@
+from __future__ import annotations
+import types
+from typing import TYPE_CHECKING, Callable, Dict, Optional, Tuple
+import numpy as np
+from shrimpgrad.dtype import DType, dtypes
+from shrimpgrad.runtime.ops import BinaryOps, BufferOps, ReduceOps, TernaryOps, UnaryOps
+from shrimpgrad.util import toposort
+if TYPE_CHECKING:
+  from shrimpgrad.engine.schedule import MLIR, MLIRConst, MLIRGather
+  from shrimpgrad.shapetracker import ShapeTracker
+
+def to_np_dtype(dtype: DType) -> np.dtype: return np.dtype(dtype.fmt)
+def from_np_dtype(dtype: np.dtype) -> DType:
+  if dtype == np.bool_: return dtypes.bool
+  return dtypes.int32 if np.issubdtype(dtype, np.integer) else dtypes.float32
+
+numpy_alu = {
+  UnaryOps.LOG2: np.log2, UnaryOps.EXP2: np.exp2, UnaryOps.EXP: np.exp, UnaryOps.SQRT: np.sqrt, UnaryOps.SIN: np.sin,
+  UnaryOps.NEG: lambda x: np.logical_not(x) if x.dtype == np.bool_ else np.negative(x),
+  BinaryOps.MUL: np.multiply, BinaryOps.ADD: np.add, BinaryOps.SUB: np.subtract, BinaryOps.XOR: np.bitwise_xor,
+  BinaryOps.MAX: np.maximum, BinaryOps.CMPEQ: np.equal, BinaryOps.CMPLT: np.less,
+  BinaryOps.MOD: np.fmod,
+  BinaryOps.DIV: lambda x,y: np.trunc(np.true_divide(x, y)).astype(x.dtype) if np.issubdtype(x.dtype, np.integer) else np.true_divide(x, y),
+  TernaryOps.WHERE: np.where, TernaryOps.MULACC: lambda x,y,z: x*y+z,
+  ReduceOps.SUM: lambda x, axis: np.sum(x, axis=axis, keepdims=True), ReduceOps.MAX: lambda x, axis: np.max(x, axis=axis, keepdims=True)}
+
+def _index(st: ShapeTracker) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+  # buffer index and validity of every element of st
+  idx, valid = st.expr(list(np.indices(st.shape, dtype=np.int64)))
+  return np.broadcast_to(idx, st.shape), None if valid is None else np.broadcast_to(valid, st.shape)
+
+def view_array(buf, st: ShapeTracker, dtype: DType) -> np.ndarray:
+  arr = np.frombuffer(buf, dtype=to_np_dtype(dtype))
+  # A single view without a mask is a strided view of the buffer, nothing is copied
+  if st.simple: return np.lib.stride_tricks.as_strided(arr[st.view.offset:], shape=st.shape, strides=tuple(s*arr.itemsize for s in st.view.strides))
+  # anything else is gathered, padding reads as 0
+  idx, valid = _index(st)
+  if valid is None: return arr[idx]
+  return np.where(valid, arr[np.clip(idx, 0, max(arr.size-1, 0))], 0).astype(arr.dtype)
+
+def _take(buf, g: MLIRGather, idx: np.ndarray) -> np.ndarray:
+  # the elements of buf at the indices of st with dim replaced by idx, an index outside the dim reads 0 like padding
+  arr, idx = np.frombuffer(buf, dtype=to_np_dtype(g.dtype)), idx.astype(np.int64)
+  idxs = list(np.indices(idx.shape, dtype=np.int64))
+  idxs[g.dim] = idx
+  bidx, valid = g.st.expr(idxs)
+  inside = (idx >= 0) & (idx < g.st.shape[g.dim])
+  valid = inside if valid is None else inside & valid
+  return np.where(valid, arr[np.clip(np.broadcast_to(bidx, idx.shape), 0, max(arr.size-1, 0))], 0).astype(arr.dtype)
+
+def _const(c: MLIRConst) -> np.ndarray:
+  ret = np.broadcast_to(np.array(c.val, dtype=to_np_dtype(c.dtype)), c.st.shape)
+  if not c.st.masked: return ret
+  _, valid = _index(c.st)
+  return np.where(valid, ret, 0).astype(ret.dtype)
+
+class NumpyProgram:
+  def __init__(self): self.func = {}
+  def create_kernel(self, name: str, ast: MLIR) -> Tuple[str, Tuple[int, ...]]:
+    # ast is a scheduled kernel, STORE(...) of a fused elementwise expression or of a reduce over one
+    self.func[name] = {'name':name, 'ast':ast}
+    return name, ()
+
+class NumpyCompiler:
+  def compile(self, prg: NumpyProgram): return types.SimpleNamespace(**{name:self._lower(opts['ast']) for name, opts in prg.func.items()})
+  def _lower(self, ast: MLIR) -> Callable:
+    store = ast.arg
+    def kernel(*bufs):
+      # Plain loads are strided views of the buffers, nothing is copied until the ufuncs produce their result
+      cache: Dict[MLIR, np.ndarray] = {}
+      def evaluate(root: MLIR) -> np.ndarray:
+        # operands before their users, an explicit stack instead of recursing on deep kernels
+        for node in toposort(root, lambda x: x.inputs):
+          if node.op is BufferOps.LOAD: ret = view_array(bufs[node.arg.index], node.arg.st, node.arg.dtype)
+          elif node.op is BufferOps.CONST: ret = _const(node.arg)
+          elif node.op is BufferOps.GATHER: ret = _take(bufs[node.arg.index], node.arg, np.asarray(cache[node.inputs[0]]))
+          elif node.op is UnaryOps.CAST: ret = cache[node.inputs[0]].astype(to_np_dtype(node.arg))
+          elif node.op in ReduceOps: ret = numpy_alu[node.op](cache[node.inputs[0]], node.arg)
+          else: ret = numpy_alu[node.op](*[cache[x] for x in node.inputs])
+          cache[node] = ret
+        return cache[root]
+      with np.errstate(all='ignore'):
+        view_array(bufs[-1], store.st, store.dtype)[...] = evaluate(ast.inputs[0])
+    return kernel
+
+class NumpyRuntime:
+  def __init__(self, lib): self.lib = lib
+  # global_size and work are launch hints for threaded backends, numpy runs the whole kernel at once
+  def exec(self, name: str, *args, global_size=None, work=0): return getattr(self.lib, name)(*args)
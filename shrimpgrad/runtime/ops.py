@@ -2,11 +2,11 @@
 from enum import Enum, auto
 from typing import Type, Union
 
-class UnaryOps(Enum): EXP2 = auto(); LOG2 = auto(); CAST = auto(); SIN = auto(); SQRT = auto(); NEG = auto() 
+class UnaryOps(Enum): EXP2 = auto(); LOG2 = auto(); CAST = auto(); SIN = auto(); SQRT = auto(); NEG = auto(); EXP = auto() 
 class BinaryOps(Enum): ADD = auto(); SUB = auto(); MUL = auto(); DIV = auto(); MAX = auto(); MOD = auto(); CMPLT = auto(); CMPEQ = auto(); XOR = auto() 
 class TernaryOps(Enum): WHERE = auto(); MULACC = auto() 
 class ReduceOps(Enum): SUM = auto(); MAX = auto() 
-class BufferOps(Enum): LOAD = auto(); CONST = auto(); STORE = auto() 
+class BufferOps(Enum): LOAD = auto(); CONST = auto(); STORE = auto(); GATHER = auto() 
 class LoadOps(Enum): EMPTY = auto(); CONST = auto(); COPY = auto(); CONTIGUOUS = auto(); CUSTOM = auto(); ASSIGN = auto() 
 
 Op = Union[UnaryOps, BinaryOps, ReduceOps, LoadOps, TernaryOps, BufferOps]
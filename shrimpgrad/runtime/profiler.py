@@ -1,17 +1,65 @@
-import time
-import types 
-
-def timefunc(fn, *args, **kwargs):
-  def fncomposite(*args, **kwargs):
-    s = time.monotonic()
-    rt = fn(*args, **kwargs)
-    e = time.monotonic() - s
-    print(f'runtime {fn.__name__} {args[1]} {len(args[2]) if len(args) > 2 else None}={e*1000}ms')
-    return rt
-  return fncomposite
-
-class Profile(type):
-  def __new__(cls, name, bases, attr):
-    for name, value in attr.items():
-      if type(value) is types.FunctionType or type(value) is types.MethodType: attr[name] = timefunc(value)
-    return super(Profile, cls).__new__(cls, name, bases, attr)
\ No newline at end of file
+from __future__ import annotations
+import collections
+import json
+import os
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple
+
+@dataclass(frozen=True)
+class KernelEvent:
+  name: str
+  device: str
+  shapes: Tuple[Tuple[int, ...], ...]
+  nbytes: int # bytes read and written by the kernel
+  flops: int # estimated from the kernel ast
+  start: int # perf_counter_ns at launch
+  duration: int # ns
+  tid: int
+
+class Profiler:
+  """Opt-in kernel profiler.
+  Launches are recorded into a ring buffer of the last capacity events only while enabled, either with
+  SHRIMP_PROFILE=1, enable() or `with PROFILER:`. Disabled, a launch costs a single attribute check.
+  """
+  def __init__(self, capacity: int=65536, enabled: bool=False):
+    self.enabled = enabled
+    self.events: collections.deque[KernelEvent] = collections.deque(maxlen=capacity)
+    self._stack: List[bool] = []
+
+  def enable(self): self.enabled = True
+  def disable(self): self.enabled = False
+  def clear(self): self.events.clear()
+  def __enter__(self):
+    self._stack.append(self.enabled)
+    self.enabled = True
+    return self
+  def __exit__(self, *exc): self.enabled = self._stack.pop()
+
+  def record(self, name: str, device: str, shapes: Tuple[Tuple[int, ...], ...], nbytes: int, flops: int, start: int, duration: int):
+    # deque appends are atomic, kernels launched from several threads need no lock
+    self.events.append(KernelEvent(name, device, shapes, nbytes, flops, start, duration, threading.get_ident()))
+
+  def summary(self) -> str:
+    stats: Dict[str, List[int]] = collections.defaultdict(lambda: [0, 0, 0, 0])
+    for e in self.events:
+      s = stats[e.name]
+      s[0], s[1], s[2], s[3] = s[0] + 1, s[1] + e.duration, s[2] + e.flops, s[3] + e.nbytes
+    lines = [f"{'kernel':<32} {'calls':>7} {'total ms':>10} {'avg us':>10} {'GFLOP/s':>9} {'GB/s':>9}"]
+    for name, (calls, ns, flops, nbytes) in sorted(stats.items(), key=lambda x: -x[1][1]):
+      lines.append(f'{name:<32} {calls:>7} {ns/1e6:>10.3f} {ns/calls/1e3:>10.2f} {flops/max(ns, 1):>9.2f} {nbytes/max(ns, 1):>9.2f}')
+    return '\n'.join(lines)
+
+  def chrome_trace(self) -> Dict[str, Any]:
+    # Complete ("X") events in microseconds, loadable by chrome://tracing and Perfetto.
+    # pids are integers, every device is one process named by a metadata ("M") event
+    pids = {d: i for i, d in enumerate(dict.fromkeys(e.device for e in self.events))}
+    meta = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': d}} for d, pid in pids.items()]
+    return {'traceEvents': meta + [{'name': e.name, 'cat': e.device, 'ph': 'X', 'ts': e.start/1e3, 'dur': e.duration/1e3, 'pid': pids[e.device], 'tid': e.tid,
+                                    'args': {'shapes': e.shapes, 'nbytes': e.nbytes, 'flops': e.flops}} for e in self.events],
+            'displayTimeUnit': 'ns'}
+
+  def save_trace(self, path: str):
+    with open(path, 'w') as f: json.dump(self.chrome_trace(), f)
+
+PROFILER = Profiler(int(os.getenv('SHRIMP_PROFILE_EVENTS', '65536')), enabled=bool(int(os.getenv('SHRIMP_PROFILE', '0'))))
@@ -61,14 +61,14 @@ def reduce_op(F: Callable, x: shrimp.Tensor, ax=0):
 
 python_alu = {
   UnaryOps.LOG2: lambda x: math.log2(x) if x > 0 else -math.inf if x == 0 else math.nan,
-  UnaryOps.EXP2: lambda x: math.exp(x*math.log(2)),
+  UnaryOps.EXP2: lambda x: math.exp(x*math.log(2)), UnaryOps.EXP: math.exp,
   UnaryOps.SQRT: lambda x: math.sqrt(x) if x >= 0 else math.nan, UnaryOps.SIN: math.sin,
   UnaryOps.NEG: lambda x: (not x) if isinstance(x, bool) else -x,
   BinaryOps.MUL: operator.mul, BinaryOps.ADD: operator.add, BinaryOps.SUB: operator.sub, BinaryOps.XOR: operator.xor,
   BinaryOps.MAX: max, BinaryOps.CMPEQ: operator.eq, BinaryOps.CMPLT: operator.lt,
   BinaryOps.MOD: lambda x,y: abs(int(x))%abs(int(y))*(1,-1)[x<0],
   BinaryOps.DIV: lambda x,y: int(x/y) if isinstance(x, int) else (x/y if y != 0 else x*math.inf),
-  TernaryOps.WHERE: lambda x,y,z: y if x else z}
+  TernaryOps.WHERE: lambda x,y,z: y if x else z, TernaryOps.MULACC: lambda x,y,z: x*y+z}
 
 class PythonRuntime:
   @staticmethod 
@@ -0,0 +1,64 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Tuple
+from shrimpgrad.util import prod
+from shrimpgrad.view import View
+
+def _and(a, b): return b if a is None else a if b is None else False if a is False or b is False else a & b
+
+@dataclass(frozen=True)
+class ShapeTracker:
+  """The movement ops applied to a buffer, as a stack of views.
+  views[-1] is what the thunk looks like, every view below it describes how the contiguous layout of the view
+  above is laid out in memory. Movement ops merge into views[-1], only a reshape the strides can't express
+  (permute then reshape, reshape of a padded view) pushes a new view, so no movement op ever copies.
+  """
+  views: Tuple[View, ...]
+
+  @staticmethod
+  def from_shape(shape: Tuple[int,...]) -> ShapeTracker: return ShapeTracker((View(shape),))
+
+  @property
+  def view(self) -> View: return self.views[-1]
+  @property
+  def shape(self) -> Tuple[int,...]: return self.view.shape
+  @property
+  def strides(self) -> Tuple[int,...]:
+    assert len(self.views) == 1, 'a stack of views has no strides'
+    return self.view.strides
+  @property
+  def numel(self): return prod(self.shape)
+  @property
+  def ndim(self): return len(self.shape)
+  @property
+  def scalar(self): return self.ndim == 0
+  @property
+  def contiguous(self) -> bool: return len(self.views) == 1 and self.view.contiguous
+  # A single view without a mask is a plain strided array, the backends have fast paths for it
+  @property
+  def simple(self) -> bool: return len(self.views) == 1 and self.view.mask is None
+  @property
+  def masked(self) -> bool: return any(v.mask is not None for v in self.views)
+
+  def reshape(self, shape: Tuple[int,...]) -> ShapeTracker:
+    # a contiguous views[-1] only reshapes the view below it, that one may take the new shape directly
+    if len(self.views) > 1 and self.view.contiguous and (new := self.views[-2].reshape(shape)) is not None: return ShapeTracker((*self.views[:-2], new))
+    if (new := self.view.reshape(shape)) is not None: return ShapeTracker((*self.views[:-1], new))
+    return ShapeTracker((*self.views, View(shape)))
+  def permute(self, order: Tuple[int,...]) -> ShapeTracker: return ShapeTracker((*self.views[:-1], self.view.permute(order)))
+  def expand(self, shape: Tuple[int,...]) -> ShapeTracker: return ShapeTracker((*self.views[:-1], self.view.expand(shape)))
+  def shrink(self, arg: Tuple[Tuple[int,int],...]) -> ShapeTracker: return ShapeTracker((*self.views[:-1], self.view.shrink(arg)))
+  def pad(self, arg: Tuple[Tuple[int,int],...]) -> ShapeTracker: return ShapeTracker((*self.views[:-1], self.view.pad(arg)))
+  def stride(self, mul: Tuple[int,...]) -> ShapeTracker: return ShapeTracker((*self.views[:-1], self.view.stride(mul)))
+
+  def expr(self, idxs):
+    # (buffer index, validity) of element idxs through every view, see View.expr
+    idx, valid = self.view.expr(idxs)
+    for v in reversed(self.views[:-1]):
+      # idx addresses the contiguous layout of v, unravel it into v's dims
+      # (the outermost dim needs no modulo, idx is in range wherever it is valid)
+      idx, vv = v.expr([idx//prod(v.shape[d+1:]) if d == 0 else (idx//prod(v.shape[d+1:])) % v.shape[d] for d in range(v.ndim)])
+      valid = _and(valid, vv)
+    return idx, valid
+
+  def __repr__(self): return f'<ShapeTracker views={self.views}>'
@@ -1,56 +1,101 @@
 from __future__ import annotations
 import functools
 import math
-from typing import Callable, List, Optional, TypeAlias, Union, Tuple
+import os
+from typing import Callable, Dict, Iterator, List, Optional, TypeAlias, Union, Tuple
 from shrimpgrad.dtype import DType, dtypes, ConstType
-from random import uniform, gauss
 from shrimpgrad.future import Thunk
-from shrimpgrad.device import ClangDevice
-from shrimpgrad.util import calc_fan_in_fan_out, calc_gain, prod, to_nested_list
+from shrimpgrad.runtime.ops import BinaryOps
+from shrimpgrad.device import Accelerator, ClangDevice
+from shrimpgrad.runtime.numpy import from_np_dtype, to_np_dtype, view_array
+from shrimpgrad.util import calc_fan_in_fan_out, calc_gain, prod
 import numpy as np
 
 Num: TypeAlias = Union[float, int, complex]
 Shape: TypeAlias = Tuple[int, ...]
 
 def pad_left(*shps: Tuple[int, ...], v=1) -> List[Tuple[int ,...]]: return [tuple((v,)*(max(len(s) for s in shps)-len(s)) + s) for s in shps]
-def broadcast_shape(*shps: Tuple[int, ...]) -> Tuple[int, ...]: return tuple([max([s[dim] for s in shps]) for dim in range(len(shps[0]))])
+def broadcast_shape(*shps: Tuple[int, ...]) -> Tuple[int, ...]: return tuple([0 if any(s[dim] == 0 for s in shps) else max([s[dim] for s in shps]) for dim in range(len(shps[0]))])
+
+def _as_bytes(data: Union[np.ndarray, bytes, bytearray, memoryview], dtype: DType, shape: Shape) -> memoryview:
+  # Only arrays of another dtype or with a non C-contiguous layout are copied
+  if isinstance(data, np.ndarray): data = np.ascontiguousarray(data, dtype=to_np_dtype(dtype)).reshape(-1)
+  mv = memoryview(data).cast('B')
+  assert mv.nbytes == prod(shape)*dtype.bytes, f'buffer of {mv.nbytes} bytes does not hold a {dtype} tensor of shape {shape}'
+  return mv
 
 
 class Tensor:
+  # set once backward has freed the context of a computed tensor
+  _graph_freed = False
   def __init__(self, shape: Shape, data: Union[List, bytes, np.array, ConstType, Thunk], dtype:DType=dtypes.float32, device=ClangDevice(), requires_grad:Optional[bool]=None) -> Tensor:
-    self.requires_grad, self.index_view = requires_grad, None 
+    self.requires_grad = requires_grad
     self.grad: Optional[Tensor] = None
     from shrimpgrad.autograd.function import Function
     self.ctx: Optional[Function] = None
     if isinstance(data, Thunk): self.thunk = data
+    elif isinstance(data, (np.ndarray, bytes, bytearray, memoryview)) and isinstance(device, Accelerator):
+      # Buffer protocol data is wrapped in place on the device, writable memory is shared not copied
+      self.thunk = Thunk.load_from_buffer(_as_bytes(data, dtype, shape), dtype, shape, device)
     else: self.thunk = Thunk.load_from_cpu(data, dtype, shape) 
     if self.thunk.device != device: self.thunk = self.thunk.copy_to_device(device)
+
+  @property
+  def thunk(self) -> Thunk: return self._thunk
+  @thunk.setter
+  def thunk(self, thunk: Thunk):
+    # The buffer behind the thunk stays out of memory plans while this tensor is alive
+    self._thunk = thunk
+    thunk.base.buff.hold(self)
   
-  def backward(self) -> Tensor:
-    self.grad = Tensor.ones(self.shape, self.dtype)
-    visited = set()
-    topo = []
-    # TODO: Turn this into generator so we don't allocate memory for 
-    # a massive list
-    def build_topo(tensor: Tensor) -> List[Tensor]:  
-      if tensor not in visited:
-        visited.add(tensor)
-        if not tensor.ctx:
-          topo.append(tensor)
-          return
-        for p in tensor.ctx.tensors:
-          build_topo(p)
-        topo.append(tensor)
-    build_topo(self) 
-    for t in reversed(topo):
-      assert t.grad, f'{t} has no grad'
+  def _reverse_topo(self) -> Iterator[Tensor]:
+    # Counts the consumers of every tensor without recursion, then yields a tensor
+    # once all of its consumers have been yielded (Kahn's algorithm over the reversed graph)
+    pending: Dict[Tensor, int] = {self: 0}
+    stack = [self]
+    while stack:
+      for p in (t.ctx.tensors if (t := stack.pop()).ctx else ()):
+        if p not in pending:
+          pending[p] = 0
+          stack.append(p)
+        pending[p] += 1
+    ready = [self]
+    while ready:
+      t = ready.pop()
+      # the caller frees ctx once the tensor is yielded, so its parents are read first
+      parents = t.ctx.tensors if t.ctx else ()
+      yield t
+      for p in parents:
+        pending[p] -= 1
+        if pending[p] == 0: ready.append(p)
+
+  def _accumulate_grad(self, grads: List[Thunk]):
+    # Incoming gradients and any gradient left from an earlier backward are summed as thunks, not tensors,
+    # so no autograd history is recorded; the balanced tree of adds fuses into a single kernel
+    if self.grad is not None: grads = [self.grad.thunk, *grads]
+    while len(grads) > 1: grads = [a.alu(BinaryOps.ADD, b) for a, b in zip(grads[::2], grads[1::2])] + grads[len(grads)//2*2:]
+    self.grad = Tensor(grads[0].shape, grads[0], grads[0].dtype, grads[0].device, requires_grad=False)
+
+  def backward(self, gradient: Optional[Tensor]=None) -> Tensor:
+    # gradients wait here until every consumer of a tensor has pushed its share
+    seed = gradient if gradient is not None else Tensor.ones(self.shape, self.dtype, device=self.device)
+    incoming: Dict[Tensor, List[Thunk]] = {self: [seed.thunk]}
+    order = list(self._reverse_topo())
+    # a tensor whose context an earlier backward freed looks like a leaf, going on would drop the gradient of its inputs
+    if any(t._graph_freed for t in order): raise RuntimeError('backward through a graph a second time, its contexts were freed by the first backward')
+    for t in order:
+      t._graph_freed = t.ctx is not None
+      # comparisons pass no gradient (None), a tensor reached only through them gets none
+      if t not in incoming:
+        t.ctx = None
+        continue
+      t._accumulate_grad(incoming.pop(t))
       if not t.ctx: continue
       grads = t.cls.backward(t.ctx, t.grad.thunk)
-      grads = [Tensor(g.shape, g, g.dtype, g.device, requires_grad=False) 
-               for g in ([grads] if len(t.ctx.tensors) == 1 else grads)]
-      for t0, g in zip(t.ctx.tensors, grads):
-        t0.grad = g if t0.grad is None else t0.grad + g
-      del t.ctx
+      for t0, g in zip(t.ctx.tensors, [grads] if len(t.ctx.tensors) == 1 else grads):
+        if g is not None: incoming.setdefault(t0, []).append(g)
+      # the context holds the saved forward thunks, nothing needs them once the gradient is pushed
+      t.ctx = None
     return self
 
   @property
@@ -64,19 +109,101 @@ class Tensor:
   @property
   def ndim(self): return self.thunk.ndim
 
+  # Realization
+  def realize(self, *tensors: Tensor) -> Tensor:
+    # Tensors realized together share one schedule, so their intermediates share memory
+    from shrimpgrad.engine.realize import realize
+    realize(self.thunk, *[t.thunk for t in tensors])
+    return self
+
+  @property
+  def data(self) -> Union[List[ConstType], ConstType]:
+    ret = self.numpy()
+    return ret.item() if self.is_scalar() else ret.reshape(-1).tolist()
+
+  def numpy(self) -> np.ndarray:
+    self.realize()
+    buff, st = self.thunk.base.buff, self.thunk.st
+    arr = np.frombuffer(buff._buf, dtype=to_np_dtype(self.dtype), count=buff.size)
+    # A contiguous view shares the device memory, any other layout is gathered into a fresh array
+    if st.contiguous and st.numel == buff.size: return arr.reshape(self.shape)
+    return np.array(view_array(arr, st, self.dtype))
+
+  @staticmethod
+  def from_numpy(arr: np.ndarray, **kwargs) -> Tensor: return Tensor(arr.shape, arr, from_np_dtype(arr.dtype), **kwargs)
+
+  @staticmethod
+  def from_file(path: str, shape: Shape, dtype:DType=dtypes.float32, offset:int=0, writable:bool=False, device=ClangDevice(), requires_grad:Optional[bool]=None) -> Tensor:
+    return Tensor(shape, Thunk.load_from_file(path, dtype, shape, device, offset, writable), dtype, device, requires_grad)
+
+  def to_file(self, path: str, offset:int=0) -> Tensor:
+    # Creates or grows the file as needed and returns a tensor over the written region
+    if not os.path.exists(path): open(path, 'wb').close()
+    out = Tensor.from_file(path, self.shape, self.dtype, offset, writable=True, device=self.device)
+    out.thunk.base.buff.copyin(memoryview(np.ascontiguousarray(self.numpy())).cast('B'))
+    out.thunk.base.buff.flush()
+    return out
+
   # Indexing 
   def item(self) -> ConstType:
     if len(self.shape): raise RuntimeError(f'a Tensor with {self.numel} elements cannot be converted to Scalar')
     return self.thunk
 
   def __getitem__(self, key) -> Tensor:
-    # TODO: Remove dimensions when indexing down from NDim to MDim (m < n)
-    # i.e.) indexing x[0,0,0] x.shape=(2,2,2) should return a scalar view of x
+    # ints, slices, None and ... are movement ops on the same buffer, nothing is copied until a kernel reads the view.
+    # A list or integer tensor index gathers in a kernel.
     if not len(self.shape): raise IndexError('invalid index of a 0-dim tensor. Use `tensor.item()`')
-    x = Tensor(self.shape, self.thunk)
-    x.index_view = to_nested_list(self, key)
-    return x
-  
+    key = key if isinstance(key, tuple) else (key,)
+    if sum(k is Ellipsis for k in key) > 1: raise IndexError('an index can only have a single ellipsis (\'...\')')
+    if (ndim := sum(k is not None and k is not Ellipsis for k in key)) > self.ndim: raise IndexError(f'too many indices for tensor of dimension {self.ndim}')
+    ell = next((i for i, k in enumerate(key) if k is Ellipsis), len(key))
+    key = key[:ell] + (slice(None),)*(self.ndim-ndim) + key[ell+1:]
+    if sum(isinstance(k, (Tensor, list)) for k in key) > 1: raise IndexError('only one list or tensor index is supported')
+    arg, mul, shape, dim, gather = [], [], [], 0, None
+    for k in key:
+      if k is None:
+        shape.append(1)
+        continue
+      s = self.shape[dim]
+      if isinstance(k, (int, np.integer)):
+        if not -s <= k < s: raise IndexError(f'index {k} is out of bounds for dimension {dim} with size {s}')
+        arg.append((k % s, k % s + 1))
+        mul.append(1)
+      elif isinstance(k, slice):
+        start, stop, step = k.indices(s)
+        n = len(range(start, stop, step))
+        # the elements from the first to the last one taken, stride then keeps every step-th (backwards for a negative step)
+        arg.append((0, 0) if n == 0 else (start, start+(n-1)*step+1) if step > 0 else (start+(n-1)*step, start+1))
+        mul.append(step if n else 1)
+        shape.append(n)
+      elif isinstance(k, (Tensor, list)):
+        gather = (len(shape), k)
+        arg.append((0, s))
+        mul.append(1)
+        shape.append(s)
+      else: raise IndexError(f'invalid index {k!r}, only integers, slices, None, ..., lists and tensors are valid')
+      dim += 1
+    x = self
+    if any(a != (0, s) for a, s in zip(arg, self.shape)): x = x.shrink(arg)
+    if any(m != 1 for m in mul): x = x.stride(mul)
+    if x.shape != tuple(shape): x = x.reshape(*shape)
+    return x if gather is None else x._gather(*gather)
+
+  def _gather(self, dim: int, idx: Union[Tensor, List[int]]) -> Tensor:
+    # x[..., idx, ...] reads the selected elements straight from x, the kernel loads the index and then x at it
+    from shrimpgrad.autograd.function import Gather
+    s = self.shape[dim]
+    if isinstance(idx, list):
+      if any(not -s <= i < s for i in idx): raise IndexError(f'index out of bounds for dimension {dim} with size {s}')
+      idx = Tensor((len(idx),), [i % s for i in idx], dtypes.int32, device=self.device)
+    else: idx = (idx + s).where(idx < 0, idx).detach()
+    pre, post = self.shape[:dim], self.shape[dim+1:]
+    if not idx.ndim: return self._gather(dim, idx.reshape(1)).reshape(*pre, *post)
+    # x and the index are broadcast to the result, the last index dim is the one gathered along
+    out = (*pre, *idx.shape, *post)
+    x = self.reshape(*pre, *(1,)*(idx.ndim-1), s, *post).expand(*pre, *idx.shape[:-1], s, *post)
+    return Gather.apply(x, idx.reshape(*(1,)*len(pre), *idx.shape, *(1,)*len(post)).expand(*out), dim=len(pre)+idx.ndim-1)
+
   # Broadcasting, Assignment, Casting and Data Augmentation
   def broadcast_to(self: Tensor, broadcast_shape: Shape) -> Tensor:
     if self.shape == broadcast_shape:
@@ -90,7 +217,8 @@ class Tensor:
     x = self
     if not isinstance(y, Tensor):
       assert isinstance(y, ConstType), f'type(y)={type(y)} is not a ConstType'
-      y = Tensor((), data=y, dtype=dtypes.from_py(y))
+      # python constants take on the dtype of the tensor they are combined with
+      y = Tensor((), data=self.thunk.const(dtypes.cast(self.dtype, y), ()), dtype=self.dtype, device=self.device)
     new_shapes = pad_left(self.shape, y.shape)
     assert all(x == y or x == 1 or y == 1 for x, y in zip(*new_shapes)), f'invalid shapes for broadcasting {self.shape} and {y.shape}'
     bs = broadcast_shape(*new_shapes)
@@ -118,7 +246,7 @@ class Tensor:
     return Where.apply(cond.cast(dtypes.bool), *x.__broadcast(y_))
   
   def detach(self) -> Tensor:
-    return Tensor(self.shape, self.thunk, self.dtype, requires_grad=False)
+    return Tensor(self.shape, self.thunk, self.dtype, self.device, requires_grad=False)
 
   # Arithmetic and Logical Functions 
   def mul(self, other, reverse=False) -> Tensor: 
@@ -232,6 +360,25 @@ class Tensor:
     from shrimpgrad.autograd.function import Permute
     return Permute.apply(self, order=order)
 
+  def stride(self, mul: Tuple[int,...]) -> Tensor:
+    # every mul-th element of each dim, backwards for a negative mul
+    from shrimpgrad.autograd.function import Stride
+    return Stride.apply(self, mul=tuple(mul))
+
+  def flip(self, axis: Union[int, Tuple[int,...]]) -> Tensor:
+    axis = self._canonicalize_axis(axis)
+    return self.stride(tuple(-1 if i in axis else 1 for i in range(self.ndim)))
+
+  def shrink(self, arg: Tuple[Tuple[int,int],...]) -> Tensor:
+    # keeps [start, end) of every dim
+    from shrimpgrad.autograd.function import Shrink
+    return Shrink.apply(self, arg=tuple(tuple(a) for a in arg))
+
+  def pad(self, arg: Tuple[Tuple[int,int],...]) -> Tensor:
+    # adds (before, after) zeros to every dim
+    from shrimpgrad.autograd.function import Pad
+    return Pad.apply(self, arg=tuple(tuple(a) for a in arg))
+
   def transpose(self, ax0=1, ax1=0):
     ax0, ax1 = (ax0 + self.ndim if ax0 < 0 else ax0), (ax1 + self.ndim if ax1 < 0 else ax1)
     order = [i for i in range(self.ndim)]
@@ -253,15 +400,15 @@ class Tensor:
   def ones(shape: Shape, dtype:DType=dtypes.float32, **kwargs) -> Tensor:  return Tensor.full(shape, fill_value=1.0, dtype=dtype, **kwargs)
 
   @staticmethod
-  def arange(start: int, stop:int, step:int=1, dtype:DType=dtypes.float32, **kwargs) -> Tensor: return Tensor(((stop - start) // step,), [float(i) if dtype == dtypes.float32 else int(i) for i in range(start, stop, step)], dtype, **kwargs) 
+  def arange(start: int, stop:int, step:int=1, dtype:DType=dtypes.float32, **kwargs) -> Tensor:
+    return Tensor(((stop - start) // step,), np.arange(start, stop, step, dtype=to_np_dtype(dtype)), dtype, **kwargs) 
 
   @staticmethod
   def fromlist(shape: Shape, data:List[Num], dtype=dtypes.float32, **kwargs): return Tensor(shape, data=data, dtype=dtype, **kwargs)
 
   @staticmethod
   def full(shape: Shape, fill_value: Num, dtype=dtypes.float32, **kwargs) -> Tensor:
-    if not len(shape): return Tensor((), fill_value)
-    return Tensor(shape, [float(fill_value) if dtype == dtypes.float32 else int(fill_value)]*prod(shape), **kwargs)
+    return Tensor(shape, np.full(shape, fill_value, dtype=to_np_dtype(dtype)), dtype, **kwargs)
 
   @staticmethod
   def full_like(t: Tensor, fill_value: Num, **kwargs) -> Tensor: return Tensor.full(t.shape, fill_value=fill_value, dtype=t.dtype, **kwargs)
@@ -275,10 +422,7 @@ class Tensor:
   @staticmethod
   def eye(n: int, dtype=dtypes.float32, **kwargs) -> Tensor:
     assert n > 0, 'identity matrix requires dimension > 0' 
-    data = [0.0] * (n**2) 
-    for i in range(n):
-      data[i*n + i] = 1.0
-    return Tensor((n,n), data, dtype, **kwargs)
+    return Tensor((n,n), np.eye(n, dtype=to_np_dtype(dtype)), dtype, **kwargs)
   
   @staticmethod
   def rand(*shape, dtype=dtypes.float32, **kwargs) -> Tensor:
@@ -288,11 +432,11 @@ class Tensor:
   @staticmethod
   def randn(*shape, dtype=dtypes.float32, **kwargs) -> Tensor:
     #TODO: Box Muller Transform 
-    return Tensor(shape, [gauss(0, 1) for _ in range(prod(shape))], dtype, **kwargs)
+    return Tensor(shape, np.random.standard_normal(shape).astype(to_np_dtype(dtype)), dtype, **kwargs)
 
   @staticmethod
   def uniform(*shape, low:Union[int, float]=0, high:Union[int, float]=10, dtype=dtypes.float32, **kwargs) -> Tensor:
-    return Tensor(shape, [uniform(low, high) for _ in range(prod(shape))], dtype=dtype, **kwargs)
+    return Tensor(shape, np.random.uniform(low, high, size=shape).astype(to_np_dtype(dtype)), dtype=dtype, **kwargs)
 
   @staticmethod
   def kaiming_uniform(*shape, mode:str='fan_in', nonlinearity:str='leaky_relu', a=0.1, **kwargs) -> Tensor:
@@ -1,10 +1,26 @@
+import ctypes
 from functools import reduce
-from typing import Iterable, Optional, Tuple, Union
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple, Union
 import operator
 import math
 
 def argsort(x): return type(x)(sorted(range(len(x)), key=x.__getitem__)) # https://stackoverflow.com/questions/3382352/equivalent-of-numpy-argsort-in-basic-python
 def prod(x: Iterable[int|float]) -> Union[float, int]: return reduce(operator.mul, x, 1)
+def toposort(root: Any, srcs: Callable[[Any], Sequence[Any]]) -> List[Any]:
+  # every node reachable from root through srcs once, each after all of its srcs and left to right,
+  # with an explicit stack so graphs of any depth don't hit the recursion limit
+  order, seen, stack = [], set(), [(root, False)]
+  while stack:
+    node, expanded = stack.pop()
+    if expanded:
+      order.append(node)
+      continue
+    if node in seen: continue
+    seen.add(node)
+    stack.append((node, True))
+    stack.extend((x, False) for x in reversed(srcs(node)))
+  return order
+def from_mv(mv: memoryview, to_type=ctypes.c_char): return ctypes.cast(ctypes.addressof(to_type.from_buffer(mv)), ctypes.POINTER(to_type * len(mv))).contents
 
 def calc_loops(tensor, key: Optional[slice|int]) -> Iterable[int]:
   if not key and not isinstance(key, int):  key = [slice(0, dim, 1) for dim in tensor.view.shape]
@@ -39,30 +55,11 @@ def calc_loops(tensor, key: Optional[slice|int]) -> Iterable[int]:
     for ed in range(len(key), len(key) + extra_dim): loops.append((0, tensor.view.shape[ed], 1))
   return loops
 
-def to_nested_list(tensor, key: Optional[slice|int]) -> Iterable:
-  def build(dim:int, offset:int, loops:Iterable[tuple], result:Iterable[float|int]) -> Iterable[float|int]:
-    if not loops: return result 
-    s, e, step = loops[0]
-    for i in range(s, e, step):
-      if len(loops) == 1: 
-        result.append(tensor.data[offset+i*step*tensor.view.strides()[dim]])
-      else: 
-        result.append([])
-        build(dim+1, offset + i*tensor.view.strides()[dim]*step, loops[1:], result[-1])
-    return result 
-  return build(0, 0, calc_loops(tensor, key), []) 
+def to_nested_list(tensor, key=None) -> Iterable:
+  # the elements of tensor[key] as nested python lists
+  return (tensor if key is None else tensor[key]).numpy().tolist()
 
-def flatten(tensor):
-  def build(dim:int, offset:int, loops:Iterable[tuple], result:Iterable[float|int]) -> Iterable[float|int]:
-    if not loops: return result 
-    s, e, step = loops[0]
-    for i in range(s, e, step):
-      if len(loops) == 1: 
-        result.append(tensor.data[offset+i*step*tensor.view.strides()[dim]])
-      else: 
-        build(dim+1, offset + i*tensor.view.strides()[dim]*step, loops[1:], result)
-    return result 
-  return build(0, 0, calc_loops(tensor, None), [])  
+def flatten(tensor) -> Iterable: return tensor.numpy().reshape(-1).tolist()
 
 ## Used for Kaiming init
 def calc_fan_in_fan_out(shape:Tuple[int,...]):
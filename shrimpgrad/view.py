@@ -1,54 +1,116 @@
 from __future__ import annotations
+from dataclasses import dataclass
 from itertools import accumulate
 import operator
-from typing import Tuple
+from typing import Optional, Tuple
 from shrimpgrad.util import prod
 
+def strides_for_shape(shape: Tuple[int,...]) -> Tuple[int,...]:
+  return tuple(accumulate(shape[-1:0:-1], func=operator.mul, initial=(1 if len(shape) else None)))[::-1]
+
+def _reshape_strides(shape: Tuple[int,...], strides: Tuple[int,...], new_shape: Tuple[int,...]) -> Optional[Tuple[int,...]]:
+  # Strides that walk new_shape through the same memory, or None when a new dim would straddle a jump in the old layout.
+  # Old dims are grouped with the new dims of the same size and a group has to be contiguous within itself (numpy's nocopy reshape).
+  old = [(s, st) for s, st in zip(shape, strides) if s != 1]
+  new_strides = [0]*len(new_shape)
+  oi, ni = 0, 0
+  while oi < len(old) and ni < len(new_shape):
+    oj, nj, osz, nsz = oi+1, ni+1, old[oi][0], new_shape[ni]
+    while osz != nsz:
+      if nsz < osz: nsz, nj = nsz*new_shape[nj], nj+1
+      else: osz, oj = osz*old[oj][0], oj+1
+    if any(old[k][1] != old[k+1][0]*old[k+1][1] for k in range(oi, oj-1)): return None
+    new_strides[nj-1] = old[oj-1][1]
+    for k in range(nj-1, ni, -1): new_strides[k-1] = new_strides[k]*new_shape[k]
+    oi, ni = oj, nj
+  # what is left of new_shape are size 1 dims
+  return tuple(0 if s == 1 else st for s, st in zip(new_shape, new_strides))
+
+@dataclass(frozen=True)
 class View:
-  """A description of how a thunk's data is interpreted
+  """A strided window onto a buffer.
+  Element idxs lives at offset + sum(idxs*strides) of the buffer, when mask (a (start, end) per dim) is set
+  only the idxs inside it are valid and the rest read as 0 (padding).
   """
-  def __init__(self, shape: Tuple[int,...]):
-    self.shape = shape 
-    self._strides = tuple(accumulate(self.shape[-1:0:-1], func=operator.mul, initial=(1 if len(self.shape)else None)))[::-1]
+  shape: Tuple[int,...]
+  strides: Optional[Tuple[int,...]] = None
+  offset: int = 0
+  mask: Optional[Tuple[Tuple[int,int],...]] = None
+
+  def __post_init__(self):
+    object.__setattr__(self, 'shape', tuple(self.shape))
+    object.__setattr__(self, 'strides', strides_for_shape(self.shape) if self.strides is None else tuple(self.strides))
+    # a mask that keeps everything is no mask
+    if self.mask is not None and all(m == (0, s) for m, s in zip(self.mask, self.shape)): object.__setattr__(self, 'mask', None)
 
   @property
-  def strides(self) -> Tuple[int,...]: return self._strides
+  def _strides(self) -> Tuple[int,...]: return self.strides
 
   @property
   def contiguous(self) -> bool:
-    return all(self._strides[i] == self.shape[i+1]*self._strides[i+1] for i in range(0, self.ndim-1))
+    return self.offset == 0 and self.mask is None and all(st == c for s, st, c in zip(self.shape, self.strides, strides_for_shape(self.shape)) if s != 1)
 
   @property
-  def scalar(self): return self.ndim == 0 
-  @property 
-  def numel(self): return prod(self.shape)    
+  def scalar(self): return self.ndim == 0
+  @property
+  def numel(self): return prod(self.shape)
   @property
   def ndim(self): return len(self.shape)
 
-  def reshape(self, new_shape: Tuple[int,...]) -> View:
-    if len(self.shape):
-      assert prod(new_shape) == self.numel, f'shape \'{new_shape}\' is invalid for input of size {self.numel} of shape {self.shape}'
-      return View(new_shape)  
-    return View(new_shape)  
+  def reshape(self, new_shape: Tuple[int,...]) -> Optional[View]:
+    # None when the new shape can't be expressed as strides over the same memory
+    assert prod(new_shape) == self.numel, f'shape \'{new_shape}\' is invalid for input of size {self.numel} of shape {self.shape}'
+    if self.contiguous: return View(new_shape)
+    if self.mask is not None: return None
+    new_strides = _reshape_strides(self.shape, self.strides, new_shape)
+    return None if new_strides is None else View(new_shape, new_strides, self.offset)
 
   def permute(self, order: Tuple[int,...]) -> View:
-    new_shape = tuple([self.shape[i] for i in order])
-    new_strides = tuple([self.strides[i] for i in order])
-    v = View(new_shape) 
-    v._strides = new_strides
-    return v
-    
+    return View(tuple(self.shape[i] for i in order), tuple(self.strides[i] for i in order), self.offset,
+                None if self.mask is None else tuple(self.mask[i] for i in order))
+
   def expand(self, shape: Tuple[int,...]) -> View:
-    out = View.from_view(self) 
-    strd = list(out.strides)
-    for i, (si, so) in enumerate(zip(self.shape, shape)):
-      if si != so: strd[i] = 0
-    out.shape = shape
-    out._strides = strd
-    return out
-  
+    # keep the strides of a permuted view, only the broadcast dims read with stride 0
+    strides = tuple(0 if si != so else st for si, so, st in zip(self.shape, shape, self.strides))
+    mask = None if self.mask is None else tuple((0, so) if si != so and m == (0, 1) else (0, 0) if si != so else m for si, so, m in zip(self.shape, shape, self.mask))
+    return View(shape, strides, self.offset, mask)
+
+  def shrink(self, arg: Tuple[Tuple[int,int],...]) -> View:
+    # keeps [start, end) of every dim by moving the offset
+    offset = self.offset + sum(b*st for (b, _), st in zip(arg, self.strides))
+    mask = None if self.mask is None else tuple((min(max(lo-b, 0), e-b), min(max(hi-b, 0), e-b)) for (lo, hi), (b, e) in zip(self.mask, arg))
+    return View(tuple(e-b for b, e in arg), self.strides, offset, mask)
+
+  def pad(self, arg: Tuple[Tuple[int,int],...]) -> View:
+    # grows every dim by (before, after) elements that are masked out
+    mask = tuple((b+lo, b+hi) for (b, _), (lo, hi) in zip(arg, self.mask if self.mask is not None else [(0, s) for s in self.shape]))
+    offset = self.offset - sum(b*st for (b, _), st in zip(arg, self.strides))
+    return View(tuple(s+b+a for s, (b, a) in zip(self.shape, arg)), self.strides, offset, mask)
+
+  def stride(self, mul: Tuple[int,...]) -> View:
+    # every mul-th element of each dim, a negative mul walks the dim backwards
+    assert all(m != 0 for m in mul), 'stride can\'t be 0'
+    offset = self.offset + sum((s-1)*st for s, st, m in zip(self.shape, self.strides, mul) if m < 0)
+    mask = None
+    if self.mask is not None:
+      flipped = [(s-hi, s-lo) if m < 0 else (lo, hi) for (lo, hi), s, m in zip(self.mask, self.shape, mul)]
+      mask = tuple((-(-lo//abs(m)), -(-hi//abs(m))) for (lo, hi), m in zip(flipped, mul))
+    return View(tuple(-(-s//abs(m)) for s, m in zip(self.shape, mul)), tuple(st*m for st, m in zip(self.strides, mul)), offset, mask)
+
+  def expr(self, idxs):
+    # (buffer index, validity) of element idxs, validity is None when every element is valid
+    # idxs can be ints, numpy arrays or anything else with + * >= < and &
+    idx = self.offset
+    for i, st in zip(idxs, self.strides):
+      if st != 0: idx = i*st + idx
+    valid = None
+    for i, (lo, hi), s in zip(idxs, self.mask or (), self.shape):
+      for cond in ([i >= lo] if lo > 0 else []) + ([i < hi] if hi < s else []): valid = cond if valid is None else valid & cond
+    # an empty dim makes every element of the view padding
+    return idx, False if self.mask is not None and any(lo >= hi for lo, hi in self.mask) else valid
+
   @staticmethod
   def from_view(view: View):
     return View(view.shape)
-  
-  def __repr__(self): return f'<View shape={self.shape} strides={self.strides} contig={self.contiguous}>'
\ No newline at end of file
+
+  def __repr__(self): return f'<View shape={self.shape} strides={self.strides} offset={self.offset} mask={self.mask} contig={self.contiguous}>'
@@ -0,0 +1,22 @@
+from benchmarks.harness import Benchmark, Result, benchmark, compare, BENCHMARKS, run
+import unittest
+
+class TestBenchmarkHarness(unittest.TestCase):
+  def test_grid_registration(self):
+    before = len(BENCHMARKS)
+    @benchmark('test', n=[1, 2], m=['a'])
+    def noop(n, m): return lambda: None
+    self.assertEqual(['test/noop[n=1,m=a]', 'test/noop[n=2,m=a]'], [b.name for b in BENCHMARKS[before:]])
+    del BENCHMARKS[before:]
+
+  def test_run(self):
+    calls = []
+    result = run(Benchmark('test/count', 'test', lambda: lambda: calls.append(1)), repeat=3, warmup=2)
+    self.assertEqual(5, len(calls))
+    self.assertEqual(3, len(result.times))
+    self.assertIn('median', result.to_json())
+
+  def test_compare(self):
+    results = [Result('fast', 'g', {}, [1.0]), Result('slow', 'g', {}, [1.5]), Result('new', 'g', {}, [1.0])]
+    baseline = {'fast': {'median': 1.2}, 'slow': {'median': 1.0}}
+    self.assertEqual(['slow'], [r.name for r in compare(results, baseline, threshold=0.1)])
@@ -0,0 +1,297 @@
+import ctypes
+import os
+import tempfile
+import unittest
+import numpy as np
+from shrimpgrad import Tensor
+from shrimpgrad.device import ClangDevice
+from shrimpgrad.dtype import dtypes
+from shrimpgrad.runtime.blas import load_blas
+from shrimpgrad.runtime.clang import ClangCodeGenerator, ClangCompiler, ClangProgram, ClangRuntime, _leaf_st, _loads, _masked_consts, collapse_dims, gemm_dims, generic_args
+from shrimpgrad.runtime.ops import BinaryOps, UnaryOps
+
+class TestClangCompiler(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.cache_dir, ClangCompiler.cache_dir = ClangCompiler.cache_dir, self.tmp.name
+    ClangCompiler._libs.clear()
+  def tearDown(self):
+    ClangCompiler.cache_dir = self.cache_dir
+    ClangCompiler._libs.clear()
+    self.tmp.cleanup()
+
+  def _prg(self, shape):
+    prg = ClangProgram()
+    prg.autogen(shape, [shape[1], 1], dtypes.float32)
+    return prg
+
+  def test_compile_cache_in_process(self):
+    lib0 = ClangCompiler().compile(self._prg((2,2)))
+    lib1 = ClangCompiler().compile(self._prg((2,2)))
+    self.assertIs(lib0, lib1)
+    self.assertIsNot(lib0, ClangCompiler().compile(self._prg((3,3))))
+
+  def test_compile_cache_on_disk(self):
+    prg = self._prg((2,2))
+    ClangCompiler().compile(prg)
+    key = ClangCompiler().key(ClangCodeGenerator(self._prg((2,2))).render())
+    self.assertEqual([f'{key}.so'], os.listdir(self.tmp.name))
+    # A fresh process only has the directory, it loads the library without recompiling
+    ClangCompiler._libs.clear()
+    mtime = os.path.getmtime(os.path.join(self.tmp.name, f'{key}.so'))
+    self.assertIsNotNone(ClangCompiler().compile(self._prg((2,2))))
+    self.assertEqual(mtime, os.path.getmtime(os.path.join(self.tmp.name, f'{key}.so')))
+
+  def test_compile_concurrent(self):
+    # the same source from many threads is built by one clang run and loaded once
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(8) as pool: libs = list(pool.map(lambda _: ClangCompiler().compile(self._prg((4,4))), range(8)))
+    self.assertTrue(all(lib is libs[0] for lib in libs))
+    self.assertEqual(1, len(os.listdir(self.tmp.name)))
+
+  def test_compile_pipeline(self):
+    import shrimpgrad.engine.realize as realize
+    from shrimpgrad.engine.schedule import Scheduler
+    def step():
+      x = Tensor.from_numpy(np.ones((4, 4), dtype=np.float32))
+      for i in range(8): x = (x * (1.0 + i/8)).permute((1, 0)) + float(i)
+      return x
+    threads = realize.COMPILE_THREADS
+    try:
+      realize.COMPILE_THREADS = 4
+      schedule = Scheduler([step().thunk]).schedule()
+      # kernels come back in schedule order however their compiles finish
+      self.assertEqual([ei.bufs[-1] for ei in realize.lower_schedule(schedule)], [sk.outputs[-1] for sk in schedule])
+      ClangCompiler._libs.clear()
+      out = step().numpy()
+      realize.COMPILE_THREADS = 1
+      np.testing.assert_allclose(out, step().numpy())
+    finally: realize.COMPILE_THREADS = threads
+
+  def test_compile_cache_lru(self):
+    ClangCompiler.cache_size = 1
+    try:
+      ClangCompiler().compile(self._prg((2,2)))
+      ClangCompiler().compile(self._prg((3,3)))
+      self.assertEqual(1, len(ClangCompiler._libs))
+      self.assertEqual(2, len(os.listdir(self.tmp.name)))
+    finally: ClangCompiler.cache_size = 256
+
+  def test_compile_key_host(self):
+    # libraries built with -march=native for another cpu are never loaded
+    import shrimpgrad.runtime.clang as clang
+    src, host_target = ClangCodeGenerator(self._prg((2,2))).render(), clang.host_target
+    key = ClangCompiler().key(src)
+    try:
+      clang.host_target = lambda: 'x86-64 +sse2'
+      self.assertNotEqual(key, ClangCompiler().key(src))
+    finally: clang.host_target = host_target
+
+  def test_compile_failure(self):
+    import subprocess
+    from unittest import mock
+    with mock.patch.object(ClangCodeGenerator, 'render', return_value='void broken( {'):
+      with self.assertRaises(subprocess.CalledProcessError): ClangCompiler().compile(ClangProgram())
+    self.assertEqual([], os.listdir(self.tmp.name))
+
+  def test_compile_failure_in_pool(self):
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest import mock
+    # every waiter sees the error and no per source lock is left behind
+    with mock.patch.object(ClangCodeGenerator, 'render', return_value='void broken( {'), ThreadPoolExecutor(4) as pool:
+      for fut in [pool.submit(ClangCompiler().compile, ClangProgram()) for _ in range(4)]:
+        with self.assertRaises(subprocess.CalledProcessError): fut.result()
+    self.assertEqual({}, ClangCompiler._building)
+
+class TestClangGeneric(unittest.TestCase):
+  def setUp(self):
+    prg = ClangProgram()
+    prg.autogen_generic(dtypes.float32)
+    self.rt = ClangRuntime(ClangCompiler().compile(prg))
+
+  def test_generic_contiguous(self):
+    for n in (1, 6, 1000):
+      x, out = (ctypes.c_float * n)(*range(n)), (ctypes.c_float * n)()
+      self.rt.exec(BinaryOps.MUL, x, x, out, *generic_args((n,), (1,), (1,), (1,)))
+      self.assertEqual([float(i*i) for i in range(n)], list(out))
+
+  def test_generic_broadcast(self):
+    x, y, out = (ctypes.c_float * 6)(*range(6)), (ctypes.c_float * 3)(10, 20, 30), (ctypes.c_float * 6)()
+    self.rt.exec(BinaryOps.ADD, x, y, out, *generic_args((2,3), (3,1), (0,1), (3,1)))
+    self.assertEqual([10.0, 21.0, 32.0, 13.0, 24.0, 35.0], list(out))
+
+  def test_generic_permuted(self):
+    x, out = (ctypes.c_float * 6)(*range(6)), (ctypes.c_float * 6)()
+    self.rt.exec(UnaryOps.NEG, x, out, *generic_args((3,2), (1,3), (2,1)))
+    self.assertEqual([-0.0, -3.0, -1.0, -4.0, -2.0, -5.0], list(out))
+
+  def test_fused_kernels_batch_generic(self):
+    from shrimpgrad.engine.schedule import Scheduler
+    from shrimpgrad.runtime.ops import BufferOps
+    def model(b):
+      x = Tensor.from_numpy(np.arange(b*10, dtype=np.float32).reshape(b, 10))
+      return ((x + Tensor.from_numpy(np.ones(10, dtype=np.float32))).relu().sum(axis=1), x)
+    def sources(b):
+      kernels = [sk for sk in Scheduler([model(b)[0].thunk]).schedule() if sk.ast.op is BufferOps.STORE]
+      return [ClangCodeGenerator((prg := ClangProgram(), prg.create_kernel('k', sk.ast))[0]).render() for sk in kernels]
+    # the bias add and the row sum take the batch as an argument, every batch size renders the same kernels
+    self.assertEqual(sources(3), sources(7))
+    for b in (3, 7):
+      y, x = model(b)
+      np.testing.assert_allclose((x.numpy() + 1.0).sum(axis=1), y.numpy())
+
+class TestCollapseDims(unittest.TestCase):
+  def test_collapse_contiguous(self):
+    self.assertEqual(((120,), [(1,), (1,)], ()), collapse_dims((2,3,4,5), [(60,20,5,1), (60,20,5,1)]))
+
+  def test_collapse_broadcast(self):
+    # the trailing (4,5) block is contiguous in both views, the leading dims only in one
+    self.assertEqual(((6,20), [(20,1), (0,1)], ()), collapse_dims((2,3,4,5), [(60,20,5,1), (0,0,5,1)]))
+
+  def test_collapse_permuted(self):
+    self.assertEqual(((3,2), [(1,3)], ()), collapse_dims((3,2), [(1,3)]))
+
+  def test_collapse_drops_ones(self):
+    self.assertEqual(((4,), [(1,)], ()), collapse_dims((1,4,1), [(4,1,1)]))
+    self.assertEqual(((), [()], ()), collapse_dims((1,1), [(1,1)]))
+
+  def test_collapse_reduce(self):
+    # reduced and kept dims are merged separately
+    self.assertEqual(((6,20), [(20,1), (1,0)], (1,)), collapse_dims((2,3,4,5), [(60,20,5,1), (3,1,0,0)], axis=(2,3)))
+
+  def test_collapsed_kernel_is_flat(self):
+    prg = ClangProgram()
+    prg.create_op(BinaryOps.ADD, (2,3,4,5), [60,20,5,1], dtypes.float32)
+    src = ClangCodeGenerator(prg).render()
+    self.assertEqual(1, src.count('for('))
+    self.assertIn('out0[i0]=in0[i0]+in1[i0];', src)
+
+class TestKernelGraph(unittest.TestCase):
+  def _leaves(self):
+    from shrimpgrad.engine.schedule import MLIR, MLIRBuffer
+    from shrimpgrad.runtime.ops import BufferOps
+    from shrimpgrad.shapetracker import ShapeTracker
+    return MLIR, [MLIR(BufferOps.LOAD, (), MLIRBuffer(i, ShapeTracker.from_shape((4,)), dtypes.float32)) for i in range(2)]
+
+  def test_loads_shared(self):
+    # every node is shared by both operands of the next, a walk without a visited set is 2**60 steps
+    MLIR, (a, b) = self._leaves()
+    y = MLIR(BinaryOps.MUL, (a, b))
+    for _ in range(60): y = MLIR(BinaryOps.MUL, (y, y))
+    self.assertEqual([a, b], _loads(MLIR(BinaryOps.ADD, (y, b))))
+    self.assertEqual([b, a], _loads(MLIR(BinaryOps.ADD, (b, y))))
+
+  def test_masked_consts_deep(self):
+    from shrimpgrad.engine.schedule import MLIRConst
+    from shrimpgrad.runtime.ops import BufferOps
+    from shrimpgrad.shapetracker import ShapeTracker
+    MLIR, (a, b) = self._leaves()
+    y = a
+    for _ in range(5000): y = MLIR(BinaryOps.ADD, (y, b))
+    self.assertFalse(_masked_consts(y))
+    self.assertIs(_leaf_st(y), a.arg.st)
+    pad = MLIR(BufferOps.CONST, (), MLIRConst(1.0, ShapeTracker.from_shape((2,)).pad(((1,1),)), dtypes.float32))
+    self.assertTrue(_masked_consts(MLIR(BinaryOps.MUL, (y, pad))))
+
+class TestClangParallel(unittest.TestCase):
+  def setUp(self):
+    self.dev = ClangDevice()
+    self.threads, self.threshold = self.dev.threads, self.dev.parallel_threshold
+  def tearDown(self):
+    self.dev.threads, self.dev.parallel_threshold = self.threads, self.threshold
+
+  def _run(self, threads):
+    self.dev.threads, self.dev.parallel_threshold = threads, 0
+    x = Tensor((7,5), [float(i) for i in range(35)])
+    y = Tensor((5,), [float(i) for i in range(5)])
+    return (x * y + x).data, (x * y).sum(axis=0).data, (x * y).sum(axis=1).data, x.sum().data
+
+  def test_parallel_matches_serial(self):
+    self.assertEqual(self._run(1), self._run(4))
+
+  def test_parallel_more_threads_than_rows(self):
+    self.assertEqual(self._run(1), self._run(64))
+
+class TestClangGemm(unittest.TestCase):
+  # the generated kernel, not the system BLAS
+  def setUp(self): self.use_blas, ClangDevice().use_blas = ClangDevice().use_blas, False
+  def tearDown(self): ClangDevice().use_blas = self.use_blas
+
+  def _schedule(self, *tensors):
+    from shrimpgrad.engine.schedule import Scheduler
+    from shrimpgrad.runtime.ops import BufferOps
+    return [sk.ast for sk in Scheduler([t.thunk for t in tensors]).schedule() if sk.ast.op is BufferOps.STORE]
+
+  def test_gemm_shapes(self):
+    rng = np.random.default_rng(0)
+    # edges of every tile and cache block, transposed operands and a batch
+    for (M, K, N) in [(1, 1, 1), (5, 7, 3), (6, 16, 16), (13, 300, 131), (64, 257, 17)]:
+      for trans in [False, True]:
+        with self.subTest(M=M, K=K, N=N, trans=trans):
+          a, b = rng.standard_normal((M, K), dtype=np.float32), rng.standard_normal((N, K) if trans else (K, N), dtype=np.float32)
+          x, w = Tensor.from_numpy(a), Tensor.from_numpy(b)
+          out = x.dot(w.transpose() if trans else w)
+          if M > 1 and N > 1: self.assertIsNotNone(gemm_dims(self._schedule(out)[0]))
+          np.testing.assert_allclose(out.numpy(), a @ (b.T if trans else b), rtol=1e-4, atol=1e-4)
+    a, b = rng.standard_normal((3, 9, 20), dtype=np.float32), rng.standard_normal((3, 20, 11), dtype=np.float32)
+    np.testing.assert_allclose(Tensor.from_numpy(a).dot(Tensor.from_numpy(b)).numpy(), a @ b, rtol=1e-4, atol=1e-4)
+
+  def test_gemm_backward(self):
+    # the weight gradient is a matmul of transposed views with the relu mask fused into it
+    rng = np.random.default_rng(1)
+    a, b = rng.standard_normal((10, 20), dtype=np.float32), rng.standard_normal((20, 30), dtype=np.float32)
+    x, w = Tensor.from_numpy(a, requires_grad=True), Tensor.from_numpy(b, requires_grad=True)
+    x.dot(w).relu().sum().backward()
+    self.assertTrue(any(gemm_dims(ast) is not None for ast in self._schedule(w.grad)))
+    mask = (a @ b > 0).astype(np.float32)
+    np.testing.assert_allclose(w.grad.numpy(), a.T @ mask, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(x.grad.numpy(), mask @ b.T, rtol=1e-4, atol=1e-4)
+
+  def test_gemm_parallel(self):
+    dev = ClangDevice()
+    threads, threshold = dev.threads, dev.parallel_threshold
+    try:
+      dev.threads, dev.parallel_threshold = 4, 0
+      a, b = np.arange(50*40, dtype=np.float32).reshape(50, 40)/100, np.ones((40, 30), dtype=np.float32)
+      np.testing.assert_allclose(Tensor.from_numpy(a).dot(Tensor.from_numpy(b)).numpy(), a @ b, rtol=1e-5)
+    finally: dev.threads, dev.parallel_threshold = threads, threshold
+
+@unittest.skipIf(load_blas() is None, 'no CBLAS library found')
+class TestBlas(unittest.TestCase):
+  def _ast(self, out):
+    from shrimpgrad.engine.schedule import Scheduler
+    return Scheduler([out.thunk]).schedule()[-1].ast
+
+  def test_blas_shapes(self):
+    rng = np.random.default_rng(2)
+    # gemm with every operand layout, a batch, and gemv on either side
+    cases = [((33, 17), (17, 9), False), ((33, 17), (9, 17), True), ((4, 10, 6), (4, 6, 5), False), ((8, 5), (5,), False), ((5,), (5, 8), False), ((8, 5), (5, 1), False)]
+    for sa, sb, trans in cases:
+      with self.subTest(a=sa, b=sb, trans=trans):
+        a, b = rng.standard_normal(sa, dtype=np.float32), rng.standard_normal(sb, dtype=np.float32)
+        out = Tensor.from_numpy(a).dot(Tensor.from_numpy(b).transpose() if trans else Tensor.from_numpy(b))
+        self.assertIsNotNone(ClangDevice().library_kernel(self._ast(out)))
+        np.testing.assert_allclose(out.numpy(), a @ (b.T if trans else b), rtol=1e-4, atol=1e-4)
+
+  def test_blas_backward(self):
+    rng = np.random.default_rng(3)
+    a, b = rng.standard_normal((10, 20), dtype=np.float32), rng.standard_normal((20, 30), dtype=np.float32)
+    x, w = Tensor.from_numpy(a, requires_grad=True), Tensor.from_numpy(b, requires_grad=True)
+    x.dot(w).relu().sum().backward()
+    mask = (a @ b > 0).astype(np.float32)
+    np.testing.assert_allclose(w.grad.numpy(), a.T @ mask, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(x.grad.numpy(), mask @ b.T, rtol=1e-4, atol=1e-4)
+
+  def test_blas_fallback(self):
+    # negative strides aren't addressable by BLAS and run the generated kernel
+    a = np.arange(12, dtype=np.float32).reshape(3, 4)
+    x = Tensor.from_numpy(a)
+    self.assertIsNone(ClangDevice().library_kernel(self._ast(x.flip(1).dot(x.transpose()))))
+    np.testing.assert_allclose(x.flip(1).dot(x.transpose()).numpy(), a[:, ::-1] @ a.T)
+    dev = ClangDevice()
+    try:
+      dev.use_blas = False
+      self.assertIsNone(dev.library_kernel(self._ast(x.dot(x.transpose()))))
+      np.testing.assert_allclose(x.dot(x.transpose()).numpy(), a @ a.T)
+    finally: dev.use_blas = True
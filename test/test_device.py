@@ -1,4 +1,7 @@
-from shrimpgrad.device import ClangDevice, CPU, MallocAllocator
+from shrimpgrad import Tensor
+from shrimpgrad.device import Buffer, ClangDevice, CPU, MallocAllocator, NumpyDevice, size_class
+from shrimpgrad.dtype import dtypes
+import numpy as np
 import unittest
 
 
@@ -14,3 +17,82 @@ class TestDevice(unittest.TestCase):
     dev = CPU()
     self.assertEqual("CPU", dev.name)
 
+
+class TestNumpyDevice(unittest.TestCase):
+  def _run(self, device):
+    x = Tensor((3,4), [float(i) - 5.0 for i in range(12)], device=device)
+    y = Tensor((4,), [0.5, 1.0, 2.0, -1.0], device=device)
+    w = Tensor((4,2), [float(i) for i in range(8)], device=device)
+    return [(x * y + 1.0).data, x.relu().data, (x > 0.0).where(x, y).data, x.dot(w).data, x.sum(axis=0).data, x.transpose().exp().data]
+
+  def test_numpy_device(self):
+    dev = NumpyDevice()
+    self.assertEqual("NUMPY", dev.name)
+    self.assertTrue(isinstance(dev.allocator(), MallocAllocator))
+
+  def test_numpy_matches_clang(self):
+    for np_out, clang_out in zip(self._run(NumpyDevice()), self._run(ClangDevice())):
+      np.testing.assert_allclose(np_out, clang_out, rtol=1e-6)
+
+class TestCachingAllocator(unittest.TestCase):
+  def test_size_class(self):
+    self.assertEqual(64, size_class(1))
+    self.assertEqual(1024, size_class(1000))
+    self.assertEqual(1024, size_class(1024))
+    self.assertEqual(2 << 20, size_class((1 << 20) + 1))
+
+  def test_reuse(self):
+    alloc = MallocAllocator()
+    block = alloc.alloc(400)
+    self.assertEqual(512, len(block))
+    alloc.free(block, 400)
+    self.assertIs(block, alloc.alloc(300))
+    self.assertEqual({'hits': 1, 'misses': 1, 'cached_bytes': 0}, {k:alloc.stats[k] for k in ('hits', 'misses', 'cached_bytes')})
+
+  def test_steady_state(self):
+    alloc = ClangDevice().allocator()
+    x, w = Tensor.randn(16,16), Tensor.randn(16,16)
+    ((x*w+1)*2).sum(axis=0).realize()
+    alloc.reset_stats()
+    for _ in range(3): ((x*w+1)*2).sum(axis=0).realize()
+    self.assertEqual(0, alloc.stats['misses'])
+    self.assertGreater(alloc.stats['hits'], 0)
+
+  def test_aliased_block_not_reused(self):
+    alloc = MallocAllocator()
+    buf = Buffer(NumpyDevice(), 4, dtypes.float32).allocate()
+    buf.allocator = alloc
+    arr = np.frombuffer(buf._buf, dtype=np.float32)
+    del buf
+    self.assertEqual(0, alloc.stats['cached_bytes'])
+    arr[:4] = 1.0
+    self.assertEqual(0, alloc.alloc(16)[0])
+
+  def test_cap_and_trim(self):
+    alloc = MallocAllocator(cap=128)
+    alloc.free(alloc.alloc(64), 64)
+    alloc.free(alloc.alloc(64), 64)
+    alloc.free(alloc.alloc(128), 128)
+    self.assertEqual(64, alloc.stats['cached_bytes'])
+    self.assertEqual(64, alloc.trim())
+    self.assertEqual(0, alloc.stats['cached_bytes'])
+
+  def test_threads(self):
+    from concurrent.futures import ThreadPoolExecutor
+    alloc = MallocAllocator()
+    def churn(_):
+      for _ in range(500): alloc.free(alloc.alloc(256), 256)
+    with ThreadPoolExecutor(8) as pool: list(pool.map(churn, range(8)))
+    # every block went back to the free list and the counters saw every call
+    self.assertEqual(8*500, alloc.stats['hits'] + alloc.stats['misses'])
+    self.assertEqual(alloc.stats['cached_bytes'], 256*len(alloc.free_lists[256]))
+    self.assertEqual(alloc.stats['misses'], len(alloc.free_lists[256]))
+
+  def test_deallocate_once(self):
+    from concurrent.futures import ThreadPoolExecutor
+    alloc = MallocAllocator()
+    buf = Buffer(NumpyDevice(), 4, dtypes.float32).allocate()
+    buf.allocator = alloc
+    with ThreadPoolExecutor(8) as pool: list(pool.map(lambda _: buf.deallocate(), range(8)))
+    self.assertFalse(buf.allocated)
+    self.assertEqual(64, alloc.stats['cached_bytes'])
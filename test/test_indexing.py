@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 from shrimpgrad import Tensor
 
 class TestIndexing(unittest.TestCase):
@@ -35,4 +36,71 @@ class TestIndexing(unittest.TestCase):
     #  [[4,5],
     #   [6,7]]]
     self.assertEqual('tensor([[[0, 1], [2, 3]], [[4, 5], [6, 7]]])', x.__str__())
-    self.assertEqual('tensor([[[0]]])', x[0,0,0].__str__())
\ No newline at end of file
+    self.assertEqual('tensor([[[0]]])', x[0,0,0].__str__())
+class TestViewIndexing(unittest.TestCase):
+  def setUp(self):
+    self.a = np.arange(60, dtype=np.float32).reshape(3,4,5)
+    self.t = Tensor.from_numpy(self.a)
+
+  def test_basic_indexing_is_a_view(self):
+    for key in [1, -1, (0,2), (slice(None),1), (Ellipsis,2), (None,1,Ellipsis), slice(None,None,-1), (slice(None),slice(None,None,2)),
+                (1,slice(3,0,-2),slice(1,5,3)), slice(5,1), (2,3,4)]:
+      with self.subTest(key=key):
+        x = self.t[key]
+        # no kernel and no copy, just a new view of the same buffer
+        self.assertIs(x.thunk.base, self.t.thunk.base)
+        np.testing.assert_equal(x.numpy(), self.a[key])
+        np.testing.assert_equal((x*2.0).numpy(), self.a[key]*2.0)
+
+  def test_batches(self):
+    for i in range(0, 3, 2):
+      batch = self.t[i:i+2]
+      self.assertEqual(len(batch.thunk.st.views), 1)
+      self.assertEqual(batch.thunk.st.view.offset, i*20)
+      np.testing.assert_equal(batch.sum(axis=0).numpy(), self.a[i:i+2].sum(axis=0))
+
+  def test_gather(self):
+    for key in [[2,0,0], (slice(None),[3,-1],None), (Ellipsis,[4,0])]:
+      with self.subTest(key=key): np.testing.assert_equal(self.t[key].numpy(), self.a[key])
+    idx = np.array([[1,-1],[0,2]], dtype=np.int32)
+    np.testing.assert_equal(self.t[:, Tensor.from_numpy(idx)].numpy(), self.a[:, idx])
+
+  def test_errors(self):
+    with self.assertRaises(IndexError): self.t[3]
+    with self.assertRaises(IndexError): self.t[0,0,0,0]
+    with self.assertRaises(IndexError): self.t[..., ...]
+    with self.assertRaises(IndexError): self.t[[0],[0]]
+
+  def test_backward(self):
+    x = Tensor.from_numpy(np.ones((4,6), dtype=np.float32), requires_grad=True)
+    (x[::-1, 1::2]*3.0).sum().backward()
+    np.testing.assert_equal(x.grad.numpy(), np.tile([0,3,0,3,0,3], (4,1)))
+    x.grad = None
+    x[[0,0,3]].sum().backward()
+    np.testing.assert_equal(x.grad.numpy()[:,0], [2,0,0,1])
+
+  def test_gather_non_finite(self):
+    # only the selected elements are read, an inf or nan elsewhere in the row doesn't reach them
+    from shrimpgrad.device import ClangDevice, NumpyDevice
+    a = np.array([[1, np.inf, 3, np.nan], [np.nan, 5, -np.inf, 7]], dtype=np.float32)
+    for device in [ClangDevice(), NumpyDevice()]:
+      with self.subTest(device=device.name):
+        t = Tensor.from_numpy(a, device=device, requires_grad=True)
+        np.testing.assert_equal(t[0, [0, 2]].numpy(), [1, 3])
+        np.testing.assert_equal(t[:, [1, 3]].numpy(), a[:, [1, 3]])
+        t[:, [0, 2]].sum().backward()
+        np.testing.assert_equal(t.grad.numpy(), [[1, 0, 1, 0]]*2)
+    # a gathered inf gradient stays on the element it came from
+    x = Tensor.from_numpy(np.ones(3, dtype=np.float32), requires_grad=True)
+    (x[[0, 2]] * Tensor.from_numpy(np.array([np.inf, 2], dtype=np.float32))).sum().backward()
+    np.testing.assert_equal(x.grad.numpy(), [np.inf, 0, 2])
+
+  def test_gather_is_a_load(self):
+    # an embedding lookup reads one row per index, no one-hot reduce over the table
+    from shrimpgrad.engine.schedule import Scheduler
+    from shrimpgrad.runtime.ops import BufferOps
+    table = np.random.default_rng(0).standard_normal((1000, 8)).astype(np.float32)
+    out = Tensor.from_numpy(table)[[5, 999, 0]]
+    ast = Scheduler([out.thunk]).schedule()[-1].ast
+    self.assertIs(ast.inputs[0].op, BufferOps.GATHER)
+    np.testing.assert_equal(out.numpy(), table[[5, 999, 0]])
@@ -0,0 +1,47 @@
+from shrimpgrad import Tensor, ShrimpJit
+import numpy as np
+import unittest
+
+class TestJit(unittest.TestCase):
+  def setUp(self):
+    self.w = Tensor.from_numpy(np.arange(16, dtype=np.float32).reshape(4,4) / 8.0)
+    self.calls = 0
+
+  def step(self, x: Tensor) -> Tensor:
+    self.calls += 1
+    return (x.dot(self.w) + 1.0).relu().sum(axis=1)
+
+  def expected(self, a: np.ndarray) -> np.ndarray: return np.maximum(a @ self.w.numpy() + 1.0, 0).sum(axis=1)
+
+  def test_replay(self):
+    step = ShrimpJit(self.step)
+    for _ in range(5):
+      a = np.random.standard_normal((3,4)).astype(np.float32)
+      np.testing.assert_allclose(self.expected(a), step(Tensor.from_numpy(a)).numpy(), rtol=1e-5, atol=1e-5)
+    # the graph is only built on the first two calls
+    self.assertEqual(2, self.calls)
+    self.assertGreater(len(step.jit_cache), 0)
+
+  def test_input_mismatch(self):
+    step = ShrimpJit(self.step)
+    for _ in range(2): step(Tensor.from_numpy(np.ones((3,4), dtype=np.float32)))
+    with self.assertRaises(AssertionError): step(Tensor.from_numpy(np.ones((2,4), dtype=np.float32)))
+
+  def test_input_view_mismatch(self):
+    # another slice of the same base buffer bakes a different offset into the kernels
+    a = np.arange(32, dtype=np.float32).reshape(8,4)
+    step = ShrimpJit(self.step)
+    for _ in range(3): step(Tensor.from_numpy(a)[0:3])
+    np.testing.assert_allclose(self.expected(a[0:3]), step(Tensor.from_numpy(a)[0:3]).numpy(), rtol=1e-5)
+    with self.assertRaises(AssertionError): step(Tensor.from_numpy(a)[4:7])
+    with self.assertRaises(AssertionError): step(Tensor.from_numpy(a.reshape(4,8)).permute((1,0))[0:3])
+    step.reset()
+    for _ in range(3): np.testing.assert_allclose(self.expected(a[4:7]), step(Tensor.from_numpy(a)[4:7]).numpy(), rtol=1e-5)
+
+  def test_reset(self):
+    step = ShrimpJit(self.step)
+    for _ in range(3): step(Tensor.from_numpy(np.ones((3,4), dtype=np.float32)))
+    step.reset()
+    a = np.full((2,4), 2.0, dtype=np.float32)
+    np.testing.assert_allclose(self.expected(a), step(Tensor.from_numpy(a)).numpy(), rtol=1e-5)
+    self.assertEqual(3, self.calls)
@@ -0,0 +1,70 @@
+from shrimpgrad import Tensor, no_grad
+from shrimpgrad.engine.memory import liveness, plan_memory
+from shrimpgrad.engine.schedule import Scheduler
+from shrimpgrad.runtime.ops import BufferOps
+import numpy as np
+import unittest
+
+@no_grad()
+def chain(x: Tensor, n: int) -> Tensor:
+  # every permute of a computed tensor makes its base an intermediate buffer,
+  # without autograd no function context keeps the intermediate tensors alive
+  for _ in range(n): x = (x + 1.0).permute((1,0))
+  return x * 2.0
+
+def stores_of(schedule): return [sk.outputs[0] for sk in schedule if sk.ast.op is BufferOps.STORE]
+
+class TestMemoryPlanner(unittest.TestCase):
+  def test_liveness(self):
+    x = Tensor.from_numpy(np.ones((4,4), dtype=np.float32))
+    schedule = Scheduler([chain(x, 2).thunk]).schedule()
+    lifetimes, stores = liveness(schedule), stores_of(schedule)
+    # each permuted intermediate is last read by the kernel that produces the next one
+    self.assertEqual([lifetimes[stores[1]][0], lifetimes[stores[2]][0]], [lifetimes[b][1] for b in stores[:2]])
+    self.assertEqual(lifetimes[stores[2]][0], lifetimes[stores[2]][1])
+
+  def test_arenas_shared(self):
+    x = Tensor.from_numpy(np.ones((4,4), dtype=np.float32))
+    y = chain(x, 6)
+    schedule = Scheduler([y.thunk]).schedule()
+    plan, stores = plan_memory(schedule, [y.thunk.buff]), stores_of(schedule)
+    self.assertNotIn(y.thunk.buff, plan.assignments)
+    # two intermediates are live at any kernel, so two arenas hold all six
+    self.assertEqual(2, len({plan.assignments[b] for b in stores[:-1]}))
+    self.assertLess(plan.peak, plan.unplanned)
+
+  def test_planned_matches(self):
+    arr = np.arange(16, dtype=np.float32).reshape(4,4)
+    expected = arr
+    for _ in range(5): expected = (expected + 1.0).T
+    np.testing.assert_allclose(expected * 2.0, chain(Tensor.from_numpy(arr), 5).numpy())
+
+  def test_intermediates_recomputed(self):
+    x = Tensor.from_numpy(np.arange(16, dtype=np.float32).reshape(4,4))
+    with no_grad():
+      y = (x + 1.0).permute((1,0))
+      z, thunk = (y * 2.0).sum(), y.thunk
+    # no tensor reads the intermediate anymore, the plan frees it and a later read recomputes it
+    del y
+    self.assertEqual(2*sum(range(1,17)), z.data)
+    self.assertIsNone(thunk.base.realized)
+    np.testing.assert_allclose((np.arange(16).reshape(4,4) + 1.0).T, Tensor(thunk.shape, thunk).numpy())
+
+  def test_live_tensors_kept(self):
+    x = Tensor.from_numpy(np.arange(16, dtype=np.float32).reshape(4,4))
+    # y is a view of an intermediate, c the output of a copy, both outlive the realize of z
+    with no_grad():
+      y, c = (x + 1.0).permute((1,0)), Tensor((4,), [1.0, 2.0, 3.0, 4.0])
+      z = (y * c).sum()
+    self.assertEqual(sum((np.arange(16).reshape(4,4) + 1.0).T.flatten()*np.tile([1.0, 2.0, 3.0, 4.0], 4)), z.data)
+    self.assertIsNotNone(y.thunk.base.realized)
+    self.assertIsNotNone(c.thunk.base.realized)
+    np.testing.assert_allclose((np.arange(16).reshape(4,4) + 1.0).T, y.numpy())
+
+  def test_realize_together(self):
+    x = Tensor.from_numpy(np.ones((4,4), dtype=np.float32))
+    y = (x + 1.0).permute((1,0))
+    a, b = (y * 2.0).sum(), (y * 3.0).sum()
+    a.realize(b)
+    self.assertEqual(64.0, a.data)
+    self.assertEqual(96.0, b.data)
@@ -77,7 +77,7 @@ class TestNN(unittest.TestCase):
     np.testing.assert_allclose(np.array(z.data), torch_z.detach().numpy(), atol=5e-4, rtol=1e-5)
     torch_z.backward()
     z.backward()
-    np.testing.assert_allclose(np.array(model.w.grad.data).reshape(2,2).transpose(), torch_model.weight.grad.detach().numpy(), atol=1e-6, rtol=1e-3)
+    np.testing.assert_allclose(np.array(model.w.grad.data).reshape(2,2), torch_model.weight.grad.detach().numpy(), atol=1e-6, rtol=1e-3)
 
   def test_basic_net(self):
     X, y  = dataset()
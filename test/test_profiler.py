@@ -0,0 +1,63 @@
+from shrimpgrad import Tensor
+from shrimpgrad.runtime.profiler import Profiler, PROFILER
+import json
+import os
+import tempfile
+import numpy as np
+import unittest
+
+class TestProfiler(unittest.TestCase):
+  def setUp(self): PROFILER.clear()
+  def tearDown(self): PROFILER.clear()
+
+  def test_disabled_records_nothing(self):
+    x = Tensor.from_numpy(np.ones((4,4), dtype=np.float32))
+    (x + 1.0).realize()
+    self.assertEqual(0, len(PROFILER.events))
+
+  def test_records_kernels(self):
+    x = Tensor.from_numpy(np.ones((8,4), dtype=np.float32))
+    with PROFILER: (x * 2.0).sum(axis=1).realize()
+    self.assertFalse(PROFILER.enabled)
+    self.assertEqual(1, len(PROFILER.events))
+    e = PROFILER.events[0]
+    self.assertEqual('CLANG', e.device)
+    self.assertEqual((8,1), e.shapes[0])
+    # a multiply and an accumulate for each of the 32 elements
+    self.assertEqual(2*32, e.flops)
+    self.assertEqual(32*4 + 8*4, e.nbytes)
+    self.assertGreater(e.duration, 0)
+    self.assertIn(e.name, PROFILER.summary())
+
+  def test_ring_buffer(self):
+    prof = Profiler(capacity=2)
+    for i in range(5): prof.record(f'k{i}', 'CLANG', ((1,),), 4, 1, i, 1)
+    self.assertEqual(['k3', 'k4'], [e.name for e in prof.events])
+
+  def test_chrome_trace(self):
+    prof = Profiler()
+    prof.record('E_4', 'CLANG', ((4,),), 32, 4, 5000, 2000)
+    prof.record('E_4', 'NUMPY', ((4,),), 32, 4, 9000, 1000)
+    with tempfile.TemporaryDirectory() as tmp:
+      prof.save_trace(path := os.path.join(tmp, 'trace.json'))
+      with open(path) as f: trace = json.load(f)
+    meta, event = [e for e in trace['traceEvents'] if e['ph'] == 'M'], [e for e in trace['traceEvents'] if e['ph'] == 'X']
+    self.assertEqual(('E_4', 'X', 5.0, 2.0), (event[0]['name'], event[0]['ph'], event[0]['ts'], event[0]['dur']))
+    self.assertEqual(4, event[0]['args']['flops'])
+    # integer pids, each named after its device
+    self.assertEqual({'CLANG': event[0]['pid'], 'NUMPY': event[1]['pid']}, {m['args']['name']: m['pid'] for m in meta if m['name'] == 'process_name'})
+    self.assertTrue(all(isinstance(e['pid'], int) for e in trace['traceEvents']))
+    self.assertNotEqual(event[0]['pid'], event[1]['pid'])
+
+  def test_shared_kernel_graph(self):
+    # y*y squared 60 times shares every node, the flop and shape walks visit each once
+    from shrimpgrad.dtype import dtypes
+    from shrimpgrad.engine.realize import _shapes, estimate_flops
+    from shrimpgrad.engine.schedule import MLIR, MLIRBuffer
+    from shrimpgrad.runtime.ops import BinaryOps, BufferOps
+    from shrimpgrad.shapetracker import ShapeTracker
+    y = MLIR(BufferOps.LOAD, (), MLIRBuffer(0, ShapeTracker.from_shape((4,)), dtypes.float32))
+    for _ in range(60): y = MLIR(BinaryOps.MUL, (y, y))
+    ast = MLIR(BufferOps.STORE, (y,), MLIRBuffer(1, ShapeTracker.from_shape((4,)), dtypes.float32))
+    self.assertEqual(60*4, estimate_flops(ast))
+    self.assertEqual(((4,),), _shapes(ast))
@@ -2,15 +2,78 @@ import unittest
 
 from shrimpgrad import Tensor
 from shrimpgrad.engine.schedule import Scheduler
-from shrimpgrad.runtime.ops import LoadOps 
+from shrimpgrad.runtime.ops import BinaryOps, BufferOps, LoadOps, ReduceOps
 
 class ScheduleTest(unittest.TestCase):
   def test_schedule_basic(self):
-    x = Tensor.full((2,2), 2.0)
+    x = Tensor((2,2), [2.0]*4)
 
     s = Scheduler([x.thunk])
     schedule = s.schedule()
 
     self.assertEqual(1, len(schedule))
     self.assertEqual(schedule[0].ast.op, LoadOps.COPY)
- 
\ No newline at end of file
+ 
+  def test_schedule_fused_elementwise(self):
+    x = Tensor.full((2,2), 2.0)
+    y = Tensor.full((2,2), 3.0)
+    z = (x * y + x).sigmoid()
+
+    s = Scheduler([z.thunk])
+    schedule = s.schedule()
+
+    # One kernel for the whole elementwise chain
+    self.assertEqual(1, len(schedule))
+    self.assertEqual(schedule[-1].ast.op, BufferOps.STORE)
+    self.assertEqual(schedule[-1].inputs, (x.thunk.buff, y.thunk.buff))
+    self.assertEqual(schedule[-1].outputs, (z.thunk.buff,))
+
+  def test_schedule_fused_elementwise_loads_once(self):
+    x = Tensor.full((2,2), 2.0)
+    z = x * x + x
+
+    schedule = Scheduler([z.thunk]).schedule()
+    loads = set()
+    def walk(mlir):
+      if mlir.op is BufferOps.LOAD: loads.add(mlir)
+      for src in mlir.inputs: walk(src)
+    walk(schedule[-1].ast)
+    self.assertEqual(1, len(loads))
+
+  def test_realize_fused_elementwise(self):
+    x = Tensor((2,2), [1.0, 2.0, 3.0, 4.0])
+    y = Tensor((2,), [10.0, 20.0])
+    z = (x * y + 1.0) / 2.0
+    self.assertEqual([5.5, 20.5, 15.5, 40.5], z.data)
+
+  def test_schedule_reduce_fuses_elementwise(self):
+    x = Tensor.full((4,3), 2.0)
+    w = Tensor.full((3,5), 3.0)
+    z = x.dot(w)
+
+    schedule = Scheduler([z.thunk]).schedule()
+
+    # The broadcast product is never stored, only the reduction
+    self.assertEqual(1, len(schedule))
+    self.assertEqual(schedule[-1].ast.inputs[0].op, ReduceOps.SUM)
+    self.assertEqual(schedule[-1].ast.inputs[0].inputs[0].op, BinaryOps.MUL)
+    self.assertEqual(schedule[-1].inputs, (x.thunk.buff, w.thunk.buff))
+
+  def test_realize_reduce(self):
+    x = Tensor((2,3), [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+    w = Tensor((3,2), [1.0, 0.0, 0.0, 1.0, 1.0, 1.0])
+    self.assertEqual([4.0, 5.0, 10.0, 11.0], x.dot(w).data)
+    self.assertEqual([17.0, 29.0, 45.0], x.square().sum(axis=0).data)
+    self.assertEqual(21.0, x.sum().data)
+
+  def test_realize_deep_chain(self):
+    # thousands of fused ops are scheduled, simplified and rendered without recursing
+    from shrimpgrad.device import ClangDevice, NumpyDevice
+    for device in [ClangDevice(), NumpyDevice()]:
+      with self.subTest(device=device.name):
+        x = Tensor((2,), [1.0, 0.5], device=device)
+        y = x
+        for _ in range(2000): y = y + x
+        self.assertEqual(1, len([sk for sk in Scheduler([y.thunk]).schedule() if sk.ast.op is BufferOps.STORE]))
+        self.assertEqual([2001.0, 1000.5], y.data)
+        self.assertEqual(3001.5, y.sum().data)
@@ -0,0 +1,102 @@
+from shrimpgrad import Tensor
+from shrimpgrad.dtype import dtypes
+from shrimpgrad.engine.schedule import MLIR, MLIRBuffer, MLIRConst, Scheduler
+from shrimpgrad.engine.rewrite import Pat, PatternMatcher, graph_rewrite
+from shrimpgrad.engine.simplify import simplify
+from shrimpgrad.runtime.ops import BinaryOps, BufferOps, TernaryOps, UnaryOps
+import math
+import numpy as np
+from shrimpgrad.shapetracker import ShapeTracker
+import unittest
+
+def load(): return MLIR(BufferOps.LOAD, (), MLIRBuffer(0, ShapeTracker.from_shape((2,2)), dtypes.float32))
+def const(val, dtype=dtypes.float32): return MLIR(BufferOps.CONST, (), MLIRConst(val, ShapeTracker.from_shape((2,2)), dtype))
+def nodes(ast):
+  seen = {}
+  def walk(n):
+    seen[id(n)] = n
+    for x in n.inputs: walk(x)
+  walk(ast)
+  return list(seen.values())
+
+class TestSimplify(unittest.TestCase):
+  def test_cse(self):
+    a, b = MLIR(UnaryOps.EXP2, (load(),)), MLIR(UnaryOps.EXP2, (load(),))
+    ast = simplify(MLIR(BinaryOps.ADD, (a, b)))
+    self.assertIs(ast.inputs[0], ast.inputs[1])
+    self.assertEqual(3, len(nodes(ast)))
+
+  def test_constant_fold(self):
+    ast = simplify(MLIR(BinaryOps.MUL, (MLIR(BinaryOps.ADD, (const(1.0), const(2.0))), const(4.0))))
+    self.assertEqual(BufferOps.CONST, ast.op)
+    self.assertEqual(12.0, ast.arg.val)
+    cmp = simplify(MLIR(BinaryOps.CMPLT, (const(1.0), const(2.0))))
+    self.assertEqual((True, dtypes.bool), (cmp.arg.val, cmp.arg.dtype))
+
+  def test_identities(self):
+    x = load()
+    for ast in [MLIR(BinaryOps.MUL, (x, const(1.0))), MLIR(BinaryOps.ADD, (const(0.0), x)), MLIR(BinaryOps.SUB, (x, const(0.0))),
+                MLIR(BinaryOps.DIV, (x, const(1.0))), MLIR(UnaryOps.NEG, (MLIR(UnaryOps.NEG, (x,)),))]:
+      self.assertIs(x, simplify(ast))
+    # 0-x is not x
+    self.assertEqual(BinaryOps.SUB, simplify(MLIR(BinaryOps.SUB, (const(0.0), x))).op)
+
+  def test_lowering(self):
+    x, y = load(), MLIR(BufferOps.LOAD, (), MLIRBuffer(1, ShapeTracker.from_shape((2,2)), dtypes.float32))
+    mulacc = simplify(MLIR(BinaryOps.ADD, (x, MLIR(BinaryOps.MUL, (x, y)))))
+    self.assertEqual(TernaryOps.MULACC, mulacc.op)
+    self.assertEqual([x, y, x], list(mulacc.inputs))
+    div = simplify(MLIR(BinaryOps.DIV, (x, const(4.0))))
+    self.assertEqual((BinaryOps.MUL, 0.25), (div.op, div.inputs[1].arg.val))
+    self.assertEqual(BinaryOps.DIV, simplify(MLIR(BinaryOps.DIV, (x, const(0.0)))).op)
+    exp = simplify(MLIR(UnaryOps.EXP2, (MLIR(BinaryOps.MUL, (x, const(1/math.log(2)))),)))
+    self.assertEqual((UnaryOps.EXP, x), (exp.op, exp.inputs[0]))
+
+  def test_lowered_results(self):
+    arr = np.linspace(-2, 2, 8, dtype=np.float32)
+    x = Tensor.from_numpy(arr)
+    np.testing.assert_allclose(np.exp(arr) / 3.0 + arr * arr, (x.exp() / 3.0 + x * x).numpy(), rtol=1e-6)
+    np.testing.assert_allclose(np.exp(-arr), (-x).exp().numpy(), rtol=1e-6)
+
+  def test_python_scalars_are_consts(self):
+    x = Tensor((2,2), [1.0, 2.0, 3.0, 4.0])
+    z = (x * 1.0 + 0.0) * (2.0 + 3.0)
+    schedule = Scheduler([z.thunk]).schedule()
+    # a copy for x and one kernel, the scalars never become buffers
+    self.assertEqual(2, len(schedule))
+    self.assertEqual(1, len(schedule[-1].inputs))
+    self.assertEqual([5.0, 10.0, 15.0, 20.0], z.data)
+
+  def test_relu_backward(self):
+    x = Tensor((4,), [-1.0, 2.0, -3.0, 4.0], requires_grad=True)
+    x.relu().sum().backward()
+    self.assertEqual([0.0, 1.0, 0.0, 1.0], x.grad.data)
+
+
+class TestRewrite(unittest.TestCase):
+  def test_match(self):
+    x = load()
+    store = {}
+    self.assertTrue(Pat(BinaryOps.MUL, (Pat(name='a'), Pat(name='a'))).match(MLIR(BinaryOps.MUL, (x, x)), store))
+    self.assertIs(x, store['a'])
+    self.assertFalse(Pat(BinaryOps.MUL, (Pat(name='a'), Pat(name='a'))).match(MLIR(BinaryOps.MUL, (x, load())), {}))
+    pat = Pat(BinaryOps.ADD, (Pat(BufferOps.CONST), Pat(name='a')))
+    self.assertFalse(pat.match(MLIR(BinaryOps.ADD, (x, const(1.0))), {}))
+    pat.commutative = True
+    self.assertTrue(pat.match(MLIR(BinaryOps.ADD, (x, const(1.0))), {}))
+
+  def test_memoized(self):
+    calls = []
+    pm = PatternMatcher([(Pat(UnaryOps.SIN, name='x'), lambda x: calls.append(x))])
+    node = load()
+    # a chain where every node is used twice, 2**40 paths but only 40 distinct nodes
+    for _ in range(40): node = MLIR(BinaryOps.ADD, (MLIR(UnaryOps.SIN, (node,)), MLIR(UnaryOps.SIN, (node,))))
+    graph_rewrite(node, pm)
+    self.assertEqual(40, len(calls))
+
+  def test_fixed_point(self):
+    # rules keep applying to what earlier rules produce
+    pm = PatternMatcher([(Pat(UnaryOps.NEG, (Pat(UnaryOps.NEG, (Pat(name='x'),)),)), lambda x: x),
+                         (Pat(UnaryOps.SQRT, (Pat(name='x'),)), lambda x: MLIR(UnaryOps.NEG, (MLIR(UnaryOps.NEG, (x,)),)))])
+    x = load()
+    self.assertIs(x, graph_rewrite(MLIR(UnaryOps.SQRT, (MLIR(UnaryOps.SQRT, (x,)),)), pm))
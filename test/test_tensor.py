@@ -1,6 +1,12 @@
+import shrimpgrad
 from shrimpgrad.tensor import Tensor
 from shrimpgrad.dtype import dtypes
+import os
+import tempfile
+import threading
 import unittest
+import weakref
+import numpy as np
 
 class TestTensor(unittest.TestCase):
   def test_full1(self):
@@ -17,4 +23,166 @@ class TestTensor(unittest.TestCase):
     self.assertEqual(x.data, [1.0,0.0,0.0,1.0])
     x = Tensor.eye(1)
     self.assertEqual(x.data, [1.0])
-    self.assertEqual(Tensor.eye(3).data, [1.0,0.0,0.0,0.0,1.0,0.0,0.0,0.0,1.0])
\ No newline at end of file
+    self.assertEqual(Tensor.eye(3).data, [1.0,0.0,0.0,0.0,1.0,0.0,0.0,0.0,1.0])
+
+class TestNumpyInterop(unittest.TestCase):
+  def test_from_numpy_shares_memory(self):
+    arr = np.arange(6, dtype=np.float32).reshape(2,3)
+    x = Tensor.from_numpy(arr)
+    self.assertEqual((2,3), x.shape)
+    arr[0,0] = 42.0
+    self.assertEqual(42.0, x.numpy()[0,0])
+
+  def test_from_numpy_dtype(self):
+    x = Tensor.from_numpy(np.arange(4))
+    self.assertEqual(dtypes.int32, x.dtype)
+    self.assertEqual([0,1,2,3], x.data)
+
+  def test_numpy_roundtrip(self):
+    arr = np.random.standard_normal((3,4)).astype(np.float32)
+    np.testing.assert_array_equal(arr, (Tensor.from_numpy(arr) + 0).numpy())
+
+  def test_numpy_permuted(self):
+    arr = np.arange(6, dtype=np.float32).reshape(2,3)
+    np.testing.assert_array_equal(arr.T, Tensor.from_numpy(arr).permute((1,0)).numpy())
+
+  def test_memoryview(self):
+    x = Tensor((2,2), memoryview(np.array([1,2,3,4], dtype=np.float32)))
+    self.assertEqual([1.0,2.0,3.0,4.0], x.data)
+
+class TestFileBacked(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmp.name, 'weights.bin')
+    np.arange(12, dtype=np.float32).tofile(self.path)
+  def tearDown(self): self.tmp.cleanup()
+
+  def test_from_file(self):
+    x = Tensor.from_file(self.path, (3,4))
+    np.testing.assert_array_equal(np.arange(12, dtype=np.float32).reshape(3,4), x.numpy())
+
+  def test_from_file_offset(self):
+    x = Tensor.from_file(self.path, (2,), offset=8*4)
+    self.assertEqual([8.0, 9.0], x.data)
+
+  def test_from_file_compute(self):
+    x = Tensor.from_file(self.path, (3,4))
+    self.assertEqual([2.0*i for i in range(12)], (x + x).data)
+    # Read only mappings never write back to the file
+    self.assertEqual(list(range(12)), np.fromfile(self.path, dtype=np.float32).tolist())
+
+  def test_to_file(self):
+    path = os.path.join(self.tmp.name, 'out.bin')
+    x = Tensor.from_file(self.path, (3,4))
+    y = (x * 2).to_file(path)
+    self.assertEqual([2.0*i for i in range(12)], np.fromfile(path, dtype=np.float32).tolist())
+    self.assertEqual([2.0*i for i in range(12)], y.data)
+
+  def test_to_file_offset(self):
+    Tensor((2,), [100.0, 200.0]).to_file(self.path, offset=4*4)
+    self.assertEqual([0.0, 1.0, 2.0, 3.0, 100.0, 200.0, 6.0], np.fromfile(self.path, dtype=np.float32).tolist()[:7])
+
+class TestBackward(unittest.TestCase):
+  def test_reverse_topo(self):
+    x = Tensor((2,), [1.0, 2.0], requires_grad=True)
+    y = x * x
+    z = y + x
+    order = [id(t) for t in z._reverse_topo()]
+    self.assertEqual(id(z), order[0])
+    self.assertLess(order.index(id(y)), order.index(id(x)))
+    self.assertEqual(len(order), len(set(order)))
+
+  def test_deep_graph(self):
+    x = Tensor((2,), [1.0, 0.5], requires_grad=True)
+    y = x
+    for _ in range(5000): y = y + x
+    # well past the recursion limit for the forward kernel too
+    self.assertEqual([5001.0, 2500.5], y.data)
+    y.sum().backward()
+    # and every context is freed on the way
+    self.assertIsNone(y.ctx)
+    self.assertEqual([5001.0, 5001.0], x.grad.data)
+
+  def test_grad_accumulates_without_history(self):
+    x = Tensor((2,), [1.0, 2.0], requires_grad=True)
+    (x * 3.0 + x * x + x).sum().backward()
+    self.assertIsNone(x.grad.ctx)
+    self.assertEqual([6.0, 8.0], x.grad.data)
+
+  def test_grad_accumulates_across_backward(self):
+    x = Tensor((2,), [1.0, 2.0], requires_grad=True)
+    for _ in range(3): (x * x).sum().backward()
+    self.assertIsNone(x.grad.ctx)
+    self.assertEqual([6.0, 12.0], x.grad.data)
+
+  def test_backward_twice_raises(self):
+    x, w = Tensor((2,), [1.0, 2.0], requires_grad=True), Tensor((2,), [3.0, 4.0], requires_grad=True)
+    h = x * w
+    h.sum().backward()
+    # h lost its context to the first backward, a second one through it can't reach x and w
+    with self.assertRaises(RuntimeError): (h * h).sum().backward()
+    self.assertEqual([3.0, 4.0], x.grad.data)
+    # leaves and fresh graphs over them are fine
+    (x * w).sum().backward()
+    self.assertEqual([6.0, 8.0], x.grad.data)
+
+class TestCheckpoint(unittest.TestCase):
+  def _grads(self, use_checkpoint: bool):
+    def segment(a, w): return (a.dot(w).relu() * 2.0).exp()
+    x = Tensor.from_numpy(np.linspace(-0.5, 0.5, 12, dtype=np.float32).reshape(3,4), requires_grad=True)
+    w = Tensor.from_numpy(np.eye(4, dtype=np.float32), requires_grad=True)
+    y = shrimpgrad.checkpoint(segment, x, w) if use_checkpoint else segment(x, w)
+    (y * 3.0).sum().backward()
+    return x.grad.numpy(), w.grad.numpy()
+
+  def test_matches_plain_backward(self):
+    for ck, plain in zip(self._grads(True), self._grads(False)): np.testing.assert_allclose(plain, ck, rtol=1e-6)
+
+  def test_saves_only_inputs(self):
+    x = Tensor((2,), [1.0, 2.0], requires_grad=True)
+    y = shrimpgrad.checkpoint(lambda a: (a * a).exp(), x)
+    self.assertEqual(1, len(y.ctx.tensors))
+    self.assertFalse(hasattr(y.ctx, 'ret') or hasattr(y.ctx, 'x'))
+    y.sum().backward()
+    np.testing.assert_allclose([2*np.exp(1.0), 4*np.exp(4.0)], x.grad.numpy(), rtol=1e-5)
+
+  def test_output_detached(self):
+    x = Tensor.from_numpy(np.arange(6, dtype=np.float32).reshape(2,3), requires_grad=True)
+    inner = []
+    def segment(a):
+      inner.append(weakref.ref((b := (a * a).exp()).thunk))
+      return b.permute((1,0))
+    y = shrimpgrad.checkpoint(segment, x)
+    # the output owns its buffer and the activations inside the segment are gone
+    self.assertFalse(hasattr(y.thunk, '_operands'))
+    self.assertIsNone(inner[0]())
+    np.testing.assert_allclose(np.exp(np.arange(6).reshape(2,3)**2).T, y.numpy(), rtol=1e-5)
+    y.sum().backward()
+    np.testing.assert_allclose(2*np.arange(6).reshape(2,3)*np.exp(np.arange(6).reshape(2,3)**2), x.grad.numpy(), rtol=1e-5)
+
+class TestNoGrad(unittest.TestCase):
+  def test_no_grad(self):
+    x = Tensor((2,), [1.0, 2.0], requires_grad=True)
+    with shrimpgrad.no_grad():
+      y = (x * x).exp()
+    self.assertIsNone(y.ctx)
+    self.assertFalse(y.requires_grad)
+    self.assertIsNotNone((x * x).ctx)
+    np.testing.assert_allclose(np.exp([1.0, 4.0]), y.numpy(), rtol=1e-6)
+
+  def test_decorator_nested(self):
+    @shrimpgrad.inference_mode()
+    def f(a): 
+      with shrimpgrad.no_grad(): b = a + 1.0
+      return b * a
+    self.assertIsNone(f(Tensor((2,), [1.0, 2.0], requires_grad=True)).ctx)
+    self.assertTrue(shrimpgrad.grad_enabled())
+
+  def test_thread_local(self):
+    seen = []
+    with shrimpgrad.no_grad():
+      t = threading.Thread(target=lambda: seen.append(shrimpgrad.grad_enabled()))
+      t.start()
+      t.join()
+      seen.append(shrimpgrad.grad_enabled())
+    self.assertEqual([True, False], seen)
@@ -1,8 +1,75 @@
 import unittest
 
+import numpy as np
+from shrimpgrad import Tensor
+from shrimpgrad.device import ClangDevice, NumpyDevice
+from shrimpgrad.shapetracker import ShapeTracker
 from shrimpgrad.view import View
 
 class TestView(unittest.TestCase):
   def test_view(self):
-    v = View(()) 
-    self.assertTrue(v._scalar)
\ No newline at end of file
+    v = View(())
+    self.assertTrue(v._scalar)
+
+  def test_reshape_merges_strides(self):
+    v = View((2,3,4)).permute((0,2,1))
+    self.assertIsNone(v.reshape((8,3)))
+    self.assertEqual(v.reshape((2,2,2,3)).strides, (12,2,1,4))
+    self.assertEqual(View((3,4)).expand((3,4)).reshape((12,)).strides, (1,))
+    self.assertEqual(View((3,1)).expand((3,4)).reshape((3,2,2)).strides, (1,0,0))
+
+  def test_shrink_pad(self):
+    v = View((4,4)).shrink(((1,3),(2,4)))
+    self.assertEqual((v.shape, v.offset, v.strides), ((2,2), 6, (4,1)))
+    p = v.pad(((1,0),(0,1)))
+    self.assertEqual((p.shape, p.mask, p.offset), ((3,3), ((1,3),(0,2)), 2))
+    self.assertIsNone(p.shrink(((1,3),(0,2))).mask)
+
+  def test_hashable(self):
+    self.assertEqual(View((2,3)).permute((1,0)), View((3,2), (1,3)))
+    self.assertEqual(len({View((2,3)), View((2,3)), View((3,2))}), 2)
+
+class TestShapeTracker(unittest.TestCase):
+  def test_permute_reshape_stacks(self):
+    self.assertEqual(len(ShapeTracker.from_shape((2,3,4)).permute((2,0,1)).reshape((4,6)).views), 1)
+    st = ShapeTracker.from_shape((2,3,4)).permute((2,0,1)).reshape((8,3))
+    self.assertEqual(len(st.views), 2)
+    idx, valid = st.expr(list(np.indices(st.shape)))
+    np.testing.assert_equal(idx, np.arange(24).reshape(2,3,4).transpose(2,0,1).reshape(8,3))
+    self.assertIsNone(valid)
+    # reshaping back to the permuted shape drops the extra view
+    self.assertEqual(len(st.reshape((4,2,3)).views), 1)
+
+  def test_pad_reshape_mask(self):
+    st = ShapeTracker.from_shape((2,2)).pad(((0,0),(1,1))).reshape((8,))
+    idx, valid = st.expr(list(np.indices(st.shape)))
+    np.testing.assert_equal(np.where(valid, idx, -1), [-1,0,1,-1,-1,2,3,-1])
+
+  def test_movement_chains(self):
+    chains = [
+      (lambda x: x.permute((2,0,1)).reshape(8,3), lambda x: x.transpose(2,0,1).reshape(8,3)),
+      (lambda x: x.permute((1,0,2)).reshape(3,8).permute((1,0)), lambda x: x.transpose(1,0,2).reshape(3,8).T),
+      (lambda x: x.reshape(2,3,4,1).expand(2,3,4,2).reshape(2,3,8), lambda x: np.broadcast_to(x.reshape(2,3,4,1), (2,3,4,2)).reshape(2,3,8)),
+      (lambda x: x.shrink(((0,2),(1,3),(1,4))), lambda x: x[:, 1:3, 1:]),
+      (lambda x: x.pad(((1,0),(0,0),(2,1))), lambda x: np.pad(x, ((1,0),(0,0),(2,1)))),
+      (lambda x: x.pad(((0,0),(1,1),(0,0))).reshape(2,20), lambda x: np.pad(x, ((0,0),(1,1),(0,0))).reshape(2,20)),
+      (lambda x: x.shrink(((1,2),(0,3),(0,4))).permute((2,1,0)).reshape(6,2), lambda x: x[1:2].transpose(2,1,0).reshape(6,2)),
+    ]
+    a = np.arange(24, dtype=np.float32).reshape(2,3,4)
+    for device in [ClangDevice(), NumpyDevice()]:
+      for i, (fn, np_fn) in enumerate(chains):
+        with self.subTest(device=device.name, chain=i):
+          t = fn(Tensor.from_numpy(a, device=device))
+          np.testing.assert_allclose(t.numpy(), np_fn(a))
+          # the same view read by a kernel
+          np.testing.assert_allclose((t*2.0).numpy(), np_fn(a)*2.0)
+
+  def test_reduce_over_stacked_view(self):
+    a = np.arange(24, dtype=np.float32).reshape(2,3,4)
+    t = Tensor.from_numpy(a).permute((2,0,1)).reshape(4,6)
+    np.testing.assert_allclose(t.sum(axis=1).numpy().reshape(-1), a.transpose(2,0,1).reshape(4,6).sum(axis=1))
+
+  def test_pad_shrink_backward(self):
+    x = Tensor.from_numpy(np.ones((2,3), dtype=np.float32), requires_grad=True)
+    (x.pad(((1,1),(0,2))).shrink(((0,3),(1,5)))*3.0).sum().backward()
+    np.testing.assert_allclose(x.grad.numpy(), [[0,3,3],[0,3,3]])